@@ -0,0 +1,150 @@
+# bench_download.py
+#
+# Compares the sendfile() and chunked read DWLD paths of ftp_server.py. Each mode runs the server as a subprocess on a
+# loopback port and downloads the same file several times, then reports throughput along with the server's CPU time and
+# peak memory.
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Constants
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "server", "ftp_server.py")
+HELLO_CHECK = b"Successfully connected to server!"
+RECEIVE_BUFFER_SIZE = 1024 * 1024
+MODES = {"sendfile": [], "chunked": ["--no-sendfile"]}
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def receive_exactly(sock, length):
+    data = bytearray(length)
+    view = memoryview(data)
+    amount_received = 0
+    while amount_received < length:
+        received = sock.recv_into(view[amount_received:])
+        if received == 0:
+            raise ConnectionError("Server closed the connection")
+        amount_received += received
+    return bytes(data)
+
+
+def connect(port, timeout=10):
+    """
+    Connects to the server and performs the HELO handshake, retrying while the server starts up.
+    :return: The connected socket
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            sock = socket.create_connection(("localhost", port))
+            break
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+    sock.sendall(b"HELO" + len(HELLO_CHECK).to_bytes(4, "big", signed=True) + HELLO_CHECK)
+    response_length = int.from_bytes(receive_exactly(sock, 4), "big", signed=True)
+    if receive_exactly(sock, response_length) != HELLO_CHECK:
+        raise ConnectionError("HELO handshake failed")
+    return sock
+
+
+def download(sock, file_name, buffer):
+    """
+    Downloads a file and throws its contents away.
+    :return: The number of bytes received
+    """
+    encoded_name = file_name.encode("utf-8")
+    sock.sendall(b"DWLD" + len(encoded_name).to_bytes(2, "big", signed=True) + encoded_name)
+    file_size = int.from_bytes(receive_exactly(sock, 4), "big", signed=True)
+    if file_size < 0:
+        raise FileNotFoundError(file_name)
+    remaining = file_size
+    while remaining > 0:
+        received = sock.recv_into(buffer, min(remaining, len(buffer)))
+        if received == 0:
+            raise ConnectionError("Server closed the connection mid-download")
+        remaining -= received
+    return file_size
+
+
+def peak_memory_kb(pid):
+    """
+    Reads a process's peak resident set size from /proc, where available.
+    :return: The peak RSS in KiB, or None
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_mode(mode, directory, file_name, repeats):
+    port = find_free_port()
+    cpu_before = os.times()
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "-p", str(port)] + MODES[mode], cwd=directory,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        sock = connect(port)
+        buffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+        t0 = time.perf_counter()
+        amount_received = 0
+        for i in range(repeats):
+            amount_received += download(sock, file_name, buffer)
+        elapsed = time.perf_counter() - t0
+        sock.sendall(b"QUIT")
+        sock.close()
+        peak_kb = peak_memory_kb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    cpu_after = os.times()
+    server_cpu = (cpu_after.children_user - cpu_before.children_user) + \
+                 (cpu_after.children_system - cpu_before.children_system)
+    return {
+        "mode": mode,
+        "bytes": amount_received,
+        "seconds": elapsed,
+        "throughput_mib_s": amount_received / elapsed / (1024 * 1024),
+        "server_cpu_seconds": server_cpu,
+        "server_peak_rss_kb": peak_kb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sendfile() and chunked DWLD serving")
+    parser.add_argument("-s", "--size", help="Size of the test file in MiB", type=int, default=256)
+    parser.add_argument("-r", "--repeats", help="Number of downloads per mode", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = "bench_download.bin"
+        with open(os.path.join(directory, file_name), "wb") as binary_file:
+            block = os.urandom(1024 * 1024)
+            for i in range(args.size):
+                binary_file.write(block)
+
+        print("Downloading {} MiB x {} per mode over loopback".format(args.size, args.repeats))
+        print("{:<10} {:>12} {:>16} {:>14}".format("mode", "MiB/s", "server CPU (s)", "peak RSS (KiB)"))
+        for mode in MODES:
+            result = run_mode(mode, directory, file_name, args.repeats)
+            print("{:<10} {:>12,.1f} {:>16.3f} {:>14}".format(result["mode"], result["throughput_mib_s"],
+                                                                result["server_cpu_seconds"],
+                                                                result["server_peak_rss_kb"] or "n/a"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# bench_segments.py
+#
+# Measures segmented DWLD throughput against the number of parallel segments. The server runs as a subprocess on a
+# loopback port and FTPClient.fetch_file_segmented downloads the same file with each segment count in turn.
+#
+# Loopback has almost no latency, so expect the gains here to be far smaller than over a long, fat link.
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir, "client"))
+
+import ftp_client  # noqa: E402
+
+# Constants
+SERVER_SCRIPT = os.path.join(BENCHMARKS_DIR, os.pardir, "server", "ftp_server.py")
+DEFAULT_SEGMENT_COUNTS = [1, 2, 4, 8]
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def open_client(port, timeout=10):
+    """
+    Opens a client session, retrying while the server starts up.
+    :return: The connected FTPClient
+    """
+    deadline = time.time() + timeout
+    # Keep the client's own progress messages out of the results
+    client = ftp_client.FTPClient(port=port, quiet=True)
+    while True:
+        try:
+            client.connect()
+            return client
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure segmented download throughput against segment count")
+    parser.add_argument("-s", "--size", help="Size of the test file in MiB", type=int, default=256)
+    parser.add_argument("-r", "--repeats", help="Number of downloads per segment count", type=int, default=3)
+    parser.add_argument("-n", "--segments", help="Segment counts to try", type=int, nargs="+",
+                        default=DEFAULT_SEGMENT_COUNTS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as server_directory, tempfile.TemporaryDirectory() as client_directory:
+        file_name = "bench_segments.bin"
+        with open(os.path.join(server_directory, file_name), "wb") as binary_file:
+            block = os.urandom(1024 * 1024)
+            for i in range(args.size):
+                binary_file.write(block)
+
+        port = find_free_port()
+        workers = str(max(args.segments) + 1)
+        server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "-p", str(port), "-w", workers],
+                                  cwd=server_directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # The client writes downloads into the working directory
+        original_directory = os.getcwd()
+        os.chdir(client_directory)
+        try:
+            client = open_client(port)
+            if "range" not in client.features:
+                sys.exit("Server does not support range requests")
+
+            print("Downloading {} MiB x {} per segment count over loopback".format(args.size, args.repeats))
+            print("{:>9} {:>12} {:>12}".format("segments", "MiB/s", "seconds"))
+            for segments in args.segments:
+                t0 = time.perf_counter()
+                for i in range(args.repeats):
+                    client.fetch_file_segmented(file_name, segments)
+                elapsed = time.perf_counter() - t0
+                throughput = args.size * args.repeats / elapsed
+                print("{:>9} {:>12,.1f} {:>12.3f}".format(segments, throughput, elapsed / args.repeats))
+            client.close()
+        finally:
+            os.chdir(original_directory)
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+# bench_throughput.py
+#
+# Measures UPLD, DWLD and LIST throughput and latency over loopback across file sizes, buffer sizes and numbers of
+# concurrent sessions. For each buffer size the server runs as a subprocess on a free port, then every file size is
+# uploaded and downloaded by each number of concurrent sessions in turn, each session with its own file. Sessions are
+# driven through FTPClient's library methods, so nothing waits on the menu.
+#
+# Results are printed as a table and can be written as JSON with -o, to be compared between runs. The server always runs
+# as a subprocess: it serves its working directory, which an in-process server would share with the client.
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir, "client"))
+
+import ftp_client  # noqa: E402
+
+# Constants
+SERVER_SCRIPT = os.path.join(BENCHMARKS_DIR, os.pardir, "server", "ftp_server.py")
+DEFAULT_FILE_SIZES = ["1K", "64K", "1M", "16M", "256M"]
+DEFAULT_BUFFER_SIZES = ["64K", "256K", "1M"]
+DEFAULT_CONCURRENCY = [1, 4]
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+# Test files are written from a block of random data repeated, so they don't compress and generating them is quick
+FILL_BLOCK_SIZE = 1024 * 1024
+RESULTS_FORMAT_VERSION = 1
+
+
+def parse_size(text):
+    """
+    Parses a size such as "512", "64K", "1M" or "2G" as a number of bytes.
+    """
+    text = text.strip().upper()
+    if text[-1:] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for suffix in ("G", "M", "K"):
+        if size >= SIZE_SUFFIXES[suffix] and size % SIZE_SUFFIXES[suffix] == 0:
+            return "{}{}".format(size // SIZE_SUFFIXES[suffix], suffix)
+    return str(size)
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    """
+    Gets a percentile of some values by the nearest-rank method.
+    :param sorted_values: The values, sorted
+    :param fraction: The percentile as a fraction, e.g. 0.95
+    """
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarise_latencies(latencies):
+    """
+    Summarises per-operation latencies in milliseconds.
+    """
+    latencies = sorted(latency * 1000 for latency in latencies)
+    return {
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else None,
+    }
+
+
+def write_test_file(path, size, block):
+    with open(path, "wb") as binary_file:
+        remaining = size
+        while remaining > 0:
+            binary_file.write(block[:min(remaining, len(block))])
+            remaining -= len(block)
+
+
+def open_client(port, buffer_size, timeout=10):
+    """
+    Opens a client session, retrying while the server starts up.
+    :return: The connected FTPClient
+    """
+    deadline = time.time() + timeout
+    # Deltas would turn repeated uploads of an unchanged file into a few bytes of block references
+    client = ftp_client.FTPClient(buffer_size, use_delta=False, port=port, quiet=True)
+    while True:
+        try:
+            client.connect()
+            return client
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_sessions(clients, operation):
+    """
+    Runs an operation on every session at once, one thread per session.
+    :param clients: The connected FTPClients
+    :param operation: A function called with a session's index and FTPClient, returning the latencies it measured
+    :return: A (wall-clock seconds, list of latencies) tuple
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = threading.Barrier(len(clients) + 1)
+
+    def session_thread(index, client):
+        start.wait()
+        try:
+            measured = operation(index, client)
+        except Exception as e:
+            errors.append(e)
+            return
+        with lock:
+            latencies.extend(measured)
+
+    threads = [threading.Thread(target=session_thread, args=(index, client)) for index, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+    if errors:
+        raise errors[0]
+    return elapsed, latencies
+
+
+def timed(function, *args):
+    t0 = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - t0
+
+
+def make_result(operation, file_size, buffer_size, concurrency, elapsed, latencies):
+    byte_count = file_size * len(latencies)
+    return {
+        "operation": operation,
+        "file_size": file_size,
+        "buffer_size": buffer_size,
+        "concurrency": concurrency,
+        "operations": len(latencies),
+        "bytes": byte_count,
+        "seconds": elapsed,
+        "throughput_mib_s": byte_count / elapsed / (1024 * 1024) if byte_count else None,
+        "operations_per_second": len(latencies) / elapsed,
+        "latency_ms": summarise_latencies(latencies),
+    }
+
+
+def print_result(result):
+    latency = result["latency_ms"]
+    throughput = result["throughput_mib_s"]
+    print("{:<5} {:>6} {:>6} {:>4} {:>10} {:>10,.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+        result["operation"], format_size(result["file_size"]) if result["file_size"] else "-",
+        format_size(result["buffer_size"]), result["concurrency"],
+        "{:,.1f}".format(throughput) if throughput is not None else "-", result["operations_per_second"],
+        latency["p50"], latency["p95"], latency["p99"]))
+
+
+def run_buffer_size(buffer_size, file_sizes, concurrency_levels, repeats, list_repeats, server_args):
+    """
+    Runs every file size and concurrency level against a server using the given buffer size.
+    :return: A list of result dicts
+    """
+    results = []
+    block = os.urandom(FILL_BLOCK_SIZE)
+    with tempfile.TemporaryDirectory() as server_directory, tempfile.TemporaryDirectory() as client_directory:
+        port = find_free_port()
+        workers = str(max(concurrency_levels) + 1)
+        server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "-p", str(port), "-w", workers,
+                                   "-b", str(buffer_size)] + server_args,
+                                  cwd=server_directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # The client reads uploads from and writes downloads to the working directory
+        original_directory = os.getcwd()
+        os.chdir(client_directory)
+        try:
+            for concurrency in concurrency_levels:
+                clients = [open_client(port, buffer_size) for i in range(concurrency)]
+                try:
+                    for file_size in file_sizes:
+                        file_names = ["bench_{}_{}.bin".format(format_size(file_size), index)
+                                      for index in range(concurrency)]
+                        for file_name in file_names:
+                            write_test_file(file_name, file_size, block)
+
+                        upload = run_sessions(clients, lambda index, client: [
+                            timed(client.upload, file_names[index]) for i in range(repeats)])
+                        download = run_sessions(clients, lambda index, client: [
+                            timed(client.download, file_names[index]) for i in range(repeats)])
+                        for operation, (elapsed, latencies) in (("UPLD", upload), ("DWLD", download)):
+                            result = make_result(operation, file_size, buffer_size, concurrency, elapsed, latencies)
+                            print_result(result)
+                            results.append(result)
+
+                    # Every file uploaded so far is in the listing
+                    elapsed, latencies = run_sessions(clients, lambda index, client: [
+                        timed(client.list) for i in range(list_repeats)])
+                    result = make_result("LIST", 0, buffer_size, concurrency, elapsed, latencies)
+                    print_result(result)
+                    results.append(result)
+                finally:
+                    for client in clients:
+                        client.close()
+        finally:
+            os.chdir(original_directory)
+            server.terminate()
+            server.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure UPLD, DWLD and LIST throughput and latency over loopback")
+    parser.add_argument("-s", "--sizes", help="File sizes to transfer, e.g. 1K 1M 2G", nargs="+",
+                        default=DEFAULT_FILE_SIZES)
+    parser.add_argument("-b", "--buffer-sizes", help="Transfer buffer sizes to give the server and client", nargs="+",
+                        default=DEFAULT_BUFFER_SIZES)
+    parser.add_argument("-c", "--concurrency", help="Numbers of sessions to run at once", type=int, nargs="+",
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument("-r", "--repeats", help="Transfers of each file per session", type=int, default=3)
+    parser.add_argument("-l", "--list-repeats", help="LIST requests per session", type=int, default=100)
+    parser.add_argument("-o", "--output", help="Write the results to this file as JSON")
+    parser.add_argument("--server-args", help="Extra arguments for the server, e.g. \"--no-sendfile\"", default="")
+    args = parser.parse_args()
+
+    file_sizes = [parse_size(size) for size in args.sizes]
+    buffer_sizes = [parse_size(size) for size in args.buffer_sizes]
+    server_args = args.server_args.split()
+
+    print("Transferring each file {} times per session over loopback".format(args.repeats))
+    print("{:<5} {:>6} {:>6} {:>4} {:>10} {:>10} {:>9} {:>9} {:>9}".format(
+        "op", "size", "buffer", "conc", "MiB/s", "ops/s", "p50 (ms)", "p95 (ms)", "p99 (ms)"))
+    results = []
+    started = time.time()
+    for buffer_size in buffer_sizes:
+        results.extend(run_buffer_size(buffer_size, file_sizes, args.concurrency, args.repeats, args.list_repeats,
+                                       server_args))
+
+    if args.output:
+        report = {
+            "format_version": RESULTS_FORMAT_VERSION,
+            "started": started,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "server_args": server_args,
+            "repeats": args.repeats,
+            "results": results,
+        }
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print("Results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
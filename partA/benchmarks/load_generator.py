@@ -0,0 +1,394 @@
+# load_generator.py
+#
+# Simulates many clients using the server at once, to size hardware and to catch FTPServer slowing down under
+# contention. Each client is a thread with its own FTPClient session, which runs a weighted mix of HELO, UPLD, DWLD,
+# LIST and DELF with a pause between operations. Uploaded file sizes are drawn from a weighted list, and each client
+# only downloads and deletes the files it uploaded itself. With --delta, some uploads are small edits to a file the
+# client already uploaded, which go out as deltas.
+#
+# Throughput and latency percentiles are printed every few seconds while the load runs, then totalled per operation.
+# Without --port a server is started as a subprocess on a free loopback port.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir, "client"))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir, "server"))
+
+import ftp_client  # noqa: E402
+from ftp_metrics import ServerMetrics  # noqa: E402
+
+# Constants
+SERVER_SCRIPT = os.path.join(BENCHMARKS_DIR, os.pardir, "server", "ftp_server.py")
+OPERATIONS = ["HELO", "UPLD", "DWLD", "LIST", "DELF"]
+# Every operation is also recorded under this name, for percentiles across the whole mix
+ALL_OPERATIONS = "ALL"
+DEFAULT_MIX = "HELO=1,UPLD=4,DWLD=8,LIST=2,DELF=1"
+DEFAULT_SIZES = "1K=50,64K=30,1M=15,16M=5"
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+FILL_BLOCK_SIZE = 1024 * 1024
+# With --delta, this fraction of uploads re-upload one of the client's files after overwriting EDIT_SIZE bytes of it
+DELTA_UPLOAD_FRACTION = 0.5
+EDIT_SIZE = 64
+RESULTS_FORMAT_VERSION = 1
+
+
+def parse_size(text):
+    """
+    Parses a size such as "512", "64K", "1M" or "2G" as a number of bytes.
+    """
+    text = text.strip().upper()
+    if text[-1:] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def parse_weights(text, parse_key):
+    """
+    Parses a comma-separated list of weighted choices such as "UPLD=4,DWLD=8".
+    :param text: The list
+    :param parse_key: A function to parse each choice with
+    :return: A (list of choices, list of weights) tuple
+    """
+    choices = []
+    weights = []
+    for item in text.split(","):
+        key, separator, weight = item.partition("=")
+        choices.append(parse_key(key))
+        weights.append(float(weight) if separator else 1.0)
+    if not choices or min(weights) < 0 or sum(weights) <= 0:
+        raise ValueError("Weights must not be negative and must not all be zero: {}".format(text))
+    return choices, weights
+
+
+def parse_operation(text):
+    operation = text.strip().upper()
+    if operation not in OPERATIONS:
+        raise ValueError("Unknown operation {}, expected one of {}".format(text, ", ".join(OPERATIONS)))
+    return operation
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class LoadClient:
+    """
+    One simulated client, run on its own thread until the load stops.
+    """
+
+    def __init__(self, generator, index):
+        self.generator = generator
+        self.index = index
+        self.random = random.Random(generator.seed + index if generator.seed is not None else None)
+        self.client = ftp_client.FTPClient(generator.buffer_size, use_delta=generator.use_delta,
+                                           host=generator.host, port=generator.port, quiet=True)
+        self.directory = os.path.join(generator.directory, "client-{}".format(index))
+        os.makedirs(self.directory)
+        # The names and sizes of the files this client has on the server
+        self.uploaded = {}
+        self.uploads = 0
+
+    def run(self):
+        while not self.generator.stopping.is_set():
+            operation = self.random.choices(self.generator.operations, self.generator.operation_weights)[0]
+            if operation in ("DWLD", "DELF") and not self.uploaded:
+                # Nothing of ours to download or delete yet
+                operation = "UPLD"
+            t0 = time.perf_counter()
+            byte_count = 0
+            failed = False
+            try:
+                byte_count = self.perform(operation)
+            except OSError as e:
+                failed = True
+                # A call that fails part way through has already dropped its session, the next one starts a new one
+                self.generator.report_error(operation, e)
+            self.generator.record(operation, time.perf_counter() - t0, byte_count, failed)
+
+            if self.generator.think_time > 0:
+                self.generator.stopping.wait(self.random.expovariate(1 / self.generator.think_time))
+        try:
+            self.client.close()
+        except OSError:
+            pass
+
+    def perform(self, operation):
+        """
+        Runs one operation.
+        :return: The number of bytes of file contents it moved
+        """
+        if operation == "HELO":
+            # A client arriving: a new connection and handshake
+            self.client.close()
+            self.client.connect()
+            return 0
+        self.client.connect()
+        if operation == "UPLD":
+            if self.generator.use_delta and self.uploaded and self.random.random() < DELTA_UPLOAD_FRACTION:
+                name = self.random.choice(list(self.uploaded))
+                size = self.uploaded[name]
+                self.client.upload(self.edit_file(size), name)
+                return size
+            size = self.random.choices(self.generator.sizes, self.generator.size_weights)[0]
+            name = "load-{}-{}.bin".format(self.index, self.uploads)
+            self.uploads += 1
+            self.client.upload(self.generator.source_files[size], name)
+            self.uploaded[name] = size
+            return size
+        if operation == "DWLD":
+            name = self.random.choice(list(self.uploaded))
+            self.client.download(name, os.path.join(self.directory, "download.bin"))
+            return self.uploaded[name]
+        if operation == "LIST":
+            self.client.list()
+            return 0
+        if operation == "DELF":
+            name = self.random.choice(list(self.uploaded))
+            del self.uploaded[name]
+            self.client.delete(name)
+            return 0
+        raise ValueError(operation)
+
+    def edit_file(self, size):
+        """
+        Overwrites a few bytes at a random place in this client's own copy of the source file of a size, making the
+        copy first if need be. Every file of that size the client uploaded is an earlier version of the copy, so
+        uploading it under any of their names sends only the edits.
+        :param size: The size of the file
+        :return: The path of the edited copy
+        """
+        path = os.path.join(self.directory, "edit-{}.bin".format(size))
+        if not os.path.exists(path):
+            shutil.copyfile(self.generator.source_files[size], path)
+        if size > 0:
+            with open(path, "r+b") as binary_file:
+                binary_file.seek(self.random.randrange(size))
+                binary_file.write(self.random.randbytes(min(EDIT_SIZE, size - binary_file.tell())))
+        return path
+
+
+class LoadGenerator:
+
+    def __init__(self, host, port, clients, operations, operation_weights, sizes, size_weights, think_time,
+                 buffer_size, use_delta, seed, directory):
+        self.host = host
+        self.port = port
+        self.client_count = clients
+        self.operations = operations
+        self.operation_weights = operation_weights
+        self.sizes = sizes
+        self.size_weights = size_weights
+        self.think_time = think_time
+        self.buffer_size = buffer_size
+        self.use_delta = use_delta
+        self.seed = seed
+        self.directory = directory
+        self.stopping = threading.Event()
+
+        # One set of totals for the current interval and one for the whole run, both keyed by operation. The byte
+        # counts go in bytes_sent, meaning moved in either direction.
+        self.lock = threading.Lock()
+        self.interval_metrics = ServerMetrics()
+        self.total_metrics = ServerMetrics()
+        self.errors = {}
+
+        # One local file of each size to upload, written once up front so uploads don't wait on generating data
+        self.source_files = {}
+        block = os.urandom(FILL_BLOCK_SIZE)
+        for size in sizes:
+            path = os.path.join(directory, "source-{}.bin".format(size))
+            with open(path, "wb") as binary_file:
+                remaining = size
+                while remaining > 0:
+                    binary_file.write(block[:min(remaining, len(block))])
+                    remaining -= len(block)
+            self.source_files[size] = path
+
+    def record(self, operation, seconds, byte_count, failed):
+        with self.lock:
+            metrics = (self.interval_metrics, self.total_metrics)
+        for operation_metrics in metrics:
+            operation_metrics.record_command(operation, seconds, bytes_sent=byte_count, failed=failed)
+            operation_metrics.record_command(ALL_OPERATIONS, seconds, bytes_sent=byte_count, failed=failed)
+
+    def report_error(self, operation, error):
+        with self.lock:
+            first = (operation, type(error).__name__) not in self.errors
+            self.errors[(operation, type(error).__name__)] = self.errors.get((operation, type(error).__name__), 0) + 1
+        if first:
+            print("Error: {} failed: {!r}".format(operation, error))
+
+    def take_interval(self):
+        """
+        Starts a new interval.
+        :return: The totals of the one that ended, as a ServerMetrics snapshot
+        """
+        with self.lock:
+            metrics = self.interval_metrics
+            self.interval_metrics = ServerMetrics()
+        return metrics.snapshot()
+
+    def run(self, duration, interval):
+        """
+        Runs the load for the given number of seconds, printing a line per interval.
+        :return: A list of the intervals' snapshots and the snapshot of the whole run
+        """
+        load_clients = [LoadClient(self, index) for index in range(self.client_count)]
+        threads = [threading.Thread(target=load_client.run, name="load-client-{}".format(load_client.index),
+                                    daemon=True) for load_client in load_clients]
+        print("{:>7} {:>9} {:>9} {:>7} {:>9} {:>9} {:>9}".format("time", "ops/s", "MiB/s", "errors", "p50 (ms)",
+                                                                 "p95 (ms)", "p99 (ms)"))
+        t0 = time.time()
+        self.take_interval()
+        self.total_metrics = ServerMetrics()
+        for thread in threads:
+            thread.start()
+
+        intervals = []
+        try:
+            while time.time() - t0 < duration:
+                self.stopping.wait(min(interval, max(0, duration - (time.time() - t0))))
+                snapshot = self.take_interval()
+                snapshot["elapsed"] = time.time() - t0
+                intervals.append(snapshot)
+                print_interval(snapshot)
+        except KeyboardInterrupt:
+            print("Stopping early...")
+        finally:
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+        return intervals, self.total_metrics.snapshot()
+
+
+def print_interval(snapshot):
+    seconds = max(snapshot["uptime"], 1e-9)
+    command = snapshot["commands"].get(ALL_OPERATIONS)
+    if command is None:
+        print("{:>6.1f}s {:>9}".format(snapshot["elapsed"], "idle"))
+        return
+    latency = command["latency_ms"]
+    print("{:>6.1f}s {:>9,.1f} {:>9,.1f} {:>7,} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+        snapshot["elapsed"], command["count"] / seconds, command["bytes_sent"] / seconds / (1024 * 1024),
+        command["errors"], latency["p50"], latency["p95"], latency["p99"]))
+
+
+def print_totals(totals):
+    seconds = max(totals["uptime"], 1e-9)
+    print("\n{:<6} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format("op", "count", "errors", "ops/s", "MiB/s",
+                                                                       "p50 (ms)", "p95 (ms)", "p99 (ms)"))
+    for operation in OPERATIONS + [ALL_OPERATIONS]:
+        command = totals["commands"].get(operation)
+        if command is None:
+            continue
+        latency = command["latency_ms"]
+        print("{:<6} {:>9,} {:>7,} {:>9,.1f} {:>9,.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            operation, command["count"], command["errors"], command["count"] / seconds,
+            command["bytes_sent"] / seconds / (1024 * 1024), latency["p50"], latency["p95"], latency["p99"]))
+
+
+def wait_for_server(host, port, timeout=10):
+    """
+    Waits until the server it started accepts connections.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many simulated clients against the server at once")
+    parser.add_argument("--host", help="The server to load, by default one started on loopback", default="localhost")
+    parser.add_argument("-p", "--port", help="The port of a running server, by default one is started", type=int)
+    parser.add_argument("-n", "--clients", help="Number of concurrent clients", type=int, default=16)
+    parser.add_argument("-d", "--duration", help="Seconds to run for", type=float, default=30)
+    parser.add_argument("-i", "--interval", help="Seconds between progress lines", type=float, default=5)
+    parser.add_argument("-m", "--mix", help="Weighted mix of operations, default \"{}\"".format(DEFAULT_MIX),
+                        default=DEFAULT_MIX)
+    parser.add_argument("-s", "--sizes", help="Weighted mix of upload sizes, default \"{}\"".format(DEFAULT_SIZES),
+                        default=DEFAULT_SIZES)
+    parser.add_argument("-t", "--think-time", help="Mean milliseconds each client waits between operations, "
+                                                   "exponentially distributed", type=float, default=0)
+    parser.add_argument("-b", "--buffer-size", help="Transfer buffer size of each client", type=int,
+                        default=ftp_client.DEFAULT_TRANSFER_BUFFER_SIZE)
+    parser.add_argument("--delta", help="Let clients upload changes to files as deltas, and make half of the uploads "
+                                         "small edits to files they already uploaded", action="store_true")
+    parser.add_argument("--seed", help="Seed the random choices so runs can be repeated", type=int)
+    parser.add_argument("-o", "--output", help="Write the intervals and totals to this file as JSON")
+    parser.add_argument("--server-args", help="Extra arguments for the server it starts, e.g. \"-w 64\"", default="")
+    args = parser.parse_args()
+
+    if args.clients < 1:
+        parser.error("--clients must be at least 1")
+    if args.duration <= 0 or args.interval <= 0:
+        parser.error("--duration and --interval must be positive")
+    try:
+        operations, operation_weights = parse_weights(args.mix, parse_operation)
+        sizes, size_weights = parse_weights(args.sizes, parse_size)
+    except ValueError as e:
+        parser.error(str(e))
+
+    server = None
+    with tempfile.TemporaryDirectory() as directory:
+        port = args.port
+        if port is None:
+            port = find_free_port()
+            server_directory = os.path.join(directory, "server")
+            os.makedirs(server_directory)
+            # Every client holds a session for the whole run, so the server needs a worker for each
+            server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "-p", str(port), "-w", str(args.clients)] +
+                                      args.server_args.split(), cwd=server_directory,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_for_server(args.host, port)
+
+        try:
+            generator = LoadGenerator(args.host, port, args.clients, operations, operation_weights, sizes,
+                                      size_weights, args.think_time / 1000, args.buffer_size, args.delta, args.seed,
+                                      directory)
+            print("Running {} clients against {}:{} for {:g} seconds".format(args.clients, args.host, port,
+                                                                             args.duration))
+            intervals, totals = generator.run(args.duration, args.interval)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    print_totals(totals)
+    if args.output:
+        report = {
+            "format_version": RESULTS_FORMAT_VERSION,
+            "clients": args.clients,
+            "mix": args.mix,
+            "sizes": args.sizes,
+            "think_time_ms": args.think_time,
+            "intervals": intervals,
+            "totals": totals,
+            "errors": [{"operation": operation, "error": error, "count": count}
+                       for (operation, error), count in generator.errors.items()],
+        }
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print("Results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,55 @@
 # ftp_client.py
 
+import hashlib
 import json
+import os
+import shlex
 import socket
 import sys
+import threading
 import argparse
-
-# Constants
 import time
+import zlib
+
+# The wire format is shared with the server, one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import ftp_protocol  # noqa: E402
+from ftp_protocol import (CHUNK_FLAGS_BLOCK, CHUNK_FLAGS_COMPRESSED, CHUNK_FLAGS_NONE, CHUNK_HEADER,  # noqa: E402
+                          CODECS, COMPRESSION_SKIP_RATIO, DELTA_SIGNATURE, DELTA_STRONG_DIGEST_SIZE, DIGEST_ALGORITHM,
+                          HELLO_BUSY, HELLO_CHECK, HELLO_OPTIONS_SEPARATOR, MAX_COMPRESSED_CHUNK_SIZE, PROTOCOL_VERSION,
+                          V1_MAX_FILE_SIZE)
 
+# Constants
+DEFAULT_HOST = "localhost"
 DEFAULT_PORT = 1337
-HELLO_CHECK = b"Successfully connected to server!"
-SOCKET_BUFFER_SIZE = 1024
+DEFAULT_TRANSFER_BUFFER_SIZE = 256 * 1024
+
+# Optional protocol version 2 features to ask the server for during HELO
+SUPPORTED_FEATURES = ["resume", "range", "digest", "delta", "have", "batch", "mlsd", "stat", "resume-check"]
+
+# Delta uploads find the server's blocks in the local file with a rolling adler32 checksum
+ADLER_MODULUS = 65521
+# Looking for blocks costs a pass over the file a byte at a time. Once at least DELTA_PROBE_SIZE bytes have had to be
+# sent as literal data, and they are more than this fraction of what was looked through, the file has changed too much
+# for that to pay and the rest of it is sent as it is.
+DELTA_PROBE_SIZE = 256 * 1024
+DELTA_MAX_LITERAL_FRACTION = 0.5
+
+# MLSD asks for listings in pages of this many entries
+LIST_PAGE_SIZE = 1000
+
+# Segmented downloads never split a file into pieces smaller than this
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+# What an interrupted download received is kept under this suffix, so the download can be resumed
+PARTIAL_SUFFIX = ".part"
+# Downloads are written to a file of their own under this suffix, and only moved to the partial file once truncated to
+# what arrived, so a download killed part way through never leaves a partial file with a preallocated end of zeros
+TEMPORARY_SUFFIX = ".tmp"
 
 # Global variables
 VERBOSE_PRINT = False
-PORT = -1
-IS_CONNECTED = False
 
 
 def vprint(contents):
@@ -23,11 +57,124 @@ def vprint(contents):
         print(contents)
 
 
-class FTPClient:
+def preallocate(binary_file, size):
+    """
+    Reserves disk space for a file up front so it is written without fragmenting, and a full disk fails before the
+    transfer starts rather than halfway through.
+    :param binary_file: A file opened for binary writing
+    :param size: The final size of the file in bytes
+    """
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(binary_file.fileno(), 0, size)
+            return
+        except OSError as e:
+            # Some filesystems don't support it, fall through and just set the length
+            vprint("posix_fallocate failed: {}".format(e))
+    binary_file.truncate(size)
+
+
+def roll_adler32(a, b, out_byte, in_byte, window_size):
+    """
+    Moves the adler32 checksum of a window of bytes on by one byte, without going over the rest of the window again.
+    :param a: The low half of the checksum, one more than the sum of the window's bytes
+    :param b: The high half of the checksum
+    :param out_byte: The byte leaving the start of the window
+    :param in_byte: The byte joining the end of the window
+    :param window_size: The size of the window
+    :return: The halves of the checksum of the window one byte on, as (a, b)
+    """
+    a = (a - out_byte + in_byte) % ADLER_MODULUS
+    b = (b - window_size * out_byte + a - 1) % ADLER_MODULUS
+    return a, b
+
+
+def digest_prefix(binary_file, length):
+    """
+    Hashes the start of a file, for the resume-check feature.
+    :param binary_file: A file opened for binary reading
+    :param length: The number of bytes to hash
+    :return: The digest as bytes
+    """
+    digest = hashlib.new(DIGEST_ALGORITHM)
+    binary_file.seek(0)
+    while length > 0:
+        data = binary_file.read(min(length, DEFAULT_TRANSFER_BUFFER_SIZE))
+        if not data:
+            break
+        digest.update(data)
+        length -= len(data)
+    return digest.digest()
+
+
+def resume_key(path):
+    """
+    Names a local file for the resume-check feature, so the server keeps an interrupted upload of it apart from uploads
+    of the same name from other files and machines.
+    :param path: The path of the local file
+    :return: The key as a string
+    """
+    location = socket.gethostname() + "\0" + os.path.abspath(path)
+    return hashlib.sha256(location.encode("utf-8", "surrogateescape")).hexdigest()[:32]
+
+
+def writing_path(partial_name):
+    """
+    Gets the path this thread writes a download to before it becomes the partial file.
+    :param partial_name: The path of the partial file
+    """
+    return "{}.{}.{}{}".format(partial_name, os.getpid(), threading.get_ident(), TEMPORARY_SUFFIX)
+
+
+class ServerBusyError(ConnectionError):
+    """
+    Raised when the server turns a new session away because it is at its limits. Trying again later may succeed.
+    """
+
+
+def format_throughput(byte_count, seconds):
+    """
+    Formats a transfer rate for display, e.g. "12.3 MB/s".
+    """
+    if seconds <= 0:
+        return "n/a MB/s"
+    return "{:,.1f} MB/s".format(byte_count / seconds / 1000000)
+
 
-    def __init__(self):
+class FTPClient:
+    """
+    A client for one server. Scripts can use it as a library through connect(), upload(), download(), list(), delete()
+    and close(), which reuse one session for every call and never prompt, and any number of clients can be used at
+    once. The menu drives the same session interactively.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_TRANSFER_BUFFER_SIZE, segments=1, compression=None, use_delta=True,
+                 host=DEFAULT_HOST, port=DEFAULT_PORT, quiet=False):
         vprint("FTPClient() constructor called")
+        self.host = host
+        self.port = port
+        # Whether progress messages for transfers are left out, as scripts usually want
+        self.quiet = quiet
         self.sock = None
+        self.is_connected = False
+        self.protocol_version = 1
+        self.features = set()
+        self.segments = segments
+        self.compression = compression
+        self.codec = None
+        self.use_delta = use_delta
+
+        # Reused for every download so memory stays bounded whatever the file size
+        self.transfer_buffer = memoryview(bytearray(buffer_size))
+
+    def report(self, message):
+        """
+        Prints a progress or error message for a transfer, unless the client is quiet.
+        """
+        if not self.quiet:
+            print(message)
 
     def send_command(self, command):
         """
@@ -40,105 +187,203 @@ class FTPClient:
 
     def send_data(self, data, data_length_size="long"):
         """
-        Sends variable-length data to the server.
-        :param data: The data to send, as bytes
-        :param data_length_size: Either "long" or "short" to specify whether the data length is given as 4 or 2 bytes
+        Sends variable-length data to the server, prefixed with its length.
+        :param data: The data to send, as bytes or str
+        :param data_length_size: Either "short", "long" or "quad" to specify whether the data length is given as 2, 4
+                                 or 8 bytes
         """
-        if data_length_size == "long":
-            bytes_length = 4
-        elif data_length_size == "short":
-            bytes_length = 2
-        else:
-            vprint("Invalid data_length_size parameter: {}".format(data_length_size))
-            return
-
-        # Convert the data to bytes if necessary
-        if type(data) != bytes:
-            data = bytes(data, "utf-8")
-
-        # Calculate the length of the data to send
-        data_length = len(data).to_bytes(bytes_length, "big", signed=True)
-        vprint("data_length = {}".format(data_length))
-
-        # Send the data length
-        self.sock.sendall(data_length)
+        ftp_protocol.send_frame(self.sock, data, data_length_size)
 
-        # Send the data
-        self.sock.sendall(data)
+    def send_data_number(self, number, data_length_size):
+        """
+        Sends a number to the server on its own, e.g. a file size.
+        :param number: The number to send
+        :param data_length_size: Either "short", "long" or "quad" to specify whether the number is given as 2, 4 or 8
+                                 bytes
+        """
+        ftp_protocol.send_number(self.sock, number, data_length_size)
 
-    def receive_data(self, variable_length_response=True, data_length_size="long", receive_length_specific=None):
+    def receive_data(self, variable_length_response=True, data_length_size="long"):
         """
         Receive data from the server, either of fixed or variable length.
-        :param variable_length_response: Whether the response is of variable length or fixed (4 bytes)
-        :param data_length_size: Either "long" or "short" to specify whether the data length is given as 4 or 2 bytes
-        :param receive_length_specific: If we already know exactly how much data to receive
+        :param variable_length_response: Whether the data is prefixed with its length, or is a number of the given size
+        :param data_length_size: Either "short", "long" or "quad" to specify whether the data length is given as 2, 4
+                                 or 8 bytes
         :return: The response data from the server
         """
-        if data_length_size == "long":
-            receive_length = 4
-        elif data_length_size == "short":
-            receive_length = 2
-        elif data_length_size == "none":
-            receive_length = 0
-        else:
-            vprint("Invalid data_length_size parameter: {}".format(data_length_size))
-            return b""
         if variable_length_response:
-            # If we already know how many bytes to receive, just use `receive_length_specific` as the response length
-            if receive_length != 0:
-                response_length = int.from_bytes(self.sock.recv(receive_length), "big", signed=True)
+            return ftp_protocol.receive_frame(self.sock, data_length_size)
+        return self.receive_exactly(ftp_protocol.DATA_LENGTH_SIZES[data_length_size])
+
+    def receive_data_number(self, data_length_size):
+        """
+        Receives a number from the server, the counterpart of send_data_number.
+        :param data_length_size: Either "short", "long" or "quad" to specify whether the number is given as 2, 4 or 8
+                                 bytes
+        :return: The number as an int
+        """
+        return ftp_protocol.receive_number(self.sock, data_length_size)
+
+    def receive_exactly(self, length):
+        """
+        Receives exactly the given number of bytes, looping over short reads.
+        :param length: The number of bytes to receive
+        :return: The data as bytes
+        """
+        return ftp_protocol.receive_exactly(self.sock, length)
+
+    def receive_into_file(self, binary_file, length, digest=None):
+        """
+        Streams the given number of bytes from the server straight into a file through the transfer buffer.
+        :param binary_file: A file opened for binary writing
+        :param length: The number of bytes to receive
+        :param digest: A hashlib object to update with the bytes received, or None
+        """
+        buffer_size = len(self.transfer_buffer)
+        remaining = length
+        while remaining > 0:
+            received = self.sock.recv_into(self.transfer_buffer, min(remaining, buffer_size))
+            if received == 0:
+                raise ConnectionError("Connection closed with {:,} of {:,} bytes still to receive".format(remaining,
+                                                                                                         length))
+            binary_file.write(self.transfer_buffer[:received])
+            if digest is not None:
+                digest.update(self.transfer_buffer[:received])
+            remaining -= received
+
+    def receive_chunks_into_file(self, binary_file, digest=None):
+        """
+        Streams protocol version 2 chunks into a file until the empty chunk that ends them.
+        :param binary_file: A file opened for binary writing
+        :param digest: A hashlib object to update with the (decompressed) bytes received, or None
+        :return: The total number of bytes received
+        """
+        amount_received = 0
+        while True:
+            flags, chunk_length = CHUNK_HEADER.unpack(self.receive_exactly(CHUNK_HEADER.size))
+            if chunk_length == 0:
+                return amount_received
+            if flags == CHUNK_FLAGS_NONE:
+                self.receive_into_file(binary_file, chunk_length, digest)
+                amount_received += chunk_length
+            elif flags == CHUNK_FLAGS_COMPRESSED and self.codec is not None:
+                chunk = ftp_protocol.receive_compressed_chunk(self.sock, self.codec, chunk_length)
+                binary_file.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                amount_received += len(chunk)
             else:
-                response_length = receive_length_specific
-            vprint("response_length = {}".format(response_length))
-
-            # Loop through and receive the response in chunks
-            amount_received = 0
-            response = b""
-
-            vprint("Will read {:,} bytes {:,} times".format(SOCKET_BUFFER_SIZE, response_length // SOCKET_BUFFER_SIZE))
-            for i in range(response_length // SOCKET_BUFFER_SIZE):
-                data = self.sock.recv(SOCKET_BUFFER_SIZE)
-                amount_received += len(data)
-                response += data
-            vprint("Will now read final {:,} bytes".format(response_length % SOCKET_BUFFER_SIZE))
-            data = self.sock.recv(response_length % SOCKET_BUFFER_SIZE)
-            amount_received += len(data)
-            response += data
-
-            vprint("(response_length = {:,}, amount_received = {:,}, len(response) = {:,})".format(response_length,
-                                                                                                   amount_received,
-                                                                                                   len(response)))
-        else:
-            response = self.sock.recv(receive_length)
-        return response
+                raise ConnectionAbortedError("Received chunk with unsupported flags {:#x}".format(flags))
+
+    def send_file_contents(self, binary_file, length, chunked, digest=None):
+        """
+        Streams the given number of bytes from a file to the server through the transfer buffer.
+        :param binary_file: A file opened for binary reading
+        :param length: The number of bytes to send
+        :param chunked: Whether to frame the contents as protocol version 2 chunks, ended by an empty chunk
+        :param digest: A hashlib object to update with the bytes sent, or None
+        """
+        buffer_size = len(self.transfer_buffer)
+        compress = CODECS[self.codec][0] if chunked and self.codec is not None else None
+        if compress is not None:
+            buffer_size = min(buffer_size, MAX_COMPRESSED_CHUNK_SIZE)
+        amount_sent = 0
+        while amount_sent < length:
+            amount_read = binary_file.readinto(self.transfer_buffer[:min(length - amount_sent, buffer_size)])
+            if not amount_read:
+                raise ConnectionAbortedError("File was truncated after {:,} of {:,} bytes".format(amount_sent, length))
+            chunk = self.transfer_buffer[:amount_read]
+            if digest is not None:
+                digest.update(chunk)
+            if compress is not None:
+                compressed_chunk = compress(chunk)
+                if amount_sent == 0 and len(compressed_chunk) > amount_read * COMPRESSION_SKIP_RATIO:
+                    vprint("First chunk only compressed to {:,} of {:,} bytes, sending the rest uncompressed".format(
+                        len(compressed_chunk), amount_read))
+                    compress = None
+                if len(compressed_chunk) < amount_read:
+                    ftp_protocol.send_parts(self.sock, [
+                        CHUNK_HEADER.pack(CHUNK_FLAGS_COMPRESSED, len(compressed_chunk)), compressed_chunk])
+                    amount_sent += amount_read
+                    continue
+            if chunked:
+                ftp_protocol.send_parts(self.sock, [CHUNK_HEADER.pack(CHUNK_FLAGS_NONE, amount_read), chunk])
+            else:
+                self.sock.sendall(chunk)
+            amount_sent += amount_read
+        if chunked:
+            self.sock.sendall(CHUNK_HEADER.pack(CHUNK_FLAGS_NONE, 0))
 
     def make_connection(self):
         """
         Makes a connection to the server by sending a short hello message and checking the response is the same.
         """
-        global IS_CONNECTED
-        vprint("IS_CONNECTED = {}".format(IS_CONNECTED))
+        vprint("is_connected = {}".format(self.is_connected))
 
+        if not self.is_connected:
+            try:
+                connected = self.open_session()
+            except ServerBusyError as e:
+                print("Error: {}.".format(e))
+                return
+            if connected:
+                print("Successfully connected to server.")
+                self.is_connected = True
+        else:
+            print("Already connected to server.")
+
+    def open_session(self):
+        """
+        Connects a new socket to the server and says HELO, negotiating the protocol version and features to use.
+        :return: Whether the server answered the HELO correctly, raises ServerBusyError if it turned the session away
+        """
         # Connect the socket to the port where the server is listening
         # Create a TCP/IP socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_address = ("localhost", PORT)
-        vprint("Connecting to server on port {}".format(PORT))
+        server_address = (self.host, self.port)
+        vprint("Connecting to server on port {}".format(self.port))
         self.sock.connect(server_address)
-
-        if not IS_CONNECTED:
+        ftp_protocol.configure_socket(self.sock)
+
+        self.send_command(b"HELO")
+        vprint("Made initial connection to server on port " + str(self.port) + "...")
+        # Ask for the newest protocol version we speak, the server answers with the version it will use
+        options = {"version": PROTOCOL_VERSION, "features": SUPPORTED_FEATURES}
+        if self.compression is not None:
+            options["codecs"] = [self.compression]
+        options = json.dumps(options).encode("utf-8")
+        self.send_data(HELLO_CHECK + HELLO_OPTIONS_SEPARATOR + options)
+        response = self.receive_data(variable_length_response=True)
+        if response == HELLO_BUSY:
+            self.sock.close()
+            raise ServerBusyError("Server at {}:{} is busy, try again later".format(self.host, self.port))
+        if response == b"MISMATCH":
+            # Servers that predate protocol negotiation reject the options, so say hello again without them
+            vprint("Server does not support protocol negotiation, retrying HELO.")
             self.send_command(b"HELO")
-            vprint("Made initial connection to server on port " + str(PORT) + "...")
             self.send_data(HELLO_CHECK)
             response = self.receive_data(variable_length_response=True)
-            if response != HELLO_CHECK:
-                vprint("HELLO_CHECK mismatch! Expected '{}' but got '{}'.".format(HELLO_CHECK, response))
-            else:
-                vprint("HELO matched correctly.")
-                print("Successfully connected to server.")
-                IS_CONNECTED = True
-        else:
-            print("Already connected to server.")
+
+        hello_check, separator, accepted_options = response.partition(HELLO_OPTIONS_SEPARATOR)
+        if hello_check != HELLO_CHECK:
+            vprint("HELLO_CHECK mismatch! Expected '{}' but got '{}'.".format(HELLO_CHECK, response))
+            return False
+        accepted_options = json.loads(accepted_options.decode("utf-8")) if separator else {}
+        self.protocol_version = accepted_options.get("version", 1)
+        self.features = set(accepted_options.get("features", []))
+        self.codec = accepted_options.get("codec")
+        vprint("HELO matched correctly, using protocol version {} with features {} and codec {}.".format(
+            self.protocol_version, sorted(self.features), self.codec))
+        return True
+
+    def close_session(self):
+        """
+        Says QUIT and closes a session opened with open_session, without touching the menu's connection state.
+        """
+        try:
+            self.send_command("QUIT")
+        finally:
+            self.sock.close()
 
     def close_connection(self):
         """
@@ -147,31 +392,176 @@ class FTPClient:
         """
         vprint("Closing socket...")
         self.sock.close()
-        global IS_CONNECTED
-        IS_CONNECTED = False
+        self.is_connected = False
         vprint("Connection closed.")
 
+    def connect(self):
+        """
+        Opens the session the library methods use, if it isn't open already.
+        """
+        if self.is_connected:
+            return
+        try:
+            opened = self.open_session()
+        except BaseException:
+            self.sock.close()
+            raise
+        if not opened:
+            self.sock.close()
+            raise ConnectionError("Server at {}:{} did not answer HELO correctly".format(self.host, self.port))
+        self.is_connected = True
+
+    def reset(self):
+        """
+        Drops the session without saying QUIT, so the next call opens a new one. The library methods do this when a
+        call fails part way through, as the session may then be out of step with the server.
+        """
+        self.is_connected = False
+        if self.sock is not None:
+            self.sock.close()
+
+    def close(self):
+        """
+        Says QUIT and closes the session, if it is open.
+        """
+        if self.is_connected:
+            self.is_connected = False
+            self.close_session()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def upload(self, path, name=None):
+        """
+        Uploads a local file.
+        :param path: The path of the local file
+        :param name: The name to store it under on the server, by default the file's own name
+        """
+        self.connect()
+        if not os.path.isfile(path):
+            raise FileNotFoundError("No local file {}".format(path))
+        if name is None:
+            name = os.path.basename(path)
+        try:
+            uploaded = self.put_file(name, path)
+        except BaseException:
+            self.reset()
+            raise
+        if not uploaded:
+            raise ConnectionError("Upload of {} failed".format(name))
+
+    def download(self, name, dest=None):
+        """
+        Downloads a file from the server.
+        :param name: The name of the file on the server
+        :param dest: The local path to write it to, or a directory to write it into, by default the working directory
+        :return: The local path it was written to
+        """
+        self.connect()
+        if dest is None:
+            dest = os.path.basename(name)
+        elif os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(name))
+        try:
+            if self.segments > 1 and "range" in self.features:
+                downloaded = self.fetch_file_segmented(name, self.segments, dest)
+            else:
+                downloaded = self.fetch_file(name, dest)
+        except BaseException:
+            self.reset()
+            raise
+        if downloaded is None:
+            raise FileNotFoundError("No file {} on the server".format(name))
+        if not downloaded:
+            raise ConnectionError("Download of {} failed".format(name))
+        return dest
+
+    def list(self):
+        """
+        Lists the files on the server.
+        :return: The names of the files, sorted
+        """
+        self.connect()
+        try:
+            self.send_command("LIST")
+            return json.loads(self.receive_data(data_length_size="long").decode("utf-8"))
+        except BaseException:
+            self.reset()
+            raise
+
+    def delete(self, name):
+        """
+        Deletes a file from the server.
+        :param name: The name of the file on the server
+        """
+        self.connect()
+        try:
+            self.send_command("DELF")
+            self.send_data(name, "short")
+            found = self.receive_data_number("long") == 1
+            if found:
+                # DELF asks to confirm a delete, the caller already has
+                self.send_data("Y", "long")
+        except BaseException:
+            self.reset()
+            raise
+        if not found:
+            raise FileNotFoundError("No file {} on the server".format(name))
+
     def upload_file(self):
         """
         Uploads a file to the server.
         """
-        if not IS_CONNECTED:
+        if not self.is_connected:
             print("Error: You are not connected to the server. Use CONN command first.")
             return
 
         file_name = input("Enter the name of the local file to upload: ")
         vprint("User wanted to upload '{}'".format(file_name))
+        self.put_file(file_name)
+
+    def put_file(self, file_name, local_path=None):
+        """
+        Uploads a file to the server over this session.
+        :param file_name: The name to store the file under on the server
+        :param local_path: The path of the local file, by default file_name
+        :return: Whether the upload succeeded
+        """
+        if local_path is None:
+            local_path = file_name
         try:
-            with open(file_name, "rb") as binary_file:
-                # Read the whole file at once
-                file_contents = binary_file.read()
-                vprint("len(file_contents) = {:,}".format(len(file_contents)))
+            binary_file = open(local_path, "rb")
+        except FileNotFoundError as e:
+            vprint(e)
+            self.report("Error: File '{}' not found.".format(local_path))
+            return False
+
+        with binary_file:
+            file_size = os.fstat(binary_file.fileno()).st_size
+            vprint("file_size = {:,}".format(file_size))
+            if self.protocol_version < 2 and file_size > V1_MAX_FILE_SIZE:
+                self.report("Error: '{}' is too large for this server, which only supports files under 2 GiB.".format(
+                    file_name))
+                return False
+
+            if "have" in self.features and self.offer_contents(file_name, binary_file, file_size):
+                return True
+            if self.use_delta and "delta" in self.features:
+                uploaded = self.upload_delta(file_name, binary_file, file_size)
+                if uploaded is not None:
+                    return uploaded
 
             # Send the command and file name
             vprint("Sending UPLD command")
             self.send_command("UPLD")
             vprint("Sending file name")
             self.send_data(file_name, "short")
+            if "resume-check" in self.features:
+                self.send_data(resume_key(local_path), "short")
 
             # Get the acknowledgement
             vprint("Receiving acknowledgement")
@@ -181,88 +571,699 @@ class FTPClient:
             # Check server is ready
             if response != "READY FOR UPLOAD":
                 # Handle the non-ready state appropriately, just inform the user and tell them to try upload again
-                print("Error: Server was not ready for upload. Try again.")
+                self.report("Error: Server was not ready for upload. Try again.")
                 vprint("Acknowledgement = {}".format(response))
-                return
+                return False
             else:
-                # Upload the file_contents
-                print("Uploading {}...".format(file_name))
-                self.send_data(file_contents, "long")
+                # Upload the file contents straight from disk
+                if "resume" in self.features:
+                    # The server tells us how much of an interrupted upload it holds, carry on from there if it can
+                    # still be part of this file
+                    partial_size = self.receive_data_number("quad")
+                    offset = partial_size if partial_size <= file_size else 0
+                    if "resume-check" in self.features:
+                        # The server's digest of what it holds, which must match the start of the file as it is now
+                        prefix_digest = self.receive_data(data_length_size="short")
+                        if offset > 0 and prefix_digest != digest_prefix(binary_file, offset):
+                            vprint("The server's first {:,} bytes of {} differ from ours".format(offset, file_name))
+                            offset = 0
+                else:
+                    offset = 0
+
+                if offset > 0:
+                    self.report("Resuming upload of {} from byte {:,}...".format(file_name, offset))
+                else:
+                    self.report("Uploading {}...".format(file_name))
+                if self.protocol_version >= 2:
+                    self.send_data_number(file_size, "quad")
+                    if "resume" in self.features:
+                        self.send_data_number(offset, "quad")
+                    binary_file.seek(offset)
+                    digest = hashlib.new(DIGEST_ALGORITHM) if "digest" in self.features else None
+                    self.send_file_contents(binary_file, file_size - offset, chunked=True, digest=digest)
+                    if digest is not None:
+                        # Let the server check what it received against what was sent
+                        self.send_data(digest.digest(), "short")
+                else:
+                    self.send_data_number(file_size, "long")
+                    self.send_file_contents(binary_file, file_size, chunked=False)
 
                 # Get the transfer process results
                 response = self.receive_data().decode("utf-8")
 
                 if response[:9+len(file_name)] == "Received " + file_name:
                     # Response is effectively the results
-                    print(response.replace("Received", "Successfully uploaded"))
+                    self.report(response.replace("Received", "Successfully uploaded"))
+                    return True
+                # Something went wrong
+                self.report("Error during upload: {}".format(response))
+                return False
+
+    def offer_contents(self, file_name, binary_file, file_size):
+        """
+        Asks the server whether it already stores the contents of a file, using the HAVE command. If it does, it stores
+        them under the file's name and nothing needs to be uploaded.
+        :param file_name: The name of the file
+        :param binary_file: The file, opened for binary reading, which is left at its start
+        :param file_size: The size of the file in bytes
+        :return: Whether the server had the contents, so the upload is already done
+        """
+        digest = hashlib.new(DIGEST_ALGORITHM)
+        while True:
+            amount_read = binary_file.readinto(self.transfer_buffer)
+            if not amount_read:
+                break
+            digest.update(self.transfer_buffer[:amount_read])
+        binary_file.seek(0)
+
+        # Send the command, file name, size and digest
+        vprint("Sending HAVE command")
+        self.send_command("HAVE")
+        vprint("Sending file name")
+        self.send_data(file_name, "short")
+        self.send_data_number(file_size, "quad")
+        self.send_data(digest.digest(), "short")
+
+        held = self.receive_data_number("long")
+        vprint("Server holds the contents of '{}': {}".format(file_name, held == 1))
+        if held != 1:
+            return False
+        self.report("Successfully uploaded {} ({:,} bytes), the server already had its contents.".format(
+            file_name, file_size))
+        return True
+
+    def upload_delta(self, file_name, binary_file, file_size):
+        """
+        Uploads a file as changes to the copy already on the server, using the DUPL command.
+        :param file_name: The name of the file
+        :param binary_file: The file, opened for binary reading
+        :param file_size: The size of the file in bytes
+        :return: Whether the upload succeeded, or None if the server has no copy to build on, in which case the file
+                 should be uploaded in full
+        """
+        # Send the command, file name and file size
+        vprint("Sending DUPL command")
+        self.send_command("DUPL")
+        vprint("Sending file name")
+        self.send_data(file_name, "short")
+        self.send_data_number(file_size, "quad")
+
+        # Get the signatures of the server's copy
+        basis_size = self.receive_data_number("quad")
+        if basis_size == -1:
+            vprint("Server has no copy of '{}' to update".format(file_name))
+            return None
+        block_size = self.receive_data_number("long")
+        blocks = {}
+        for index, (weak, strong) in enumerate(DELTA_SIGNATURE.iter_unpack(self.receive_data(data_length_size="long"))):
+            blocks.setdefault(weak, []).append((strong, index))
+        vprint("Server holds {:,} bytes of '{}' in blocks of {:,} bytes".format(basis_size, file_name, block_size))
+
+        # Send the changes, then the digest of the whole file so the server can check what it rebuilt
+        self.report("Uploading changes to {}...".format(file_name))
+        digest = hashlib.new(DIGEST_ALGORITHM)
+        self.send_delta(binary_file, block_size, blocks, digest)
+        self.send_data(digest.digest(), "short")
+
+        # Get the transfer process results
+        response = self.receive_data().decode("utf-8")
+
+        if response[:9+len(file_name)] == "Received " + file_name:
+            # Response is effectively the results
+            self.report(response.replace("Received", "Successfully uploaded"))
+            return True
+        # Something went wrong
+        self.report("Error during upload: {}".format(response))
+        return False
+
+    def send_delta(self, binary_file, block_size, blocks, digest):
+        """
+        Streams a file to the server as chunks of literal data and references to blocks of the server's copy, ended by
+        an empty chunk. The weak checksum rolls along the file a byte at a time, so blocks are found at any offset and
+        data inserted or removed before a block doesn't stop it matching. A file that turns out to have changed too
+        much is sent as it is from then on, see DELTA_MAX_LITERAL_FRACTION.
+        :param binary_file: A file opened for binary reading
+        :param block_size: The size of the server's blocks
+        :param blocks: The server's blocks, as a dict of weak checksum to a list of (strong digest, index) pairs
+        :param digest: A hashlib object to update with the whole file
+        """
+        max_literal_size = len(self.transfer_buffer)
+        data = bytearray()
+        literal_start = 0
+        literal_size = 0
+        matched_size = 0
+        position = 0
+        at_end = False
+        have_checksum = False
+        while True:
+            if not at_end and len(data) - position <= block_size:
+                # Keep the window and the byte after it in memory, dropping what has already been sent
+                del data[:literal_start]
+                position -= literal_start
+                literal_start = 0
+                more = binary_file.read(max(block_size, max_literal_size))
+                if more:
+                    digest.update(more)
+                    data += more
                 else:
-                    # Something went wrong
-                    print("Error during upload: {}".format(response))
-        except FileNotFoundError as e:
-            vprint(e)
-            print("Error: File '{}' not found.".format(file_name))
+                    at_end = True
+                continue
+
+            window_size = min(block_size, len(data) - position)
+            if window_size == 0:
+                break
+            if not have_checksum:
+                checksum = zlib.adler32(data[position:position + window_size])
+                a, b = checksum & 0xffff, checksum >> 16
+                have_checksum = True
+
+            candidates = blocks.get((b << 16) | a)
+            if candidates:
+                window = data[position:position + window_size]
+                strong = hashlib.blake2b(window, digest_size=DELTA_STRONG_DIGEST_SIZE).digest()
+                index = next((index for block_strong, index in candidates if block_strong == strong), None)
+                if index is not None:
+                    self.send_literal(data[literal_start:position])
+                    self.sock.sendall(CHUNK_HEADER.pack(CHUNK_FLAGS_BLOCK, index))
+                    literal_size += position - literal_start
+                    matched_size += window_size
+                    position += window_size
+                    literal_start = position
+                    have_checksum = False
+                    continue
+
+            if position + window_size == len(data):
+                # Nothing left to roll the window onto
+                break
+            # Roll the window on by one byte
+            a, b = roll_adler32(a, b, data[position], data[position + window_size], window_size)
+            position += 1
+            if position - literal_start >= max_literal_size:
+                self.send_literal(data[literal_start:position])
+                literal_size += position - literal_start
+                literal_start = position
+                if (literal_size >= DELTA_PROBE_SIZE and
+                        literal_size > DELTA_MAX_LITERAL_FRACTION * (literal_size + matched_size)):
+                    vprint("Found only {:,} bytes of the server's blocks in {:,}, sending the rest as it is".format(
+                        matched_size, literal_size + matched_size))
+                    self.send_literal(data[literal_start:])
+                    literal_start = len(data)
+                    while not at_end:
+                        more = binary_file.read(max_literal_size)
+                        if more:
+                            digest.update(more)
+                            self.send_literal(more)
+                        else:
+                            at_end = True
+                    break
+
+        self.send_literal(data[literal_start:])
+        self.sock.sendall(CHUNK_HEADER.pack(CHUNK_FLAGS_NONE, 0))
+
+    def send_literal(self, literal):
+        """
+        Sends literal data for a delta upload as a single chunk, if there is any.
+        :param literal: The bytes to send
+        """
+        if literal:
+            ftp_protocol.send_parts(self.sock, [CHUNK_HEADER.pack(CHUNK_FLAGS_NONE, len(literal)), literal])
 
     def download_file(self):
         """
         Downloads a file from the server.
         :return:
         """
-        if not IS_CONNECTED:
+        if not self.is_connected:
             print("Error: You are not connected to the server. Use CONN command first.")
             return
 
         file_name = input("Enter the name of the remote file to download: ")
         vprint("User wanted to download '{}'".format(file_name))
 
+        if self.segments > 1 and "range" in self.features:
+            self.fetch_file_segmented(file_name, self.segments)
+        else:
+            self.fetch_file(file_name)
+
+    def fetch_file(self, file_name, local_path=None):
+        """
+        Downloads a file from the server over this session.
+        :param file_name: The name of the remote file
+        :param local_path: The path to write the local copy to, by default file_name
+        :return: Whether the download succeeded, or None if the file does not exist on the server
+        """
         # Start the timer
         t0 = time.time()
 
-        # Send the command and file name
+        # Send the command and request
         vprint("Sending DWLD command")
         self.send_command("DWLD")
+        self.send_download_request(file_name, local_path)
+        return self.receive_download(file_name, t0, local_path)
+
+    def send_download_request(self, file_name, local_path=None):
+        """
+        Sends the body of a DWLD request for a whole file, asking to resume an earlier interrupted attempt if possible.
+        :param file_name: The name of the remote file
+        :param local_path: The path the local copy is written to, by default file_name
+        """
+        partial_name = (local_path if local_path is not None else file_name) + PARTIAL_SUFFIX
+        partial_size = 0
+        prefix_digest = b""
+        if "resume" in self.features and os.path.isfile(partial_name):
+            with open(partial_name, "rb") as partial_file:
+                partial_size = os.fstat(partial_file.fileno()).st_size
+                if "resume-check" in self.features and partial_size > 0:
+                    # Let the server check that what we hold is still the start of its file
+                    prefix_digest = digest_prefix(partial_file, partial_size)
+
         vprint("Sending file name")
         self.send_data(file_name, "short")
+        if "resume" in self.features or "range" in self.features:
+            self.send_data_number(partial_size, "quad")
+        if "range" in self.features:
+            # The rest of the file
+            self.send_data_number(-1, "quad")
+        if "resume-check" in self.features:
+            self.send_data(prefix_digest, "short")
+
+    def receive_download(self, file_name, t0, local_path=None):
+        """
+        Receives the reply to a DWLD request, writing the contents to a file of its own that is renamed once complete,
+        or kept as the partial file if the download is interrupted.
+        :param file_name: The name of the remote file
+        :param t0: The time the download started
+        :param local_path: The path to write the local copy to, by default file_name
+        :return: Whether the download succeeded, or None if the file does not exist on the server
+        """
+        if local_path is None:
+            local_path = file_name
+        # With resume an earlier interrupted attempt kept in the partial file is carried on
+        partial_name = local_path + PARTIAL_SUFFIX
+        writing_name = writing_path(partial_name)
 
         # Getting file status (file size or -1 if remote file does not exist)
-        file_size_raw = self.receive_data(variable_length_response=False, data_length_size="long")
-        file_size = int.from_bytes(file_size_raw, "big", signed=True)
+        file_size = self.receive_data_number("quad" if self.protocol_version >= 2 else "long")
         vprint("File 'size' of '{}' is: {:,}".format(file_name, file_size))
 
         if file_size == -1:
             # File does not exist
-            print("The file does not exist on server")
-            return
+            self.report("The file does not exist on server")
+            return None
         else:
-            # File does exist
-            file_contents = self.receive_data(variable_length_response=True,
-                                              data_length_size="none",
-                                              receive_length_specific=file_size)
-            vprint("File contents = {}".format(file_contents))
-
-            # Write the results to file
-            with open(file_name, "wb") as binary_file:
-                binary_file.write(file_contents)
+            # File does exist, the server says where it is starting from if we asked to resume
+            offset = 0
+            if "resume" in self.features or "range" in self.features:
+                offset = self.receive_data_number("quad")
+            if offset > 0:
+                self.report("Resuming download of {} from byte {:,}...".format(file_name, offset))
+
+            # Write the file to disk as it arrives
+            digest = hashlib.new(DIGEST_ALGORITHM) if "digest" in self.features else None
+            if offset > 0:
+                os.replace(partial_name, writing_name)
+            with open(writing_name, "r+b" if offset > 0 else "wb") as binary_file:
+                try:
+                    binary_file.truncate(offset)
+                    binary_file.seek(offset)
+                    preallocate(binary_file, file_size)
+                    if self.protocol_version >= 2:
+                        amount_received = offset + self.receive_chunks_into_file(binary_file, digest)
+                        if amount_received != file_size:
+                            raise ConnectionAbortedError("Expected {:,} bytes but received {:,}".format(
+                                file_size, amount_received))
+                        if digest is not None:
+                            expected_digest = self.receive_data(data_length_size="short")
+                    else:
+                        self.receive_into_file(binary_file, file_size)
+                except BaseException:
+                    # Keep what did arrive for a later resume, but not the preallocated space after it. This runs for
+                    # KeyboardInterrupt too, only a process killed outright leaves the file where it was written.
+                    binary_file.truncate(binary_file.tell())
+                    binary_file.close()
+                    os.replace(writing_name, partial_name)
+                    raise
+            if digest is not None and digest.digest() != expected_digest:
+                # What arrived can't be trusted to resume from either
+                os.remove(writing_name)
+                self.report("Error: {} was corrupted in transit, its {} digest does not match.".format(
+                    file_name, DIGEST_ALGORITHM))
+                return False
+            os.replace(writing_name, local_path)
+            if offset == 0 and os.path.isfile(partial_name):
+                # An earlier attempt the server would not resume from is no use now
+                os.remove(partial_name)
 
             # Stop the timer
             t1 = time.time()
-            time_diff = round(t1 - t0, 3)
+            time_diff = t1 - t0
+
+            amount_transferred = file_size - offset
+            results = "Downloaded {} ({:,} bytes) in {:,} seconds ({}).".format(file_name, amount_transferred,
+                                                                                round(time_diff, 3),
+                                                                                format_throughput(amount_transferred,
+                                                                                                  time_diff))
+            self.report(results)
+            return True
+
+    def fetch_file_segmented(self, file_name, segments, local_path=None):
+        """
+        Downloads a file over several sessions at once, each fetching its own byte range straight into place in a
+        preallocated file. One session cannot fill a link with a high bandwidth-delay product, several together can.
+        :param file_name: The name of the remote file
+        :param segments: The number of sessions to use, including this one
+        :param local_path: The path to write the local copy to, by default file_name
+        :return: Whether the download succeeded, or None if the file does not exist on the server
+        """
+        if local_path is None:
+            local_path = file_name
+
+        # Start the timer
+        t0 = time.time()
+
+        file_size = self.request_range(file_name, None, 0, 0)
+        if file_size == -1:
+            self.report("The file does not exist on server")
+            return None
+        segments = min(segments, file_size // MIN_SEGMENT_SIZE)
+        if segments <= 1:
+            # Too small to be worth splitting
+            return self.fetch_file(file_name, local_path)
+        segment_size = -(-file_size // segments)
+        vprint("Downloading {:,} bytes of '{}' in {} segments of {:,} bytes".format(file_size, file_name, segments,
+                                                                                    segment_size))
+
+        # Segments arrive out of order, so the file has holes in it until every one is done and can never be resumed
+        # from. It is written to a file of its own, removed however the download fails.
+        writing_name = writing_path(local_path + PARTIAL_SUFFIX)
+
+        # This session fetches the first segment, every other segment gets a session of its own
+        sessions = [self]
+        errors = []
+        try:
+            for i in range(1, segments):
+                session = FTPClient(len(self.transfer_buffer), compression=self.compression, host=self.host,
+                                    port=self.port)
+                opened = session.open_session()
+                if opened:
+                    sessions.append(session)
+                if not opened or "range" not in session.features:
+                    raise ConnectionError("Could not open session {} of {} to the server".format(i + 1, segments))
+
+            with open(writing_name, "wb") as binary_file:
+                preallocate(binary_file, file_size)
+
+            def fetch_segment(session, offset):
+                try:
+                    with open(writing_name, "r+b") as segment_file:
+                        session.request_range(file_name, segment_file, offset, min(segment_size, file_size - offset))
+                except Exception as e:
+                    # Decompression and protocol errors fail the download just as connection errors do
+                    errors.append(e)
+
+            threads = [threading.Thread(target=fetch_segment, args=(session, i * segment_size))
+                       for i, session in enumerate(sessions)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+            os.replace(writing_name, local_path)
+        except BaseException:
+            if os.path.exists(writing_name):
+                os.remove(writing_name)
+            raise
+        finally:
+            for session in sessions[1:]:
+                try:
+                    session.close_session()
+                except OSError as e:
+                    vprint("Could not close a segment session: {}".format(e))
+
+        # Stop the timer
+        t1 = time.time()
+        time_diff = t1 - t0
+
+        results = "Downloaded {} ({:,} bytes) in {:,} seconds using {} segments ({}).".format(
+            file_name, file_size, round(time_diff, 3), segments, format_throughput(file_size, time_diff))
+        self.report(results)
+        return True
+
+    def request_range(self, file_name, binary_file, offset, length):
+        """
+        Downloads one byte range of a remote file into the same place in a local file.
+        :param file_name: The name of the remote file
+        :param binary_file: A file opened for binary writing, or None when length is 0
+        :param offset: The position in the file to start from
+        :param length: The number of bytes to fetch, 0 just to find out the file size
+        :return: The size of the whole remote file, or -1 if it does not exist
+        """
+        self.send_command("DWLD")
+        self.send_data(file_name, "short")
+        self.send_data_number(offset, "quad")
+        self.send_data_number(length, "quad")
+        if "resume-check" in self.features:
+            # The range is wanted whatever this client already holds
+            self.send_data(b"", "short")
+
+        file_size = self.receive_data_number("quad")
+        if file_size == -1:
+            return file_size
+        start = self.receive_data_number("quad")
+        if start != offset:
+            raise ConnectionAbortedError("Asked for {} from byte {:,} but the server started at byte {:,}".format(
+                file_name, offset, start))
+
+        if binary_file is not None:
+            binary_file.seek(offset)
+        digest = hashlib.new(DIGEST_ALGORITHM) if "digest" in self.features else None
+        amount_received = self.receive_chunks_into_file(binary_file, digest)
+        if amount_received != length:
+            raise ConnectionAbortedError("Expected {:,} bytes of {} but received {:,}".format(length, file_name,
+                                                                                             amount_received))
+        if digest is not None and self.receive_data(data_length_size="short") != digest.digest():
+            raise ConnectionAbortedError("Bytes {:,} to {:,} of {} were corrupted in transit".format(
+                offset, offset + length, file_name))
+        return file_size
+
+    def check_file(self):
+        """
+        Compares a local file with its copy on the server using the HASH command, without downloading it.
+        """
+        if not self.is_connected:
+            print("Error: You are not connected to the server. Use CONN command first.")
+            return
+        if "digest" not in self.features:
+            print("Error: The server does not support the HASH command.")
+            return
+
+        file_name = input("Enter the name of the file to check: ")
+        vprint("User wanted to check '{}'".format(file_name))
+
+        # Send the command and file name
+        vprint("Sending HASH command")
+        self.send_command("HASH")
+        vprint("Sending file name")
+        self.send_data(file_name, "short")
+
+        file_size = self.receive_data_number("quad")
+        if file_size == -1:
+            print("The file does not exist on the server.")
+            return
+        remote_digest = self.receive_data(data_length_size="short")
+        print("{} on the server: {:,} bytes, {} {}".format(file_name, file_size, DIGEST_ALGORITHM,
+                                                           remote_digest.hex()))
+
+        try:
+            binary_file = open(file_name, "rb")
+        except FileNotFoundError as e:
+            vprint(e)
+            print("There is no local copy of {} to compare with.".format(file_name))
+            return
+        with binary_file:
+            digest = hashlib.new(DIGEST_ALGORITHM)
+            while True:
+                amount_read = binary_file.readinto(self.transfer_buffer)
+                if not amount_read:
+                    break
+                digest.update(self.transfer_buffer[:amount_read])
+        if digest.digest() == remote_digest:
+            print("The local copy of {} matches the server's.".format(file_name))
+        else:
+            print("The local copy of {} differs from the server's.".format(file_name))
+
+    def pipeline(self, send_requests, receive_replies):
+        """
+        Sends requests from a second thread while this one reads the replies. The server answers each request as soon
+        as it has read it, so neither side may wait for the other to drain its socket before carrying on. If sending
+        fails, the session is dropped and the sender's exception is raised here.
+        :param send_requests: A function that sends the requests
+        :param receive_replies: A function that receives the replies
+        """
+        errors = []
+
+        def sender():
+            try:
+                send_requests()
+            except BaseException as e:
+                errors.append(e)
+                # The server is still waiting for the rest of the request, so stop the replies from waiting too
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        sender_thread = threading.Thread(target=sender, daemon=True)
+        sender_thread.start()
+        try:
+            receive_replies()
+        except BaseException:
+            sender_thread.join()
+            if errors:
+                self.reset()
+                raise errors[0]
+            raise
+        sender_thread.join()
+        if errors:
+            self.reset()
+            raise errors[0]
+
+    def download_files(self):
+        """
+        Downloads several files from the server.
+        """
+        if not self.is_connected:
+            print("Error: You are not connected to the server. Use CONN command first.")
+            return
+
+        file_names = shlex.split(input("Enter the names of the remote files to download: "))
+        vprint("User wanted to download {}".format(file_names))
+        if "batch" not in self.features:
+            for file_name in file_names:
+                self.fetch_file(file_name)
+            return
+
+        def send_requests():
+            vprint("Sending MGET command")
+            self.send_command("MGET")
+            self.send_data_number(len(file_names), "long")
+            for file_name in file_names:
+                self.send_download_request(file_name)
+
+        def receive_replies():
+            for file_name in file_names:
+                self.receive_download(file_name, time.time())
 
-            results = "Downloaded {} ({:,} bytes) in {:,} seconds.".format(file_name, len(file_contents), time_diff)
-            print(results)
+        self.pipeline(send_requests, receive_replies)
+
+    def upload_files(self):
+        """
+        Uploads several files to the server. Batched uploads are always sent whole, they are neither resumed nor sent
+        as changes.
+        """
+        if not self.is_connected:
+            print("Error: You are not connected to the server. Use CONN command first.")
+            return
+
+        file_names = shlex.split(input("Enter the names of the local files to upload: "))
+        vprint("User wanted to upload {}".format(file_names))
+        if "batch" not in self.features:
+            for file_name in file_names:
+                self.put_file(file_name)
+            return
+
+        # Leave out any file we can't send before the batch starts, the server is told how many files to expect
+        found_file_names = []
+        for file_name in file_names:
+            if not os.path.isfile(file_name):
+                print("Error: File '{}' not found.".format(file_name))
+            else:
+                found_file_names.append(file_name)
+
+        def send_requests():
+            vprint("Sending MPUT command")
+            self.send_command("MPUT")
+            self.send_data_number(len(found_file_names), "long")
+            for file_name in found_file_names:
+                with open(file_name, "rb") as binary_file:
+                    file_size = os.fstat(binary_file.fileno()).st_size
+                    self.send_data(file_name, "short")
+                    self.send_data_number(file_size, "quad")
+                    digest = hashlib.new(DIGEST_ALGORITHM) if "digest" in self.features else None
+                    self.send_file_contents(binary_file, file_size, chunked=True, digest=digest)
+                    if digest is not None:
+                        self.send_data(digest.digest(), "short")
+
+        def receive_replies():
+            for file_name in found_file_names:
+                response = self.receive_data().decode("utf-8")
+                if response[:9+len(file_name)] == "Received " + file_name:
+                    print(response.replace("Received", "Successfully uploaded"))
+                else:
+                    print("Error during upload: {}".format(response))
+
+        self.pipeline(send_requests, receive_replies)
+
+    def delete_files(self):
+        """
+        Deletes several files from the server, prompting the user for confirmation once for all of them.
+        """
+        if not self.is_connected:
+            print("Error: You are not connected to the server. Use CONN command first.")
+            return
+
+        file_names = shlex.split(input("Enter the names of the remote files to delete: "))
+        vprint("User wanted to delete {}".format(file_names))
+
+        # Ask the user for confirmation
+        confirmation = ""
+        while confirmation != "Y" and confirmation != "N":
+            confirmation = input("Are you sure you want to delete {:,} files? [Y/N]: ".format(len(file_names))).upper()
+        vprint("confirmation = {}".format(confirmation))
+        if confirmation == "N":
+            return
+
+        def send_requests():
+            vprint("Sending MDEL command")
+            self.send_command("MDEL")
+            self.send_data_number(len(file_names), "long")
+            for file_name in file_names:
+                self.send_data(file_name, "short")
+
+        def receive_replies():
+            for file_name in file_names:
+                file_exists_num = self.receive_data_number("long")
+                if file_exists_num == 1:
+                    print("Deleted {}.".format(file_name))
+                else:
+                    print("The file '{}' does not exist on the server.".format(file_name))
+
+        if "batch" in self.features:
+            self.pipeline(send_requests, receive_replies)
+            return
+
+        # Older servers ask for confirmation of each file in turn
+        for file_name in file_names:
+            self.send_command("DELF")
+            self.send_data(file_name, "short")
+            file_exists_num = self.receive_data_number("long")
+            if file_exists_num == 1:
+                self.send_data(confirmation, "long")
+                print("Deleted {}.".format(file_name))
+            else:
+                print("The file '{}' does not exist on the server.".format(file_name))
 
     def list_files(self):
         """
         Retrieves a list of files from the current working directory of the server.
         """
-        if not IS_CONNECTED:
+        if not self.is_connected:
             print("Error: You are not connected to the server. Use CONN command first.")
             return
 
-        # Send the command
-        self.send_command("LIST")
-
         # Receive the list of files
-        files = json.loads(self.receive_data(data_length_size="long").decode("utf-8"))
+        files = self.list()
 
         vprint("Received files list: {}".format(files))
 
@@ -270,11 +1271,104 @@ class FTPClient:
         for item in files:
             print(" - {}".format(item))
 
+    def list_files_detailed(self):
+        """
+        Lists the files on the server with their sizes and modification times, a page at a time.
+        """
+        if not self.is_connected:
+            print("Error: You are not connected to the server. Use CONN command first.")
+            return
+        if "mlsd" not in self.features:
+            print("Error: The server does not support the MLSD command.")
+            return
+
+        prefix = input("Enter the start of the names to list, or nothing for all files: ")
+        with_digests = ""
+        while with_digests != "Y" and with_digests != "N":
+            with_digests = input("Include {} digests? [Y/N]: ".format(DIGEST_ALGORITHM)).upper()
+        vprint("User wanted to list files starting with '{}', digests {}".format(prefix, with_digests))
+
+        print("\nFiles/folders in directory are:")
+        count = 0
+        for entry in self.iterate_files(prefix, with_digests == "Y"):
+            line = " - {}  {:,} bytes  modified {}".format(
+                entry["name"] + ("/" if entry["type"] == "dir" else ""), entry["size"],
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["mtime"])))
+            if "digest" in entry:
+                line += "  {}".format(entry["digest"])
+            print(line)
+            count += 1
+        print("{:,} found.".format(count))
+
+    def show_metrics(self):
+        """
+        Shows the server's metrics: how many times each command has been served and how long they took.
+        """
+        if not self.is_connected:
+            print("Error: You are not connected to the server. Use CONN command first.")
+            return
+        if "stat" not in self.features:
+            print("Error: The server does not support the STAT command.")
+            return
+
+        metrics = self.fetch_metrics()
+        print("\nServer up for {:,.0f} seconds, {:,} sessions ({:,} active), {:,} bytes received, "
+              "{:,} bytes sent".format(metrics["uptime"], metrics["sessions"]["opened"], metrics["sessions"]["active"],
+                                       metrics["bytes_received"], metrics["bytes_sent"]))
+        print("{:<6} {:>10} {:>8} {:>10} {:>10} {:>10}".format("", "count", "errors", "p50 (ms)", "p95 (ms)",
+                                                               "p99 (ms)"))
+        for command, command_metrics in sorted(metrics["commands"].items()):
+            latency = command_metrics["latency_ms"]
+            print("{:<6} {:>10,} {:>8,} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                command, command_metrics["count"], command_metrics["errors"], latency["p50"], latency["p95"],
+                latency["p99"]))
+        admission = metrics.get("admission")
+        if admission is not None:
+            print("Admission: {:,} sessions open, {:,} turned away at the session limit, {:,} for memory and {:,} with "
+                  "every worker busy".format(admission["sessions"], admission["rejected_sessions"],
+                                             admission["rejected_memory"], admission.get("rejected_waiting", 0)))
+        file_cache = metrics.get("file_cache")
+        if file_cache is not None and file_cache["hit_ratio"] is not None:
+            print("File cache: {:.1%} of {:,} lookups hit, {:,} files in {:,} of {:,} bytes, {:,} evicted".format(
+                file_cache["hit_ratio"], file_cache["hits"] + file_cache["misses"], file_cache["files"],
+                file_cache["bytes"], file_cache["max_bytes"], file_cache["evictions"]))
+
+    def fetch_metrics(self):
+        """
+        Asks the server for its metrics with the STAT command.
+        :return: The metrics as a dict
+        """
+        self.send_command("STAT")
+        return json.loads(self.receive_data(data_length_size="long").decode("utf-8"))
+
+    def iterate_files(self, prefix="", with_digests=False):
+        """
+        Lists the files on the server with their metadata using the MLSD command. Entries are fetched a page at a time
+        as they are needed, so even a huge directory is never held in memory at once.
+        :param prefix: Only list files whose names start with this
+        :param with_digests: Whether to include the digest of each file, which the server may need to compute
+        :return: An iterator of dicts with the name, size, mtime, type and, if asked for, digest of each file
+        """
+        cursor = ""
+        while True:
+            self.send_command("MLSD")
+            self.send_data(prefix, "short")
+            self.send_data(cursor, "short")
+            self.send_data_number(LIST_PAGE_SIZE, "long")
+            self.send_data_number(1 if with_digests else 0, "long")
+            page = json.loads(self.receive_data(data_length_size="long").decode("utf-8"))
+            vprint("Received page of {} entries".format(len(page["entries"])))
+            for entry in page["entries"]:
+                yield entry
+            cursor = page["cursor"]
+            if cursor is None:
+                return
+
     def delete_file(self):
         """
         Deletes a file from the server, prompting the user for confirmation.
         """
-        if not IS_CONNECTED:
+        if not self.is_connected:
             print("Error: You are not connected to the server. Use CONN command first.")
             return
 
@@ -287,9 +1381,7 @@ class FTPClient:
         vprint("Sending file name")
         self.send_data(file_name, "short")
 
-        file_exists_num = int.from_bytes(self.receive_data(variable_length_response=False, data_length_size="long"),
-                                         "big",
-                                         signed=True)
+        file_exists_num = self.receive_data_number("long")
         if file_exists_num == 1:
             file_exists = True
         elif file_exists_num == -1:
@@ -317,7 +1409,7 @@ class FTPClient:
         :return:
         """
         print("Quitting...")
-        if IS_CONNECTED:
+        if self.is_connected:
             self.send_command("QUIT")
             self.close_connection()
         sys.exit(0)
@@ -325,13 +1417,19 @@ class FTPClient:
     def menu(self):
         print()
         print("#########################################")
-        print("   Status: {}\n".format("Connected to server " if IS_CONNECTED else "Not connected to server"))
+        print("   Status: {}\n".format("Connected to server " if self.is_connected else "Not connected to server"))
         print("## FTP Client Menu ##")
         print("   CONN - connect to server")
         print("   UPLD - upload a file to the server")
         print("   LIST - list the files on the server")
+        print("   MLSD - list the files on the server with their sizes and times")
         print("   DWLD - download a file from the server")
         print("   DELF - delete a file from the server")
+        print("   HASH - check a local file against the server's copy")
+        print("   MGET - download several files from the server")
+        print("   MPUT - upload several files to the server")
+        print("   MDEL - delete several files from the server")
+        print("   STAT - show the server's command counts and latencies")
         print("   QUIT - exit FTP client")
         print()
         command = input("Enter a command: ").upper()
@@ -345,12 +1443,30 @@ class FTPClient:
         elif command == "LIST":
             vprint("User wanted LIST")
             self.list_files()
+        elif command == "MLSD":
+            vprint("User wanted MLSD")
+            self.list_files_detailed()
         elif command == "DWLD":
             vprint("User wanted DWLD")
             self.download_file()
         elif command == "DELF":
             vprint("User wanted DELF")
             self.delete_file()
+        elif command == "HASH":
+            vprint("User wanted HASH")
+            self.check_file()
+        elif command == "MGET":
+            vprint("User wanted MGET")
+            self.download_files()
+        elif command == "MPUT":
+            vprint("User wanted MPUT")
+            self.upload_files()
+        elif command == "MDEL":
+            vprint("User wanted MDEL")
+            self.delete_files()
+        elif command == "STAT":
+            vprint("User wanted STAT")
+            self.show_metrics()
         elif command == "QUIT":
             vprint("User wanted QUIT")
             self.quit()
@@ -363,11 +1479,18 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", help="Enable verbose printing", action="store_true")
     parser.add_argument("-p", "--port", help="Specify a port to connect to", type=int)
+    parser.add_argument("-s", "--segments", help="Download files over this many parallel sessions", type=int,
+                        default=1)
+    parser.add_argument("-z", "--compress", help="Ask the server to compress transfers with this codec",
+                        choices=sorted(CODECS))
+    parser.add_argument("-b", "--buffer-size", help="Bytes received per socket read during downloads", type=int,
+                        default=DEFAULT_TRANSFER_BUFFER_SIZE)
+    parser.add_argument("--no-delta", help="Always upload whole files, even when the server has an older copy",
+                        action="store_true")
     args = parser.parse_args()
 
     # Global inits
     global VERBOSE_PRINT
-    global PORT
 
     print("Starting server...")
 
@@ -378,22 +1501,36 @@ def main():
     vprint("Verbose status was {}".format(args.verbose))
     vprint("VERBOSE_PRINT = {}".format(VERBOSE_PRINT))
     if args.port is not None:
-        PORT = args.port
-        print("Using port:", PORT)
+        port = args.port
+        print("Using port:", port)
     else:
-        PORT = DEFAULT_PORT
-        print("Using port: {} (default)".format(PORT))
+        port = DEFAULT_PORT
+        print("Using port: {} (default)".format(port))
     vprint("Arg port was {}".format(args.port))
 
     vprint("main() called")
 
+    if args.buffer_size < 1:
+        parser.error("--buffer-size must be at least 1")
+    vprint("Arg buffer size was {}".format(args.buffer_size))
+    if args.segments < 1:
+        parser.error("--segments must be at least 1")
+    vprint("Arg segments was {}".format(args.segments))
+    vprint("Arg compress was {}".format(args.compress))
+    vprint("Arg no delta was {}".format(args.no_delta))
+
     # Make server
-    client = FTPClient()
+    client = FTPClient(args.buffer_size, args.segments, args.compress, use_delta=not args.no_delta, port=port)
     vprint("Made client instance")
 
     # Start menu
     while True:
-        client.menu()
+        try:
+            client.menu()
+        except ConnectionError as e:
+            # The server closed the session, e.g. after the client was idle for longer than its --idle-timeout
+            print("Error: Lost the connection to the server ({}). Use CONN command to reconnect.".format(e))
+            client.close_connection()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,199 @@
+# ftp_protocol.py
+#
+# The wire format shared by client/ftp_client.py and server/ftp_server.py: the protocol constants both sides must agree
+# on, and the framing of numbers and length-prefixed data. Both scripts add this directory to sys.path to import it.
+
+import bz2
+import functools
+import socket
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # Python can be built without liblzma
+    lzma = None
+
+# Constants
+HELLO_CHECK = b"Successfully connected to server!"
+# A server at its limits answers HELO with this instead of HELLO_CHECK and closes the connection
+HELLO_BUSY = b"BUSY"
+
+# Numbers are big-endian and signed. Variable-length data is prefixed with its length as one of these numbers.
+NUMBER_FORMATS = {
+    "short": struct.Struct(">h"),
+    "long": struct.Struct(">i"),
+    "quad": struct.Struct(">q"),
+}
+DATA_LENGTH_SIZES = {name: number_format.size for name, number_format in NUMBER_FORMATS.items()}
+
+# Protocol version 2 is negotiated during HELO. It sends sizes as "quad" numbers and file contents as a series of
+# chunks, each with a flags byte and a 4-byte length, ended by an empty chunk.
+PROTOCOL_VERSION = 2
+HELLO_OPTIONS_SEPARATOR = b"\n"
+CHUNK_HEADER = struct.Struct(">BI")
+CHUNK_FLAGS_NONE = 0
+CHUNK_FLAGS_COMPRESSED = 1
+V1_MAX_FILE_SIZE = 2 ** 31 - 1
+
+# Compression codecs that can be asked for during HELO, as (compress, decompressor) pairs. Each chunk is compressed on
+# its own so a file streams through without being buffered, and a chunk that doesn't shrink is sent as it is.
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompressobj),
+    "bz2": (bz2.compress, bz2.BZ2Decompressor),
+}
+if lzma is not None:
+    CODECS["lzma"] = (functools.partial(lzma.compress, preset=1), lzma.LZMADecompressor)
+
+# A compressed chunk holds at most this many bytes of the file, and so is never larger itself. Receivers turn away
+# larger compressed chunks before reading them and stop decompressing once a chunk yields more, so a peer cannot make
+# them allocate or inflate without bound.
+MAX_COMPRESSED_CHUNK_SIZE = 4 * 1024 * 1024
+
+# If the first chunk of a file compresses to more than this fraction of its size, the file is most likely compressed
+# already and the rest of it is sent uncompressed
+COMPRESSION_SKIP_RATIO = 0.9
+
+# With the digest feature, each side hashes the bytes it streams and the sender follows the chunks with its digest
+DIGEST_ALGORITHM = "sha256"
+
+# With the delta feature, DUPL uploads a file as changes to the copy the server already has. The server sends a
+# signature of each block of its copy, a weak adler32 checksum and a strong BLAKE2 digest, and the client replies with
+# chunks of literal data and references to blocks it found in its own file.
+CHUNK_FLAGS_BLOCK = 2
+DELTA_STRONG_DIGEST_SIZE = 16
+DELTA_SIGNATURE = struct.Struct(">I{}s".format(DELTA_STRONG_DIGEST_SIZE))
+
+
+def configure_socket(sock):
+    """
+    Sets up a connected socket for the protocol. Requests and replies are made of several small writes, which Nagle's
+    algorithm would otherwise hold back waiting for the peer's delayed ACK.
+    :param sock: A connected TCP socket
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def send_parts(sock, parts):
+    """
+    Sends several buffers as if they were one, with a single sendmsg() scatter-gather call where the platform has it.
+    :param sock: A connected socket
+    :param parts: A list of bytes-like objects
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(parts))
+        return
+    parts = [memoryview(part).cast("B") for part in parts if len(part)]
+    while parts:
+        amount_sent = sock.sendmsg(parts)
+        # Carry on from wherever a short send stopped
+        while parts and amount_sent >= len(parts[0]):
+            amount_sent -= len(parts[0])
+            parts.pop(0)
+        if amount_sent:
+            parts[0] = parts[0][amount_sent:]
+
+
+def encode_number(number, data_length_size):
+    """
+    Encodes a number for sending.
+    :param number: The number to encode
+    :param data_length_size: Either "short", "long" or "quad" to specify whether the number is given as 2, 4 or 8 bytes
+    :return: The number as bytes
+    """
+    return NUMBER_FORMATS[data_length_size].pack(number)
+
+
+def decode_number(raw, data_length_size):
+    """
+    Decodes a number that was received, the counterpart of encode_number.
+    :param raw: The number as bytes
+    :param data_length_size: Either "short", "long" or "quad" to specify whether the number is given as 2, 4 or 8 bytes
+    :return: The number as an int
+    """
+    return NUMBER_FORMATS[data_length_size].unpack(raw)[0]
+
+
+def send_number(sock, number, data_length_size):
+    """
+    Sends a number on its own, e.g. a file size.
+    :param sock: A connected socket
+    :param number: The number to send
+    :param data_length_size: Either "short", "long" or "quad" to specify whether the number is given as 2, 4 or 8 bytes
+    """
+    sock.sendall(encode_number(number, data_length_size))
+
+
+def send_frame(sock, data, data_length_size="long"):
+    """
+    Sends variable-length data prefixed with its length, in a single call.
+    :param sock: A connected socket
+    :param data: The data to send, as bytes or str
+    :param data_length_size: Either "short", "long" or "quad" to specify whether the data length is given as 2, 4 or 8
+                             bytes
+    """
+    if type(data) != bytes:
+        data = bytes(data, "utf-8")
+    send_parts(sock, [encode_number(len(data), data_length_size), data])
+
+
+def receive_exactly(sock, length):
+    """
+    Receives exactly the given number of bytes, looping over short reads.
+    :param sock: A connected socket
+    :param length: The number of bytes to receive
+    :return: The data as bytes
+    """
+    if length < 0:
+        # Lengths come from the peer, a negative one means the stream is corrupt or hostile
+        raise ConnectionAbortedError("Received a negative length {:,}".format(length))
+    data = bytearray(length)
+    view = memoryview(data)
+    amount_received = 0
+    while amount_received < length:
+        received = sock.recv_into(view[amount_received:])
+        if received == 0:
+            raise ConnectionError("Connection closed after {:,} of {:,} bytes".format(amount_received, length))
+        amount_received += received
+    return bytes(data)
+
+
+def receive_compressed_chunk(sock, codec, length):
+    """
+    Receives a compressed chunk and decompresses it, refusing chunks over MAX_COMPRESSED_CHUNK_SIZE either way.
+    :param sock: A connected socket
+    :param codec: The name of the codec the chunk was compressed with
+    :param length: The length of the compressed chunk, from its header
+    :return: The decompressed data as bytes
+    """
+    if length > MAX_COMPRESSED_CHUNK_SIZE:
+        raise ConnectionAbortedError("Received a compressed chunk of {:,} bytes, the limit is {:,}".format(
+            length, MAX_COMPRESSED_CHUNK_SIZE))
+    decompressor = CODECS[codec][1]()
+    data = decompressor.decompress(receive_exactly(sock, length), MAX_COMPRESSED_CHUNK_SIZE)
+    if not decompressor.eof:
+        raise ConnectionAbortedError("Received a compressed chunk that is truncated or holds more than {:,} "
+                                     "bytes".format(MAX_COMPRESSED_CHUNK_SIZE))
+    return data
+
+
+def receive_number(sock, data_length_size):
+    """
+    Receives a number sent by send_number.
+    :param sock: A connected socket
+    :param data_length_size: Either "short", "long" or "quad" to specify whether the number is given as 2, 4 or 8 bytes
+    :return: The number as an int
+    """
+    return decode_number(receive_exactly(sock, DATA_LENGTH_SIZES[data_length_size]), data_length_size)
+
+
+def receive_frame(sock, data_length_size="long"):
+    """
+    Receives variable-length data sent by send_frame.
+    :param sock: A connected socket
+    :param data_length_size: Either "short", "long" or "quad" to specify whether the data length is given as 2, 4 or 8
+                             bytes
+    :return: The data as bytes
+    """
+    return receive_exactly(sock, receive_number(sock, data_length_size))
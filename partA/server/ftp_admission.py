@@ -0,0 +1,85 @@
+# ftp_admission.py
+#
+# Admission control for FTPServer. Rather than queueing every connection until the server runs out of workers or memory,
+# connections beyond its limits are answered with HELLO_BUSY during HELO and closed, so clients can back off and retry.
+
+import os
+import threading
+
+
+def resident_memory():
+    """
+    Gets how much memory the process is using.
+    :return: The resident set size in bytes, or None on platforms without /proc
+    """
+    try:
+        with open("/proc/self/statm") as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class AdmissionController:
+    """
+    Counts the sessions a server is serving or has waiting for a worker, and decides whether another can be admitted.
+    A session is turned away when there are already max_sessions of them, or when the process's resident memory is over
+    max_memory, so the sessions already admitted can finish before the server takes on more.
+    """
+
+    def __init__(self, max_sessions=None, max_memory=None):
+        """
+        :param max_sessions: The most sessions to serve or hold waiting at once, or None for no limit
+        :param max_memory: The resident memory in bytes above which new sessions are turned away, or None for no limit
+        """
+        self.max_sessions = max_sessions
+        self.max_memory = max_memory
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.rejected_sessions = 0
+        self.rejected_memory = 0
+        self.rejected_waiting = 0
+
+    def admit(self):
+        """
+        Admits a new session if the limits allow it. Every admitted session must be released when it ends.
+        :return: Whether the session was admitted
+        """
+        memory = resident_memory() if self.max_memory is not None else None
+        with self.lock:
+            if self.max_sessions is not None and self.sessions >= self.max_sessions:
+                self.rejected_sessions += 1
+                return False
+            if memory is not None and memory > self.max_memory:
+                self.rejected_memory += 1
+                return False
+            self.sessions += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.sessions -= 1
+
+    def turn_away(self):
+        """
+        Releases a session that was admitted but has to be turned away after all, because too many sessions are
+        already waiting for a worker.
+        """
+        with self.lock:
+            self.sessions -= 1
+            self.rejected_waiting += 1
+
+    def stats(self):
+        """
+        :return: The limits, the sessions admitted and how many were turned away, as a dict that can be encoded as JSON
+        """
+        with self.lock:
+            return {
+                "max_sessions": self.max_sessions,
+                "max_memory": self.max_memory,
+                "sessions": self.sessions,
+                "rejected_sessions": self.rejected_sessions,
+                "rejected_memory": self.rejected_memory,
+                "rejected_waiting": self.rejected_waiting,
+                "resident_memory": resident_memory(),
+            }
@@ -0,0 +1,99 @@
+# ftp_cache.py
+#
+# An in-memory cache of the contents of popular files, so FTPServer can send repeated downloads of the same file
+# without reading it from storage each time.
+
+import collections
+import threading
+
+
+class FileCache:
+    """
+    Holds the contents of recently downloaded files, up to a total size, dropping the least recently used file to make
+    room. Each file is kept along with the size, modification time and inode it had when it was read, so a file that has
+    been replaced or changed is never served from the cache, even if the change didn't go through this server.
+    """
+
+    def __init__(self, max_size, max_file_size):
+        """
+        :param max_size: The most bytes of file contents to hold in total
+        :param max_file_size: The largest file to hold, larger files are always read from storage
+        """
+        self.max_size = max_size
+        self.max_file_size = min(max_file_size, max_size)
+        self.lock = threading.Lock()
+        # File name -> ((size, mtime, inode), contents), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def holds(self, file_stat):
+        """
+        Checks whether a file is small enough to be cached.
+        :param file_stat: The os.stat_result of the file
+        """
+        return file_stat.st_size <= self.max_file_size
+
+    def get(self, file_name, file_stat):
+        """
+        Looks up the contents of a file.
+        :param file_name: The name of the file
+        :param file_stat: The os.stat_result of the file as it is now
+        :return: The contents as bytes, or None if they aren't cached for this version of the file
+        """
+        version = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+        with self.lock:
+            entry = self.entries.get(file_name)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(file_name)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, file_name, file_stat, contents):
+        """
+        Caches the contents of a file, if they fit.
+        :param file_name: The name of the file
+        :param file_stat: The os.stat_result of the file the contents were read from
+        :param contents: The contents as bytes
+        """
+        if len(contents) > self.max_file_size:
+            return
+        version = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+        with self.lock:
+            self.remove(file_name)
+            self.entries[file_name] = (version, contents)
+            self.size += len(contents)
+            while self.size > self.max_size:
+                evicted_name, (evicted_version, evicted_contents) = self.entries.popitem(last=False)
+                self.size -= len(evicted_contents)
+                self.evictions += 1
+
+    def forget(self, file_name):
+        with self.lock:
+            self.remove(file_name)
+
+    def remove(self, file_name):
+        # Only call with the lock held
+        entry = self.entries.pop(file_name, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def stats(self):
+        """
+        :return: The hit and miss counts and how full the cache is, as a dict that can be encoded as JSON
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "files": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_size,
+            }
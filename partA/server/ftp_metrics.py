@@ -0,0 +1,190 @@
+# ftp_metrics.py
+#
+# Counters, byte counts and latency histograms for the commands FTPServer serves. Sessions record each command as it
+# finishes, and the totals are read back with the STAT command or written to a file every few seconds.
+
+import bisect
+import json
+import os
+import threading
+import time
+
+# Constants
+# Latency histogram buckets start at 10 microseconds and each is 2^(1/4) times wider than the last, so a percentile read
+# from them is within 19% of the true value. 108 buckets reach past 16 minutes, anything slower goes in the last one.
+HISTOGRAM_LOWEST_BOUND = 0.00001
+HISTOGRAM_GROWTH = 2 ** 0.25
+HISTOGRAM_BUCKETS = 108
+HISTOGRAM_BOUNDS = [HISTOGRAM_LOWEST_BOUND * HISTOGRAM_GROWTH ** i for i in range(HISTOGRAM_BUCKETS)]
+REPORTED_PERCENTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+
+class LatencyHistogram:
+    """
+    Counts latencies in exponentially growing buckets, so memory and the cost of recording stay fixed however many
+    latencies are recorded.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (HISTOGRAM_BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        # The first bucket whose upper bound is at least this latency, or the last bucket if none is
+        index = bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Estimates a percentile as the upper bound of the bucket it falls in.
+        :param fraction: The percentile as a fraction, e.g. 0.95
+        :return: The latency in seconds, or None if nothing has been recorded
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(fraction * self.count + 0.5))
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                if index == HISTOGRAM_BUCKETS:
+                    return self.max
+                return min(HISTOGRAM_BOUNDS[index], self.max)
+        return self.max
+
+    def summary(self):
+        """
+        :return: The mean, maximum and REPORTED_PERCENTILES in milliseconds, as a dict
+        """
+        summary = {"mean": self.total / self.count * 1000 if self.count else None, "max": self.max * 1000}
+        for name, fraction in REPORTED_PERCENTILES.items():
+            value = self.percentile(fraction)
+            summary[name] = value * 1000 if value is not None else None
+        return summary
+
+
+class CommandMetrics:
+    """
+    The totals for one command.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.latency = LatencyHistogram()
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "latency_ms": self.latency.summary(),
+        }
+
+
+class ServerMetrics:
+    """
+    The totals for every command a server has served, shared by all of its sessions.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.sessions_opened = 0
+        self.sessions_active = 0
+        self.dump_thread = None
+        # Other figures to include in snapshots, as name -> function returning a dict
+        self.sources = {}
+
+    def add_source(self, name, function):
+        """
+        Includes figures kept elsewhere, e.g. by a cache, in every snapshot.
+        :param name: The key to include them under
+        :param function: A function returning the figures as a dict that can be encoded as JSON
+        """
+        self.sources[name] = function
+
+    def session_started(self):
+        with self.lock:
+            self.sessions_opened += 1
+            self.sessions_active += 1
+
+    def session_ended(self):
+        with self.lock:
+            self.sessions_active -= 1
+
+    def record_command(self, command, seconds, bytes_received=0, bytes_sent=0, failed=False):
+        """
+        Records a command that has finished.
+        :param command: The four-character command
+        :param seconds: How long the command took, from reading it to sending the last of the reply
+        :param bytes_received: The number of bytes of file contents received while serving it
+        :param bytes_sent: The number of bytes of file contents sent while serving it
+        :param failed: Whether the command ended the session with an error
+        """
+        with self.lock:
+            command_metrics = self.commands.get(command)
+            if command_metrics is None:
+                command_metrics = self.commands[command] = CommandMetrics()
+            command_metrics.count += 1
+            command_metrics.bytes_received += bytes_received
+            command_metrics.bytes_sent += bytes_sent
+            if failed:
+                command_metrics.errors += 1
+            command_metrics.latency.record(seconds)
+
+    def snapshot(self):
+        """
+        :return: The current totals as a dict that can be encoded as JSON
+        """
+        with self.lock:
+            commands = {command: command_metrics.summary() for command, command_metrics in self.commands.items()}
+            sessions = {"opened": self.sessions_opened, "active": self.sessions_active}
+        snapshot = {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "sessions": sessions,
+            "bytes_received": sum(command["bytes_received"] for command in commands.values()),
+            "bytes_sent": sum(command["bytes_sent"] for command in commands.values()),
+            "commands": commands,
+        }
+        for name, function in self.sources.items():
+            snapshot[name] = function()
+        return snapshot
+
+    def write_snapshot(self, path):
+        """
+        Writes the current totals to a file as JSON, replacing it in one step so a reader never sees half of it.
+        :param path: The path of the file
+        """
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as metrics_file:
+            json.dump(self.snapshot(), metrics_file, indent=2)
+        os.replace(temporary_path, path)
+
+    def start_dumping(self, path, interval):
+        """
+        Writes the totals to a file every interval seconds from a background thread.
+        :param path: The path of the file
+        :param interval: The number of seconds between writes
+        """
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_snapshot(path)
+                except OSError as e:
+                    print("Error: Could not write metrics to {}: {}".format(path, e))
+
+        self.dump_thread = threading.Thread(target=dump_loop, name="ftp-metrics", daemon=True)
+        self.dump_thread.start()
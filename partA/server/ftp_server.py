@@ -1,19 +1,90 @@
 # ftp_server.py
 
+import asyncio
+import hashlib
 import json
+import math
+import queue
 import socket
 import argparse
+import bisect
 import os
+import signal
+import sys
+import threading
 import time
+import traceback
+import zlib
+
+from ftp_admission import AdmissionController
+from ftp_cache import FileCache
+from ftp_metrics import ServerMetrics
+from ftp_shaping import TrafficShaper
+from ftp_storage import (DEFAULT_SYNC_INTERVAL, DURABILITY_POLICIES, BlobStorage, DirectoryStorage, LocalFile,
+                         MemoryFile, PartialFile)
+
+# The wire format is shared with the client, one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import ftp_protocol  # noqa: E402
+from ftp_protocol import (CHUNK_FLAGS_BLOCK, CHUNK_FLAGS_COMPRESSED, CHUNK_FLAGS_NONE, CHUNK_HEADER,  # noqa: E402
+                          CODECS, COMPRESSION_SKIP_RATIO, DATA_LENGTH_SIZES, DELTA_SIGNATURE, DELTA_STRONG_DIGEST_SIZE,
+                          DIGEST_ALGORITHM, HELLO_BUSY, HELLO_CHECK, HELLO_OPTIONS_SEPARATOR, MAX_COMPRESSED_CHUNK_SIZE,
+                          PROTOCOL_VERSION, V1_MAX_FILE_SIZE)
 
 # Constants
 DEFAULT_PORT = 1337
-HELLO_CHECK = b"Successfully connected to server!"
-VALID_COMMANDS = ["HELO", "UPLD", "LIST", "DWLD", "DELF", "QUIT"]
-SINGLE_OPTION_COMMANDS = ["LIST", "DWLD", "DELF"]
+VALID_COMMANDS = ["HELO", "UPLD", "LIST", "DWLD", "DELF", "HASH", "DUPL", "HAVE", "MGET", "MPUT", "MDEL", "MLSD",
+                  "STAT", "QUIT"]
+SINGLE_OPTION_COMMANDS = ["LIST", "DWLD", "DELF", "HASH"]
 ACKNOWLEDGEMENT_NEEDED_COMMANDS = ["HELO", "UPLD"]
 NO_OPTION_COMMANDS = ["QUIT"]
-SOCKET_BUFFER_SIZE = 1024
+DEFAULT_WORKERS = 16
+DEFAULT_TRANSFER_BUFFER_SIZE = 256 * 1024
+ENGINES = ["threads", "asyncio"]
+DEFAULT_METRICS_INTERVAL = 10
+# With --cache-size, files up to this fraction of the cache are cached unless --cache-max-file-size says otherwise
+DEFAULT_CACHE_MAX_FILE_FRACTION = 0.25
+MEBIBYTE = 1024 * 1024
+
+# A session is closed when the client sends nothing for this many seconds part way through a command, or, with
+# --idle-timeout, between commands
+DEFAULT_READ_TIMEOUT = 60
+
+# Connections turned away by --max-sessions or --max-memory wait here to be answered HELLO_BUSY, each for at most
+# BUSY_REPLY_TIMEOUT seconds. Any more are closed without an answer.
+BUSY_QUEUE_SIZE = 64
+BUSY_REPLY_TIMEOUT = 5
+# While a session waits on the rate limits, another worker stands in for it so new sessions are still served, up to a
+# pool of this many times --workers
+MAX_POOL_FACTOR = 4
+
+# Seconds to wait before accepting again when accept() fails, e.g. because the process is out of file descriptors
+ACCEPT_RETRY_DELAY = 0.1
+
+# With --processes, a worker process that dies this soon after starting is restarted only after a delay, so one that
+# cannot start doesn't fork over and over
+WORKER_MIN_LIFETIME = 5
+WORKER_RESTART_DELAY = 1
+# The signals that stop the supervisor and its worker processes
+STOP_SIGNALS = [signal.SIGINT, signal.SIGTERM]
+
+# Optional protocol version 2 features, the client asks for the ones it wants during HELO
+SUPPORTED_FEATURES = ["resume", "range", "digest", "delta", "have", "batch", "mlsd", "stat", "resume-check"]
+
+# With resume-check, UPLD is sent a key naming the client's copy of the file, so uploads of the same name from different
+# clients are resumed separately. Longer keys are refused.
+MAX_RESUME_KEY_LENGTH = 64
+
+# MLSD sends a listing in pages of at most this many entries, the client asks for each page with a cursor
+MAX_LIST_PAGE_SIZE = 1000
+
+# Features that need the server's storage to deduplicate content
+DEDUPLICATION_FEATURES = ["have"]
+
+# DUPL signs the server's copy of a file in blocks of about the square root of its size, within these bounds
+DELTA_MIN_BLOCK_SIZE = 2 * 1024
+DELTA_MAX_BLOCK_SIZE = 128 * 1024
 
 # Global variables
 VERBOSE_PRINT = False
@@ -25,65 +96,365 @@ def vprint(contents):
         print(contents)
 
 
+def delta_block_size(file_size):
+    """
+    Picks the block size for the signatures of a file, rounded up to a whole KiB.
+    :param file_size: The size of the file in bytes
+    :return: The block size in bytes
+    """
+    block_size = -(-int(math.sqrt(file_size)) // 1024) * 1024
+    return min(max(block_size, DELTA_MIN_BLOCK_SIZE), DELTA_MAX_BLOCK_SIZE)
+
+
 class FTPServer:
 
-    def __init__(self):
+    def __init__(self, port=DEFAULT_PORT, workers=DEFAULT_WORKERS, buffer_size=DEFAULT_TRANSFER_BUFFER_SIZE,
+                 use_sendfile=True, use_compression=True, storage=None, reuse_port=False, file_cache=None,
+                 durability="none", sync_interval=DEFAULT_SYNC_INTERVAL, shaper=None, admission=None,
+                 idle_timeout=None, read_timeout=DEFAULT_READ_TIMEOUT):
         vprint("FTPServer constructor was called")
 
         self.sock = None
-        self.connection = None
+        self.port = port
+        # Whether other processes may listen on the same port, the kernel then spreads connections between them
+        self.reuse_port = reuse_port
+        self.workers = workers
+        # The worker threads started and how many of them are waiting on the rate limits. Only the others count
+        # towards --workers.
+        self.pool_lock = threading.Lock()
+        self.pool_size = 0
+        self.waiting_workers = 0
+        self.workers_started = 0
+        self.buffer_size = buffer_size
+        self.use_sendfile = use_sendfile
+        self.use_compression = use_compression
+        # Seconds a session may wait for the client between commands and part way through one, None to wait forever
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        # The AdmissionController that turns connections away when the server is at its limits, or None. Without one,
+        # connections wait for a free worker however long that takes.
+        self.admission = admission
+        # Connections waiting for a worker. --max-sessions bounds them itself, otherwise at most one per worker wait
+        # here and the rest wait in the listen backlog, or are turned away with admission control.
+        sessions_bounded = admission is not None and admission.max_sessions is not None
+        self.connections = queue.Queue(maxsize=0 if sessions_bounded else workers)
+        self.busy_connections = queue.Queue(maxsize=BUSY_QUEUE_SIZE)
+        self.storage = storage if storage is not None else DirectoryStorage()
+        # One of DURABILITY_POLICIES, how uploads are synced to disk
+        self.durability = durability
+        self.sync_interval = sync_interval
+
+        # Whole-file digests, shared by every session and keyed by file name. Each entry remembers the size, mtime and
+        # inode it was computed for, so a file that has been replaced or modified is never given a stale digest.
+        self.digests = {}
+        self.digests_lock = threading.Lock()
+
+        # The sorted names of the files in storage, shared by every session. It is rebuilt after an upload or delete,
+        # or when the storage says it has changed some other way.
+        self.listing = None
+        self.listing_version = None
+        self.listing_lock = threading.Lock()
+
+        # Per-command counters and latencies, read with STAT or written to a file with --metrics-file
+        self.metrics = ServerMetrics()
+
+        # The contents of popular files, so repeated downloads are sent from memory. None if caching is off.
+        self.file_cache = file_cache
+        if file_cache is not None:
+            self.metrics.add_source("file_cache", file_cache.stats)
+
+        # The TrafficShaper that limits the rate file contents are moved at, or None if they are not limited
+        self.shaper = shaper
+        if shaper is not None:
+            self.metrics.add_source("rate_limits", shaper.stats)
+        if admission is not None:
+            self.metrics.add_source("admission", admission.stats)
         self.initialise_socket()
 
     def initialise_socket(self):
         # Create a TCP/IP socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         vprint(self.sock)
         vprint("Made socket")
-        vprint("Defined self.connection")
 
     def listen(self):
         # Bind the socket to the port
-        server_address = ("localhost", PORT)
-        print("Server listening on port {}".format(PORT))
+        server_address = ("localhost", self.port)
         self.sock.bind(server_address)
+        self.port = self.sock.getsockname()[1]
+        print("Server listening on port {} with {} workers".format(self.port, self.workers))
 
         # Listen for incoming connections
-        self.sock.listen(1)
+        self.sock.listen(socket.SOMAXCONN)
 
-        # Get connection
+        # Start the worker pool, each worker serves one session at a time
+        with self.pool_lock:
+            for i in range(self.workers):
+                self.start_worker()
+        vprint("Started {} workers".format(self.workers))
+        if self.admission is not None:
+            threading.Thread(target=self.busy_loop, name="ftp-busy", daemon=True).start()
+
+        # Hand connections to the workers. Once every worker is busy and the queue is full, put() blocks, so further
+        # clients wait in the listen backlog rather than piling up inside the server. With admission control,
+        # connections beyond its limits or a full queue are turned away instead.
         while True:
             print("Waiting for a connection...")
-            self.connection, client_address = self.sock.accept()
+            try:
+                connection, client_address = self.sock.accept()
+            except OSError as e:
+                # Most likely out of file descriptors, which sessions ending will give back
+                print("Error: Could not accept a connection: {}".format(e))
+                time.sleep(ACCEPT_RETRY_DELAY)
+                continue
             vprint("Connection from {}".format(client_address))
-            break
+            if self.admission is None:
+                self.connections.put((connection, client_address))
+                continue
+            if self.admission.admit():
+                try:
+                    self.connections.put_nowait((connection, client_address))
+                    continue
+                except queue.Full:
+                    self.admission.turn_away()
+            print("Server is busy, turning away {}.".format(client_address))
+            try:
+                self.busy_connections.put_nowait((connection, client_address))
+            except queue.Full:
+                connection.close()
 
-        self.listen_for_command()
+    def busy_loop(self):
+        """
+        Answers the HELO of each connection turned away by admission control with HELLO_BUSY, then closes it.
+        """
+        while True:
+            connection, client_address = self.busy_connections.get()
+            try:
+                connection.settimeout(BUSY_REPLY_TIMEOUT)
+                if ftp_protocol.receive_exactly(connection, 4) == b"HELO":
+                    ftp_protocol.receive_frame(connection)
+                    ftp_protocol.send_frame(connection, HELLO_BUSY)
+            except OSError as e:
+                vprint("Could not tell {} the server is busy: {}".format(client_address, e))
+            finally:
+                connection.close()
 
-    def listen_for_command(self):
-        # Once we have the connection
+    def start_worker(self):
+        """
+        Starts another worker thread. Called with pool_lock held.
+        """
+        self.pool_size += 1
+        self.workers_started += 1
+        worker = threading.Thread(target=self.worker_loop, name="ftp-worker-{}".format(self.workers_started - 1),
+                                  daemon=True)
+        worker.start()
+
+    def wait_aside(self, seconds):
+        """
+        Waits in a session's worker thread for the rate limits. The worker stops counting towards --workers while it
+        waits, and if that leaves too few, another is started to serve new sessions, so throttled transfers cannot keep
+        other clients' LIST and DELF waiting for a worker.
+        :param seconds: How long to wait
+        """
+        with self.pool_lock:
+            self.waiting_workers += 1
+            if self.pool_size - self.waiting_workers < self.workers and self.pool_size < self.workers * MAX_POOL_FACTOR:
+                vprint("Starting a worker to stand in for a throttled session")
+                self.start_worker()
+        try:
+            time.sleep(seconds)
+        finally:
+            with self.pool_lock:
+                self.waiting_workers -= 1
+
+    def worker_loop(self):
+        """
+        Takes connections off the queue and serves each one until the client quits or disconnects. A worker exits
+        after a session if there are more than --workers without counting those waiting on the rate limits, so the
+        workers started to stand in for them go away again.
+        """
         while True:
-            print("Waiting for command...")
-            # Receive the command
-            command = self.receive_command()
+            connection, client_address = self.connections.get()
+            self.metrics.session_started()
+            try:
+                FTPSession(self, connection, client_address).listen_for_commands()
+            except OSError as e:
+                print("Error: Connection to {} failed: {}".format(client_address, e))
+            except Exception:
+                # A malformed request, e.g. a name that isn't UTF-8, ends its session but must not take the worker
+                # down with it, or the pool would shrink with every one
+                print("Error: Session with {} failed:".format(client_address))
+                traceback.print_exc()
+            finally:
+                connection.close()
+                self.metrics.session_ended()
+                if self.admission is not None:
+                    self.admission.release()
+            with self.pool_lock:
+                if self.pool_size - self.waiting_workers > self.workers:
+                    self.pool_size -= 1
+                    return
+
+    def get_digest(self, file_name, file_stat):
+        """
+        Looks up the cached digest of a file.
+        :param file_name: The name of the file
+        :param file_stat: The os.stat_result of the file as it is now
+        :return: The digest as bytes, or None if it isn't cached for this version of the file
+        """
+        with self.digests_lock:
+            cached = self.digests.get(file_name)
+        if cached is None or cached[0] != (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+            return None
+        return cached[1]
+
+    def set_digest(self, file_name, file_stat, digest):
+        """
+        Caches the digest of a file.
+        :param file_name: The name of the file
+        :param file_stat: The os.stat_result of the file the digest was computed for
+        :param digest: The digest as bytes
+        """
+        with self.digests_lock:
+            self.digests[file_name] = ((file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino), digest)
+
+    def forget_digest(self, file_name):
+        with self.digests_lock:
+            self.digests.pop(file_name, None)
+
+    def get_listing(self):
+        """
+        Gets the names of the files in storage, from the cache if it is still current.
+        :return: A sorted list of file names, which must not be modified
+        """
+        with self.listing_lock:
+            version = self.storage.listing_version()
+            if self.listing is None or self.listing_version != version:
+                vprint("Rebuilding the file listing")
+                self.listing = sorted(self.storage.list_files())
+                self.listing_version = version
+            return self.listing
+
+    def invalidate_listing(self):
+        with self.listing_lock:
+            self.listing = None
+
+    def file_changed(self, file_name):
+        """
+        Forgets everything cached about a file that has been stored, replaced or deleted: its digest, its contents and
+        the listing it appears in.
+        :param file_name: The name of the file
+        """
+        self.forget_digest(file_name)
+        if self.file_cache is not None:
+            self.file_cache.forget(file_name)
+        self.invalidate_listing()
+
+    def open_for_download(self, file_name):
+        """
+        Opens a file to be sent to a client, from the file cache if it holds the file as it is now. A file small enough
+        to be cached but not yet held is read into the cache whole.
+        :param file_name: The name of the file
+        :return: A StoredFile
+        """
+        binary_file = self.storage.open_file(file_name)
+        if self.file_cache is None or not self.file_cache.holds(binary_file.stat):
+            return binary_file
+        with binary_file:
+            contents = self.file_cache.get(file_name, binary_file.stat)
+            if contents is None:
+                contents = binary_file.read(0, binary_file.size)
+                # A file that shrank as it was read is sent as it was read, but not cached
+                if len(contents) == binary_file.size:
+                    self.file_cache.put(file_name, binary_file.stat, contents)
+            return MemoryFile(binary_file.stat, contents, binary_file.digest)
+
+
+class FTPSession:
+
+    def __init__(self, server, connection, client_address):
+        vprint("FTPSession constructor was called for {}".format(client_address))
+
+        self.server = server
+        self.connection = connection
+        ftp_protocol.configure_socket(connection)
+        connection.settimeout(server.read_timeout)
+        self.client_address = client_address
+        self.is_open = True
+        self.protocol_version = 1
+        self.features = set()
+        self.codec = None
+        # File contents moved over the session so far, each command is recorded with how much these grew
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        # One transfer buffer per session, reused for every file so memory stays bounded whatever the file size
+        self.transfer_buffer = memoryview(bytearray(server.buffer_size))
+        # The session's own rate limit, if the server gives each session one
+        self.rate_bucket = server.shaper.session_bucket() if server.shaper is not None else None
+        self.command_handlers = {
+            "HELO": self.handle_hello,
+            "UPLD": self.handle_upload,
+            "LIST": self.handle_list,
+            "DWLD": self.handle_download,
+            "DELF": self.handle_delete,
+            "HASH": self.handle_hash,
+            "DUPL": self.handle_delta_upload,
+            "HAVE": self.handle_have,
+            "MGET": self.handle_multi_download,
+            "MPUT": self.handle_multi_upload,
+            "MDEL": self.handle_multi_delete,
+            "MLSD": self.handle_list_detailed,
+            "STAT": self.handle_stat,
+            "QUIT": self.handle_quit,
+        }
+
+    def listen_for_commands(self):
+        """
+        Reads and dispatches commands until the client quits or disconnects. Handlers return here when they finish, so
+        a session uses the same stack depth for its millionth command as for its first.
+        """
+        while self.is_open:
+            vprint("Waiting for command...")
+            # Receive the command, then the rest of it with the shorter deadline of a client part way through a command
+            self.connection.settimeout(self.server.idle_timeout)
+            try:
+                command = self.receive_command()
+            except socket.timeout:
+                print("Client {} was idle for {:g} seconds, closing the connection.".format(self.client_address,
+                                                                                           self.server.idle_timeout))
+                break
+            self.connection.settimeout(self.server.read_timeout)
             vprint("Received command: {!r}".format(command))
-            break
 
-        if command == "HELO":
-            self.handle_hello()
-        elif command == "UPLD":
-            self.handle_upload()
-        elif command == "LIST":
-            self.handle_list()
-        elif command == "DWLD":
-            self.handle_download()
-        elif command == "DELF":
-            self.handle_delete()
-        elif command == "QUIT":
-            self.handle_quit()
+            if command == "":
+                # The client went away without sending QUIT
+                print("Client {} disconnected.".format(self.client_address))
+                break
+            handler = self.command_handlers.get(command)
+            if handler is None:
+                print("Error: Client {} sent unknown command {!r}.".format(self.client_address, command))
+                break
+
+            t0 = time.perf_counter()
+            bytes_received = self.bytes_received
+            bytes_sent = self.bytes_sent
+            failed = True
+            try:
+                handler()
+                failed = False
+            finally:
+                self.server.metrics.record_command(command, time.perf_counter() - t0,
+                                                   self.bytes_received - bytes_received, self.bytes_sent - bytes_sent,
+                                                   failed)
 
     def close_connection(self):
         vprint("Cleaning up connection...")
-        # Clean up the connection
+        # Clean up the connection, closing twice is harmless
+        self.is_open = False
         self.connection.close()
         vprint("Closed connection.")
 
@@ -92,94 +463,311 @@ class FTPServer:
         Receives a 4-byte command
         :return: A 4-character string
         """
-        command_raw = self.connection.recv(4)
+        try:
+            command_raw = self.receive_exactly(4)
+        except ConnectionError:
+            # An empty command tells the session loop that the client has gone
+            return ""
         vprint("command_raw = {}".format(command_raw))
         command = command_raw.decode("utf-8")
         return command
 
     def send_data(self, data, data_length_size="long"):
         """
-        Sends variable-length data to the server.
-        :param data: The data to send, as bytes
-        :param data_length_size: Either "long" or "short" to specify whether the data length is given as 4 or 2 bytes
+        Sends variable-length data to the client, prefixed with its length.
+        :param data: The data to send, as bytes or str
+        :param data_length_size: Either "short", "long" or "quad" to specify whether the data length is given as 2, 4
+                                 or 8 bytes
         """
-
-        # Send the data length
-        self.send_data_number(len(data), data_length_size)
-
-        # Send the data itself
-        if type(data) != bytes:
-            data = bytes(data, "utf-8")
-        self.connection.sendall(data)
+        ftp_protocol.send_frame(self.connection, data, data_length_size)
 
     def send_data_number(self, number, data_length_size):
         """
-        Sends a number to the client. Encodes it as char bytes.
+        Sends a number to the client on its own, e.g. a file size.
         :param number: The number to send
-        :param data_length_size: Either "long" or "short" to specify whether the data length is given as 4 or 2 bytes
+        :param data_length_size: Either "short", "long" or "quad" to specify whether the number is given as 2, 4 or 8
+                                 bytes
         """
-        if data_length_size == "short":
-            bytes_length = 2
-        elif data_length_size == "long":
-            bytes_length = 4
-        else:
-            vprint("Invalid data_length_size parameter: {}".format(data_length_size))
-            return False
-        encoded_number = number.to_bytes(bytes_length, "big", signed=True)
-        self.connection.sendall(encoded_number)
+        ftp_protocol.send_number(self.connection, number, data_length_size)
 
     def receive_data(self, variable_length_response=True, data_length_size="long"):
         """
-        Receive data from the server, either of fixed or variable length.
-        :param variable_length_response: Whether the response is of variable length or fixed (4 bytes)
-        :param data_length_size: Either "long" or "short" to specify whether the data length is given as 4 or 2 bytes
-        :return: The response data from the server
+        Receive data from the client, either of fixed or variable length.
+        :param variable_length_response: Whether the data is prefixed with its length, or is a number of the given size
+        :param data_length_size: Either "short", "long" or "quad" to specify whether the data length is given as 2, 4
+                                 or 8 bytes
+        :return: The data from the client
         """
-        if data_length_size == "long":
-            receive_length = 4
-        elif data_length_size == "short":
-            receive_length = 2
-        else:
-            vprint("Invalid data_length_size parameter: {}".format(data_length_size))
-            return b""
         if variable_length_response:
-            response_length = int.from_bytes(self.connection.recv(receive_length), "big", signed=True)
-            vprint("response_length = {:,}".format(response_length))
+            return ftp_protocol.receive_frame(self.connection, data_length_size)
+        return self.receive_exactly(DATA_LENGTH_SIZES[data_length_size])
 
-            # Loop through and receive the response in chunks
-            amount_received = 0
-            response = b""
-
-            vprint("Will read {:,} bytes {:,} times".format(SOCKET_BUFFER_SIZE, response_length // SOCKET_BUFFER_SIZE))
-            for i in range(response_length // SOCKET_BUFFER_SIZE):
-                data = self.connection.recv(SOCKET_BUFFER_SIZE)
-                amount_received += len(data)
-                response += data
-            vprint("Will now read final {:,} bytes".format(response_length % SOCKET_BUFFER_SIZE))
-            data = self.connection.recv(response_length % SOCKET_BUFFER_SIZE)
-            amount_received += len(data)
-            response += data
-
-            vprint("(response_length = {:,}, amount_received = {:,}, len(response) = {:,})".format(response_length,
-                                                                                             amount_received,
-                                                                                             len(response)))
-        else:
-            response = self.connection.recv(receive_length)
-        return response
+    def receive_data_number(self, data_length_size):
+        """
+        Receives a number from the client, the counterpart of send_data_number.
+        :param data_length_size: Either "short", "long" or "quad" to specify whether the number is given as 2, 4 or 8
+                                 bytes
+        :return: The number as an int
+        """
+        return ftp_protocol.receive_number(self.connection, data_length_size)
+
+    def receive_exactly(self, length):
+        """
+        Receives exactly the given number of bytes, looping over short reads.
+        :param length: The number of bytes to receive
+        :return: The data as bytes
+        """
+        return ftp_protocol.receive_exactly(self.connection, length)
+
+    def open_partial_file(self, partial_name, file_size, offset=0, resumable=True):
+        """
+        Opens a file to receive an upload into, preallocated and synced as the server is configured to.
+        :param partial_name: The path of the partial file
+        :param file_size: The size the client announced for the whole file
+        :param offset: How many bytes already in the partial file to keep, 0 to start over
+        :param resumable: Whether an upload that ends early is kept to be resumed
+        :return: A PartialFile
+        """
+        return PartialFile(partial_name, file_size, offset, self.server.durability, self.server.sync_interval,
+                           resumable)
+
+    def digest_prefix(self, binary_file, length):
+        """
+        Hashes the start of a file, for the resume-check feature.
+        :param binary_file: A StoredFile
+        :param length: The number of bytes to hash
+        :return: The digest as bytes
+        """
+        digest = hashlib.new(DIGEST_ALGORITHM)
+        offset = 0
+        while offset < length:
+            data = binary_file.read(offset, min(length - offset, self.server.buffer_size))
+            if not data:
+                break
+            digest.update(data)
+            offset += len(data)
+        return digest.digest()
+
+    def throttle(self, amount):
+        """
+        Waits until the given number of bytes of file contents may be moved under the server's rate limits, if it has
+        any.
+        :param amount: The number of bytes about to be sent, or just received
+        """
+        if self.server.shaper is not None:
+            self.server.shaper.throttle(self.rate_bucket, amount, self.server.wait_aside)
+
+    def receive_into_file(self, binary_file, length, digest=None):
+        """
+        Streams the given number of bytes from the connection straight into a file through the session's transfer
+        buffer, so no more than one buffer of the file is ever held in memory.
+        :param binary_file: A PartialFile or a file opened for binary writing
+        :param length: The number of bytes to receive
+        :param digest: A hashlib object to update with the bytes received, or None
+        """
+        buffer_size = len(self.transfer_buffer)
+        remaining = length
+        while remaining > 0:
+            received = self.connection.recv_into(self.transfer_buffer, min(remaining, buffer_size))
+            if received == 0:
+                raise ConnectionError("Connection closed with {:,} of {:,} bytes still to receive".format(remaining,
+                                                                                                         length))
+            binary_file.write(self.transfer_buffer[:received])
+            if digest is not None:
+                digest.update(self.transfer_buffer[:received])
+            remaining -= received
+            self.bytes_received += received
+            # Waiting before the next read lets the client's sends back up, TCP slows it down to the limit
+            self.throttle(received)
+
+    def receive_chunks_into_file(self, binary_file, digest=None):
+        """
+        Streams protocol version 2 chunks into a file until the empty chunk that ends them.
+        :param binary_file: A PartialFile or a file opened for binary writing
+        :param digest: A hashlib object to update with the (decompressed) bytes received, or None
+        :return: The total number of bytes received
+        """
+        amount_received = 0
+        while True:
+            flags, chunk_length = CHUNK_HEADER.unpack(self.receive_exactly(CHUNK_HEADER.size))
+            if chunk_length == 0:
+                return amount_received
+            if flags == CHUNK_FLAGS_NONE:
+                self.receive_into_file(binary_file, chunk_length, digest)
+                amount_received += chunk_length
+            elif flags == CHUNK_FLAGS_COMPRESSED and self.codec is not None:
+                chunk = ftp_protocol.receive_compressed_chunk(self.connection, self.codec, chunk_length)
+                self.bytes_received += chunk_length
+                self.throttle(chunk_length)
+                binary_file.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                amount_received += len(chunk)
+            else:
+                raise ConnectionAbortedError("Received chunk with unsupported flags {:#x}".format(flags))
+
+    def send_file_chunks(self, binary_file, offset, length, digest=None):
+        """
+        Sends part of a file as protocol version 2 chunks, followed by the empty chunk that ends them. Chunks are sent
+        back to back without waiting for the client.
+        :param binary_file: A StoredFile
+        :param offset: The position in the file to start from
+        :param length: The number of bytes to send
+        :param digest: A hashlib object to update with the bytes sent, or None
+        """
+        chunk_size = len(self.transfer_buffer)
+        compress = CODECS[self.codec][0] if self.codec is not None else None
+        if compress is not None:
+            chunk_size = min(chunk_size, MAX_COMPRESSED_CHUNK_SIZE)
+        for chunk_offset in range(offset, offset + length, chunk_size):
+            chunk_length = min(offset + length - chunk_offset, chunk_size)
+            if compress is None and digest is None:
+                self.connection.sendall(CHUNK_HEADER.pack(CHUNK_FLAGS_NONE, chunk_length))
+                self.send_file_contents(binary_file, chunk_offset, chunk_length)
+                continue
+
+            # Compressing or hashing means reading the chunk ourselves rather than leaving it to sendfile()
+            chunk = self.transfer_buffer[:binary_file.readinto(chunk_offset, self.transfer_buffer[:chunk_length])]
+            if len(chunk) != chunk_length:
+                raise ConnectionAbortedError("File was truncated after {:,} of {:,} bytes".format(
+                    chunk_offset + len(chunk), offset + length))
+            if digest is not None:
+                digest.update(chunk)
+            if compress is not None:
+                compressed_chunk = compress(chunk)
+                if chunk_offset == offset and len(compressed_chunk) > chunk_length * COMPRESSION_SKIP_RATIO:
+                    vprint("First chunk only compressed to {:,} of {:,} bytes, sending the rest uncompressed".format(
+                        len(compressed_chunk), chunk_length))
+                    compress = None
+                if len(compressed_chunk) < chunk_length:
+                    self.throttle(len(compressed_chunk))
+                    ftp_protocol.send_parts(self.connection, [
+                        CHUNK_HEADER.pack(CHUNK_FLAGS_COMPRESSED, len(compressed_chunk)), compressed_chunk])
+                    self.bytes_sent += len(compressed_chunk)
+                    continue
+            self.throttle(chunk_length)
+            ftp_protocol.send_parts(self.connection, [CHUNK_HEADER.pack(CHUNK_FLAGS_NONE, chunk_length), chunk])
+            self.bytes_sent += chunk_length
+        self.connection.sendall(CHUNK_HEADER.pack(CHUNK_FLAGS_NONE, 0))
+
+    def compute_digest(self, binary_file, file_name):
+        """
+        Gets the digest of a whole file, from the storage or the server's cache if it is there or by reading the file
+        through the transfer buffer otherwise.
+        :param binary_file: A StoredFile
+        :param file_name: The name of the file, for the cache
+        :return: The digest as bytes
+        """
+        cached_digest = binary_file.digest or self.server.get_digest(file_name, binary_file.stat)
+        if cached_digest is not None:
+            return cached_digest
+
+        digest = hashlib.new(DIGEST_ALGORITHM)
+        offset = 0
+        while True:
+            amount_read = binary_file.readinto(offset, self.transfer_buffer)
+            if not amount_read:
+                break
+            digest.update(self.transfer_buffer[:amount_read])
+            offset += amount_read
+        self.server.set_digest(file_name, binary_file.stat, digest.digest())
+        return digest.digest()
+
+    def send_file_contents(self, binary_file, offset, length):
+        """
+        Sends the given number of bytes from a file. Uses sendfile() where possible so the kernel copies the file
+        straight to the socket, otherwise reads it through the session's transfer buffer.
+        :param binary_file: A StoredFile
+        :param offset: The position in the file to start from
+        :param length: The number of bytes to send
+        """
+        if self.server.shaper is not None:
+            buffer_size = len(self.transfer_buffer)
+            if length > buffer_size:
+                # Send a transfer buffer at a time, so the rate limits can take turns between sessions
+                for piece_offset in range(offset, offset + length, buffer_size):
+                    self.send_file_contents(binary_file, piece_offset, min(offset + length - piece_offset, buffer_size))
+                return
+            self.throttle(length)
+        if binary_file.contents is not None:
+            # Held in memory, so there is no file on disk for sendfile() to read
+            self.connection.sendall(binary_file.contents[offset:offset + length])
+            self.bytes_sent += length
+            return
+        amount_sent = 0
+        for extent_file, extent_offset, extent_length in binary_file.extents(offset, length):
+            if self.server.use_sendfile and hasattr(os, "sendfile"):
+                extent_sent = self.connection.sendfile(extent_file, extent_offset, extent_length)
+            else:
+                extent_sent = self.send_file_contents_chunked(extent_file, extent_offset, extent_length)
+            amount_sent += extent_sent
+            self.bytes_sent += extent_sent
+            if extent_sent != extent_length:
+                break
+        if amount_sent != length:
+            # The file shrank underneath us, the client is still waiting for the rest so the session cannot continue
+            raise ConnectionAbortedError("File was truncated after {:,} of {:,} bytes".format(offset + amount_sent,
+                                                                                            offset + length))
+
+    def send_file_contents_chunked(self, binary_file, offset, length):
+        """
+        Sends up to the given number of bytes from a file one transfer buffer at a time.
+        :param binary_file: A file opened for binary reading
+        :param offset: The position in the file to start from
+        :param length: The number of bytes to send
+        :return: The number of bytes actually sent
+        """
+        buffer_size = len(self.transfer_buffer)
+        binary_file.seek(offset)
+        amount_sent = 0
+        while amount_sent < length:
+            amount_read = binary_file.readinto(self.transfer_buffer[:min(length - amount_sent, buffer_size)])
+            if not amount_read:
+                break
+            self.connection.sendall(self.transfer_buffer[:amount_read])
+            amount_sent += amount_read
+        return amount_sent
 
     def handle_hello(self):
         """
-        Handles the HELO command by sending back the HELLO_CHECK message.
+        Handles the HELO command by sending back the HELLO_CHECK message. Newer clients follow HELLO_CHECK with JSON
+        options asking for a protocol version, and are answered in kind with the version this session will use.
         """
         data = self.receive_data(True)
-        if data != HELLO_CHECK:
+        hello_check, separator, options = data.partition(HELLO_OPTIONS_SEPARATOR)
+        if hello_check != HELLO_CHECK:
             vprint("HELLO_CHECK mismatch. Expected '{}' but received '{}'".format(HELLO_CHECK, data))
             self.send_data(b"MISMATCH", "long")
-        else:
-            vprint("HELLO_CHECK match.")
+        elif not separator:
+            vprint("HELLO_CHECK match, using protocol version 1.")
+            self.protocol_version = 1
             self.send_data(HELLO_CHECK, "long")
-        print("Connected to client.")
-        self.listen_for_command()
+        else:
+            try:
+                requested_options = json.loads(options.decode("utf-8"))
+                requested_version = int(requested_options.get("version", 1))
+                requested_features = set(requested_options.get("features", []))
+                requested_codecs = list(requested_options.get("codecs", []))
+            except (ValueError, TypeError, AttributeError) as e:
+                vprint("Invalid HELO options {!r}: {}".format(options, e))
+                requested_version = 1
+                requested_features = set()
+                requested_codecs = []
+            self.protocol_version = max(1, min(requested_version, PROTOCOL_VERSION))
+            if self.protocol_version >= 2:
+                self.features = requested_features.intersection(SUPPORTED_FEATURES)
+                if not self.server.storage.deduplicates:
+                    self.features.difference_update(DEDUPLICATION_FEATURES)
+                if self.server.use_compression:
+                    # Codecs are listed in the client's order of preference
+                    self.codec = next((codec for codec in requested_codecs if codec in CODECS), None)
+            vprint("HELLO_CHECK match, using protocol version {} with features {} and codec {}.".format(
+                self.protocol_version, sorted(self.features), self.codec))
+            accepted_options = json.dumps({"version": self.protocol_version,
+                                           "features": sorted(self.features),
+                                           "codec": self.codec}).encode("utf-8")
+            self.send_data(HELLO_CHECK + HELLO_OPTIONS_SEPARATOR + accepted_options, "long")
+        print("Connected to client {}.".format(self.client_address))
 
     def handle_upload(self):
         """
@@ -191,83 +779,374 @@ class FTPServer:
         # Receive the file name
         file_name = self.receive_data(data_length_size="short").decode("utf-8")
         vprint("Received file name: {}".format(file_name))
+        resume_key = ""
+        if "resume-check" in self.features:
+            resume_key = self.receive_data(data_length_size="short").decode("utf-8")
+            if len(resume_key) > MAX_RESUME_KEY_LENGTH:
+                raise ConnectionAbortedError("Received a resume key of {:,} characters".format(len(resume_key)))
 
         # Acknowledge that we're ready to receive the file contents
         self.send_data("READY FOR UPLOAD")
         vprint("Acknowledging ready for upload...")
 
-        # Receive the file contents
+        # An interrupted upload leaves what it received in a partial file, to be resumed
+        partial_name = self.server.storage.partial_path(file_name, resume_key)
+        partial_size = 0
+        if "resume" in self.features:
+            # Tell the client how much of an earlier attempt we already hold, it decides where to continue from
+            if os.path.isfile(partial_name):
+                partial_size = os.path.getsize(partial_name)
+            vprint("Holding {:,} bytes of {}".format(partial_size, partial_name))
+            self.send_data_number(partial_size, "quad")
+            if "resume-check" in self.features:
+                # Let the client check that the bytes we hold are the start of the file it is sending now
+                prefix_digest = b""
+                if partial_size > 0:
+                    with LocalFile(partial_name) as partial_file:
+                        prefix_digest = self.digest_prefix(partial_file, partial_size)
+                self.send_data(prefix_digest, "short")
+
+        # Receive the file contents, writing them to disk as they arrive
         print("Receiving {}...".format(file_name))
-        file_contents = self.receive_data(data_length_size="long")
-        vprint("Received file contents, size {:,} bytes".format(len(file_contents)))
+        if self.protocol_version >= 2:
+            file_size = self.receive_data_number("quad")
+            offset = self.receive_data_number("quad") if "resume" in self.features else 0
+            if not 0 <= offset <= partial_size:
+                raise ConnectionAbortedError("Client asked to resume {} at byte {:,} but only {:,} are held".format(
+                    file_name, offset, partial_size))
+            vprint("Receiving file contents in chunks, size {:,} bytes from byte {:,}".format(file_size, offset))
+            digest = hashlib.new(DIGEST_ALGORITHM) if "digest" in self.features else None
+            expected_digest = None
+            with self.open_partial_file(partial_name, file_size, offset) as binary_file:
+                amount_received = offset + self.receive_chunks_into_file(binary_file, digest)
+                if digest is not None:
+                    # The client follows the chunks with its digest of the bytes it sent
+                    expected_digest = self.receive_data(data_length_size="short")
+        else:
+            offset = 0
+            digest = None
+            expected_digest = None
+            file_size = self.receive_data_number("long")
+            vprint("Receiving file contents, size {:,} bytes".format(file_size))
+            # Version 1 cannot resume, so an interrupted upload is not kept
+            with self.open_partial_file(partial_name, file_size, resumable=False) as binary_file:
+                self.receive_into_file(binary_file, file_size)
+            amount_received = file_size
 
-        # Write the file contents to disk
-        with open(file_name, "wb") as binary_file:
-            binary_file.write(file_contents)
+        self.finish_upload(file_name, binary_file, file_size, amount_received, offset, digest, expected_digest, t0)
 
+    def finish_upload(self, file_name, partial_file, file_size, amount_received, offset, digest, expected_digest, t0):
+        """
+        Checks a received upload, stores it if it arrived intact and sends the results to the client.
+        :param file_name: The name of the file
+        :param partial_file: The closed PartialFile the contents were written to
+        :param file_size: The size the client said the file is
+        :param amount_received: The size of the partial file
+        :param offset: The byte the upload resumed from
+        :param digest: A hashlib object updated with the bytes received, or None
+        :param expected_digest: The client's digest of the bytes it sent, or None
+        :param t0: The time the upload started
+        """
         # Stop the timer
         t1 = time.time()
         time_diff = round(t1 - t0, 3)
 
-        results = "Received {} ({:,} bytes) in {:,} seconds.".format(file_name, len(file_contents), time_diff)
+        if amount_received != file_size:
+            partial_file.abandon()
+            results = "Error: Expected {:,} bytes of {} but received {:,}.".format(file_size, file_name,
+                                                                                 amount_received)
+        elif digest is not None and digest.digest() != expected_digest:
+            # What was received can't be trusted to resume from either
+            os.remove(partial_file.writing_path)
+            results = "Error: {} was corrupted in transit, its {} digest does not match.".format(file_name,
+                                                                                             DIGEST_ALGORITHM)
+        else:
+            durable = self.server.durability == "close"
+            stored_digest = self.server.storage.commit_file(partial_file.writing_path, file_name, durable)
+            try:
+                # Whatever an earlier attempt left to resume from is no use now
+                os.remove(partial_file.path)
+            except FileNotFoundError:
+                pass
+            self.server.file_changed(file_name)
+            if digest is not None and offset == 0:
+                stored_digest = digest.digest()
+            if stored_digest is not None:
+                self.server.set_digest(file_name, self.server.storage.stat(file_name), stored_digest)
+            results = "Received {} ({:,} bytes) in {:,} seconds.".format(file_name, file_size, time_diff)
+            if offset > 0:
+                results += " Resumed from byte {:,}.".format(offset)
         print(results)
 
         # Send back transfer process results
         self.send_data(results)
 
-        vprint("Calling self.listen_for_command() from self.handle_upload()")
-        self.listen_for_command()
+    def handle_multi_upload(self):
+        """
+        Receives a batch of uploads. The client sends the number of files, then each file's name, size and contents
+        without waiting, and is sent the results for each file in turn. Batched uploads are never resumed.
+        """
+        file_count = self.receive_data_number("long")
+        print("Receiving a batch of {:,} files...".format(file_count))
+        for i in range(file_count):
+            t0 = time.time()
+            file_name = self.receive_data(data_length_size="short").decode("utf-8")
+            vprint("Received file name: {}".format(file_name))
+            file_size = self.receive_data_number("quad")
 
-    def handle_download(self):
+            partial_name = self.server.storage.partial_path(file_name)
+            digest = hashlib.new(DIGEST_ALGORITHM) if "digest" in self.features else None
+            with self.open_partial_file(partial_name, file_size, resumable=False) as binary_file:
+                amount_received = self.receive_chunks_into_file(binary_file, digest)
+                expected_digest = self.receive_data(data_length_size="short") if digest is not None else None
+            self.finish_upload(file_name, binary_file, file_size, amount_received, 0, digest, expected_digest, t0)
+
+    def handle_multi_download(self):
         """
-        Receives a download request from the client.
+        Receives a batch of download requests. The client sends the number of files, then a DWLD request for each one,
+        and is sent each reply in turn.
         """
-        # Receive the file name
+        file_count = self.receive_data_number("long")
+        print("Sending a batch of {:,} files...".format(file_count))
+        for i in range(file_count):
+            self.handle_download()
+
+    def handle_multi_delete(self):
+        """
+        Deletes a batch of files. The client asks its user for confirmation before sending the batch, so each file is
+        deleted straight away and answered with 1, or -1 if it was not found.
+        """
+        file_count = self.receive_data_number("long")
+        print("Client requested to delete a batch of {:,} files.".format(file_count))
+        for i in range(file_count):
+            file_name = self.receive_data(data_length_size="short").decode("utf-8")
+            vprint("Received file name: {}".format(file_name))
+            try:
+                self.server.storage.delete_file(file_name)
+                self.server.file_changed(file_name)
+            except (FileNotFoundError, IsADirectoryError) as e:
+                vprint(e)
+                print("Client requested to delete '{}', but it was not found on the server.".format(file_name))
+                self.send_data_number(-1, "long")
+                continue
+            print("Deleted {}.".format(file_name))
+            self.send_data_number(1, "long")
+
+    def handle_delta_upload(self):
+        """
+        Receives a delta upload request from the client, rebuilding the file from literal data and blocks of the copy
+        already on the server.
+        """
+        # Start the timer
+        t0 = time.time()
+
+        # Receive the file name and the size of the client's file
         file_name = self.receive_data(data_length_size="short").decode("utf-8")
         vprint("Received file name: {}".format(file_name))
-        # print("Client requested to download {}".format(file_name))
+        file_size = self.receive_data_number("quad")
 
-        file_exists = os.path.isfile(file_name)
-        vprint("{} exists: {}".format(file_name, file_exists))
-        if file_exists:
-            # Send the file size
-            file_size = os.path.getsize(file_name)
-            vprint("File size: {:,}".format(file_size))
-            self.send_data_number(file_size, "long")
+        try:
+            basis_file = self.server.storage.open_file(file_name)
+        except (FileNotFoundError, IsADirectoryError) as e:
+            vprint(e)
+            basis_file = None
+        if basis_file is None or basis_file.size == 0:
+            # Send a -1 to say there is nothing to build on, the client falls back to UPLD
+            print("Client requested a delta upload of {} but there is no copy to update.".format(file_name))
+            self.send_data_number(-1, "quad")
+            if basis_file is not None:
+                basis_file.close()
+            return
 
-            # Read the file contents and send them
-            try:
-                with open(file_name, "rb") as binary_file:
-                    # Read the whole file at once
-                    file_contents = binary_file.read()
-                    vprint("Printing file contents... {}".format(file_contents))
-
-                    # Send the file contents using connection.sendall as we have already sent the data length
-                    self.connection.sendall(file_contents)
-                    print("Client downloaded {}.".format(file_name))
-            except FileNotFoundError as e:
-                vprint(e)
-                print("Error: File '{}' not found.".format(file_name))
+        partial_name = self.server.storage.partial_path(file_name)
+        digest = hashlib.new(DIGEST_ALGORITHM)
+        with basis_file:
+            # Send the signatures of our copy
+            basis_size = basis_file.size
+            block_size = delta_block_size(basis_size)
+            signatures = bytearray()
+            for block_offset in range(0, basis_size, block_size):
+                block = basis_file.read(block_offset, block_size)
+                strong_checksum = hashlib.blake2b(block, digest_size=DELTA_STRONG_DIGEST_SIZE).digest()
+                signatures += DELTA_SIGNATURE.pack(zlib.adler32(block), strong_checksum)
+            block_count = len(signatures) // DELTA_SIGNATURE.size
+            vprint("Sending {:,} signatures of {:,} byte blocks of {}".format(block_count, block_size, file_name))
+            self.send_data_number(basis_size, "quad")
+            self.send_data_number(block_size, "long")
+            self.send_data(bytes(signatures), "long")
+
+            # Rebuild the file in a partial file from literal chunks and block references, until an empty chunk
+            print("Receiving changes to {}...".format(file_name))
+            amount_received = 0
+            literal_size = 0
+            # A half-built file is no use for resuming an upload
+            with self.open_partial_file(partial_name, file_size, resumable=False) as binary_file:
+                while True:
+                    flags, chunk_length = CHUNK_HEADER.unpack(self.receive_exactly(CHUNK_HEADER.size))
+                    if flags == CHUNK_FLAGS_NONE:
+                        if chunk_length == 0:
+                            break
+                        self.receive_into_file(binary_file, chunk_length, digest)
+                        amount_received += chunk_length
+                        literal_size += chunk_length
+                    elif flags == CHUNK_FLAGS_BLOCK:
+                        # The length field holds the index of one of our blocks
+                        if chunk_length >= block_count:
+                            raise ConnectionAbortedError("Client referred to block {:,} of {} but there are only "
+                                                         "{:,}".format(chunk_length, file_name, block_count))
+                        block = basis_file.read(chunk_length * block_size, block_size)
+                        binary_file.write(block)
+                        digest.update(block)
+                        amount_received += len(block)
+                    else:
+                        raise ConnectionAbortedError("Received chunk with unsupported flags {:#x}".format(flags))
+                # The client follows the chunks with the digest of its whole file
+                expected_digest = self.receive_data(data_length_size="short")
 
+        # Stop the timer
+        t1 = time.time()
+        time_diff = round(t1 - t0, 3)
+
+        if amount_received != file_size or digest.digest() != expected_digest:
+            binary_file.abandon()
+            results = "Error: {} was not rebuilt correctly, its {} digest does not match.".format(file_name,
+                                                                                                DIGEST_ALGORITHM)
         else:
+            self.server.storage.commit_file(binary_file.writing_path, file_name, self.server.durability == "close")
+            self.server.file_changed(file_name)
+            self.server.set_digest(file_name, self.server.storage.stat(file_name), digest.digest())
+            results = "Received {} ({:,} bytes, {:,} sent as changes) in {:,} seconds.".format(
+                file_name, file_size, literal_size, time_diff)
+        print(results)
+
+        # Send back transfer process results
+        self.send_data(results)
+
+    def handle_download(self):
+        """
+        Receives a download request from the client.
+        """
+        # Receive the file name, then the offset to start from with resume or range, and the number of bytes wanted
+        # with range (-1 for the rest of the file)
+        file_name = self.receive_data(data_length_size="short").decode("utf-8")
+        vprint("Received file name: {}".format(file_name))
+        sends_offset = "resume" in self.features or "range" in self.features
+        requested_offset = self.receive_data_number("quad") if sends_offset else 0
+        requested_length = self.receive_data_number("quad") if "range" in self.features else -1
+        # With resume-check, the client sends its digest of the bytes before the offset, or nothing to skip the check
+        prefix_digest = self.receive_data(data_length_size="short") if "resume-check" in self.features else b""
+        size_length = "quad" if self.protocol_version >= 2 else "long"
+
+        # Open the file before announcing its size, so it cannot disappear between the two
+        try:
+            binary_file = self.server.open_for_download(file_name)
+        except (FileNotFoundError, IsADirectoryError) as e:
+            vprint(e)
             # Send a -1 to say the file doesn't exist
             print("Error: Client requested to download {} but it does not exist.".format(file_name))
-            self.send_data_number(-1, "long")
+            self.send_data_number(-1, size_length)
+            return
+
+        with binary_file:
+            file_size = binary_file.size
+            vprint("File size: {:,}".format(file_size))
 
-        self.listen_for_command()
+            if self.protocol_version >= 2:
+                # Send the file size, then the file contents in chunks
+                self.send_data_number(file_size, "quad")
+                offset = 0
+                if sends_offset:
+                    # Start over if the client holds more than the file now has, it must have changed
+                    offset = requested_offset if 0 <= requested_offset <= file_size else 0
+                    if offset > 0 and prefix_digest and prefix_digest != self.digest_prefix(binary_file, offset):
+                        vprint("Client's first {:,} bytes of {} differ from ours".format(offset, file_name))
+                        offset = 0
+                    self.send_data_number(offset, "quad")
+                length = file_size - offset
+                if 0 <= requested_length < length:
+                    length = requested_length
+                vprint("Sending {:,} bytes from byte {:,}".format(length, offset))
+                if "digest" not in self.features:
+                    self.send_file_chunks(binary_file, offset, length)
+                else:
+                    # Follow the chunks with the digest of the bytes sent. A known digest of the whole file lets it go
+                    # out through sendfile() without being read, otherwise it is hashed on the way through.
+                    cached_digest = None
+                    if offset == 0 and length == file_size:
+                        cached_digest = binary_file.digest or self.server.get_digest(file_name, binary_file.stat)
+                    if cached_digest is not None:
+                        self.send_file_chunks(binary_file, offset, length)
+                        self.send_data(cached_digest, "short")
+                    else:
+                        digest = hashlib.new(DIGEST_ALGORITHM)
+                        self.send_file_chunks(binary_file, offset, length, digest)
+                        if offset == 0 and length == file_size:
+                            self.server.set_digest(file_name, binary_file.stat, digest.digest())
+                        self.send_data(digest.digest(), "short")
+            elif file_size > V1_MAX_FILE_SIZE:
+                print("Error: {} is too large to send with protocol version 1.".format(file_name))
+                self.send_data_number(-1, "long")
+                return
+            else:
+                # Send the file size, then the file contents. No further framing is needed as we have already sent the
+                # data length.
+                self.send_data_number(file_size, "long")
+                self.send_file_contents(binary_file, 0, file_size)
+            print("Client downloaded {}.".format(file_name))
 
     def handle_list(self):
         """
-        Sends a list of files in the current working directory to the client.
+        Sends a list of the files in storage to the client.
         """
         print("Client requested list of files in directory.")
-        files = json.dumps(os.listdir())
+        files = json.dumps(self.server.get_listing())
         vprint(files)
 
         # Send the list of files as JSON
         self.send_data(files, "long")
 
-        self.listen_for_command()
+    def handle_list_detailed(self):
+        """
+        Sends one page of a listing of the files in storage with their metadata. The client sends a prefix to filter
+        names by, the cursor from the previous page (empty for the first), the most entries it wants and whether to
+        include digests. The page is sent as JSON with the cursor for the next page, which is null after the last.
+        """
+        prefix = self.receive_data(data_length_size="short").decode("utf-8")
+        cursor = self.receive_data(data_length_size="short").decode("utf-8")
+        page_size = min(max(self.receive_data_number("long"), 1), MAX_LIST_PAGE_SIZE)
+        with_digests = self.receive_data_number("long") == 1
+        vprint("Listing page of {} entries after {!r} with prefix {!r}".format(page_size, cursor, prefix))
+
+        # Carry on from just after the cursor, which still works if the listing has changed since the last page
+        listing = self.server.get_listing()
+        if cursor:
+            start = bisect.bisect_right(listing, cursor)
+        else:
+            start = bisect.bisect_left(listing, prefix)
+
+        entries = []
+        index = start
+        while index < len(listing) and len(entries) < page_size and listing[index].startswith(prefix):
+            file_name = listing[index]
+            index += 1
+            try:
+                size, mtime, is_directory = self.server.storage.describe(file_name)
+            except FileNotFoundError:
+                # Deleted since the listing was built
+                continue
+            entry = {"name": file_name, "size": size, "mtime": mtime, "type": "dir" if is_directory else "file"}
+            if with_digests and not is_directory:
+                try:
+                    with self.server.storage.open_file(file_name) as binary_file:
+                        entry["digest"] = self.compute_digest(binary_file, file_name).hex()
+                except FileNotFoundError:
+                    continue
+            entries.append(entry)
+
+        if not cursor:
+            print("Client requested detailed list of files in directory.")
+        more = index < len(listing) and listing[index].startswith(prefix)
+        self.send_data(json.dumps({"entries": entries, "cursor": listing[index - 1] if more else None}), "long")
 
     def handle_delete(self):
         """
@@ -277,20 +1156,23 @@ class FTPServer:
         file_name = self.receive_data(data_length_size="short").decode("utf-8")
         vprint("Received file name: {}".format(file_name))
 
-        file_exists = os.path.isfile(file_name)
+        file_exists = self.server.storage.exists(file_name)
         vprint("{} exists: {}".format(file_name, file_exists))
 
         if file_exists:
             print("Client requested to delete '{}', awaiting confirmation...".format(file_name))
             self.send_data_number(1, "long")
 
-            # Get confirmation from the user to delete the file
+            # Get confirmation from the user to delete the file, who may take as long as between commands
+            self.connection.settimeout(self.server.idle_timeout)
             confirmation = self.receive_data(data_length_size="long").decode("utf-8")
+            self.connection.settimeout(self.server.read_timeout)
             vprint("User confirmation = {}".format(confirmation))
 
             if confirmation == "Y":
                 # Delete the file
-                os.remove(file_name)
+                self.server.storage.delete_file(file_name)
+                self.server.file_changed(file_name)
                 print("Deleted {}.".format(file_name))
             elif confirmation == "N":
                 print("Client aborted file delete.")
@@ -301,13 +1183,400 @@ class FTPServer:
             print("Client requested to delete '{}', but it was not found on the server.".format(file_name))
             self.send_data_number(-1, "long")
 
-        self.listen_for_command()
+    def handle_stat(self):
+        """
+        Handles the STAT command by sending the server's metrics as JSON: how many times each command has been served,
+        how many failed, the file contents they moved and their latency percentiles.
+        """
+        self.send_data(json.dumps(self.server.metrics.snapshot()), "long")
+
+    def handle_hash(self):
+        """
+        Sends the size and digest of a file, so the client can check its own copy without downloading it.
+        """
+        # Receive the file name
+        file_name = self.receive_data(data_length_size="short").decode("utf-8")
+        vprint("Received file name: {}".format(file_name))
+
+        try:
+            binary_file = self.server.storage.open_file(file_name)
+        except (FileNotFoundError, IsADirectoryError) as e:
+            vprint(e)
+            # Send a -1 to say the file doesn't exist
+            print("Error: Client requested the digest of {} but it does not exist.".format(file_name))
+            self.send_data_number(-1, "quad")
+            return
+
+        with binary_file:
+            file_size = binary_file.size
+            digest = self.compute_digest(binary_file, file_name)
+        print("Client requested the digest of {}.".format(file_name))
+        self.send_data_number(file_size, "quad")
+        self.send_data(digest, "short")
+
+    def handle_have(self):
+        """
+        Checks whether the server already stores the contents of a file the client is about to upload. If it does, the
+        contents are stored under the client's file name straight away and the upload can be skipped.
+        """
+        # Receive the file name, then the size and digest of its contents
+        file_name = self.receive_data(data_length_size="short").decode("utf-8")
+        vprint("Received file name: {}".format(file_name))
+        file_size = self.receive_data_number("quad")
+        digest = self.receive_data(data_length_size="short")
+
+        if self.server.storage.link_content(file_name, file_size, digest, self.server.durability == "close"):
+            self.server.file_changed(file_name)
+            print("Stored {} ({:,} bytes) from content already held.".format(file_name, file_size))
+            self.send_data_number(1, "long")
+        else:
+            vprint("Contents of {} not held".format(file_name))
+            self.send_data_number(0, "long")
 
     def handle_quit(self):
-        print("Client disconnected.")
+        print("Client {} disconnected.".format(self.client_address))
         self.close_connection()
-        self.initialise_socket()
-        self.listen()
+
+
+class AsyncFTPServer:
+    """
+    Serves the same protocol as FTPServer from a single asyncio event loop. Each connection is a coroutine rather than
+    a thread, so thousands of mostly idle control connections can share one process.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, buffer_size=DEFAULT_TRANSFER_BUFFER_SIZE, use_sendfile=True,
+                 reuse_port=False, durability="none", sync_interval=DEFAULT_SYNC_INTERVAL):
+        vprint("AsyncFTPServer constructor was called")
+
+        self.port = port
+        self.reuse_port = reuse_port
+        self.buffer_size = buffer_size
+        self.use_sendfile = use_sendfile
+        self.storage = DirectoryStorage()
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.metrics = ServerMetrics()
+
+    def listen(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, "localhost", self.port, limit=self.buffer_size,
+                                            reuse_address=True, reuse_port=self.reuse_port or None,
+                                            backlog=socket.SOMAXCONN)
+        self.port = server.sockets[0].getsockname()[1]
+        print("Server listening on port {} (asyncio)".format(self.port))
+
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        vprint("Connection from {}".format(client_address))
+        session = AsyncFTPSession(self, reader, writer, client_address)
+        self.metrics.session_started()
+        try:
+            await session.listen_for_commands()
+        except (asyncio.IncompleteReadError, OSError) as e:
+            print("Error: Connection to {} failed: {}".format(client_address, e))
+        except Exception:
+            print("Error: Session with {} failed:".format(client_address))
+            traceback.print_exc()
+        finally:
+            writer.close()
+            self.metrics.session_ended()
+
+
+class AsyncFTPSession:
+    """
+    One client connection on the asyncio engine. Mirrors FTPSession, but every read uses readexactly() so a frame is
+    never returned short.
+    """
+
+    def __init__(self, server, reader, writer, client_address):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = client_address
+        self.command_handlers = {
+            "HELO": self.handle_hello,
+            "UPLD": self.handle_upload,
+            "LIST": self.handle_list,
+            "DWLD": self.handle_download,
+            "DELF": self.handle_delete,
+        }
+
+    async def listen_for_commands(self):
+        """
+        Reads and dispatches commands until the client quits or disconnects.
+        """
+        while True:
+            try:
+                command = (await self.reader.readexactly(4)).decode("utf-8")
+            except asyncio.IncompleteReadError:
+                # The client went away between commands
+                print("Client {} disconnected.".format(self.client_address))
+                return
+            vprint("Received command: {!r}".format(command))
+
+            if command == "QUIT":
+                print("Client {} disconnected.".format(self.client_address))
+                return
+            handler = self.command_handlers.get(command)
+            if handler is None:
+                print("Error: Client {} sent unknown command {!r}.".format(self.client_address, command))
+                return
+
+            t0 = time.perf_counter()
+            failed = True
+            try:
+                await handler()
+                failed = False
+            finally:
+                self.server.metrics.record_command(command, time.perf_counter() - t0, failed=failed)
+
+    async def receive_number(self, data_length_size="long"):
+        """
+        Receives a big-endian signed number.
+        :param data_length_size: Either "long" or "short" to specify whether the number is given as 4 or 2 bytes
+        :return: The number as an int
+        """
+        raw = await self.reader.readexactly(DATA_LENGTH_SIZES[data_length_size])
+        return ftp_protocol.decode_number(raw, data_length_size)
+
+    async def receive_data(self, data_length_size="long"):
+        """
+        Receives variable-length data prefixed with its length.
+        :param data_length_size: Either "long" or "short" to specify whether the data length is given as 4 or 2 bytes
+        :return: The data as bytes
+        """
+        data_length = await self.receive_number(data_length_size)
+        return await self.reader.readexactly(data_length)
+
+    async def send_data(self, data, data_length_size="long"):
+        """
+        Sends variable-length data prefixed with its length.
+        :param data: The data to send, as bytes or str
+        :param data_length_size: Either "long" or "short" to specify whether the data length is given as 4 or 2 bytes
+        """
+        if type(data) != bytes:
+            data = bytes(data, "utf-8")
+        self.writer.writelines([ftp_protocol.encode_number(len(data), data_length_size), data])
+        await self.writer.drain()
+
+    async def send_data_number(self, number, data_length_size="long"):
+        """
+        Sends a big-endian signed number.
+        :param number: The number to send
+        :param data_length_size: Either "long" or "short" to specify whether the number is given as 4 or 2 bytes
+        """
+        self.writer.write(ftp_protocol.encode_number(number, data_length_size))
+        await self.writer.drain()
+
+    async def handle_hello(self):
+        """
+        Handles the HELO command by sending back the HELLO_CHECK message.
+        """
+        data = await self.receive_data("long")
+        # Options asking for a newer protocol version are ignored, a plain reply tells the client to use version 1
+        if data.partition(HELLO_OPTIONS_SEPARATOR)[0] != HELLO_CHECK:
+            vprint("HELLO_CHECK mismatch. Expected '{}' but received '{}'".format(HELLO_CHECK, data))
+            await self.send_data(b"MISMATCH", "long")
+        else:
+            vprint("HELLO_CHECK match.")
+            await self.send_data(HELLO_CHECK, "long")
+        print("Connected to client {}.".format(self.client_address))
+
+    async def handle_upload(self):
+        """
+        Receives an upload request from the client.
+        """
+        t0 = time.time()
+
+        file_name = (await self.receive_data("short")).decode("utf-8")
+        vprint("Received file name: {}".format(file_name))
+        await self.send_data("READY FOR UPLOAD")
+
+        # Stream the file contents to a partial file rather than holding them all in memory, so a client that goes
+        # away part way through never leaves a truncated file under the name
+        print("Receiving {}...".format(file_name))
+        file_size = await self.receive_number("long")
+        remaining = file_size
+        partial_name = self.server.storage.partial_path(file_name)
+        with PartialFile(partial_name, file_size, 0, self.server.durability, self.server.sync_interval,
+                         resumable=False) as binary_file:
+            while remaining > 0:
+                chunk = await self.reader.readexactly(min(remaining, self.server.buffer_size))
+                binary_file.write(chunk)
+                remaining -= len(chunk)
+        self.server.storage.commit_file(binary_file.writing_path, file_name, self.server.durability == "close")
+
+        time_diff = round(time.time() - t0, 3)
+        results = "Received {} ({:,} bytes) in {:,} seconds.".format(file_name, file_size, time_diff)
+        print(results)
+        await self.send_data(results)
+
+    async def handle_download(self):
+        """
+        Receives a download request from the client.
+        """
+        file_name = (await self.receive_data("short")).decode("utf-8")
+        vprint("Received file name: {}".format(file_name))
+
+        try:
+            binary_file = self.server.storage.open_file(file_name)
+        except (FileNotFoundError, IsADirectoryError) as e:
+            vprint(e)
+            print("Error: Client requested to download {} but it does not exist.".format(file_name))
+            await self.send_data_number(-1, "long")
+            return
+
+        with binary_file:
+            file_size = binary_file.size
+            if file_size > V1_MAX_FILE_SIZE:
+                print("Error: {} is too large to send with protocol version 1.".format(file_name))
+                await self.send_data_number(-1, "long")
+                return
+            await self.send_data_number(file_size, "long")
+            amount_sent = 0
+            for extent_file, extent_offset, extent_length in binary_file.extents(0, file_size):
+                extent_sent = await self.send_extent(extent_file, extent_offset, extent_length)
+                amount_sent += extent_sent
+                if extent_sent != extent_length:
+                    break
+            if amount_sent != file_size:
+                # The file shrank underneath us, the client cannot be resynchronised
+                raise ConnectionAbortedError("{} was truncated during download".format(file_name))
+        print("Client downloaded {}.".format(file_name))
+
+    async def send_extent(self, binary_file, offset, length):
+        """
+        Sends up to the given number of bytes from a file on disk.
+        :param binary_file: A file opened for binary reading
+        :param offset: The position in the file to start from
+        :param length: The number of bytes to send
+        :return: The number of bytes actually sent
+        """
+        if self.server.use_sendfile:
+            # Let the event loop use os.sendfile(), it falls back to reading the file itself where it cannot
+            return await asyncio.get_running_loop().sendfile(self.writer.transport, binary_file, offset, length)
+        binary_file.seek(offset)
+        amount_sent = 0
+        while amount_sent < length:
+            chunk = binary_file.read(min(length - amount_sent, self.server.buffer_size))
+            if not chunk:
+                break
+            self.writer.write(chunk)
+            await self.writer.drain()
+            amount_sent += len(chunk)
+        return amount_sent
+
+    async def handle_list(self):
+        """
+        Sends a list of files in the current working directory to the client, without partial uploads.
+        """
+        print("Client requested list of files in directory.")
+        await self.send_data(json.dumps(self.server.storage.list_files()), "long")
+
+    async def handle_delete(self):
+        """
+        Deletes a file from the server.
+        """
+        file_name = (await self.receive_data("short")).decode("utf-8")
+        vprint("Received file name: {}".format(file_name))
+
+        if not self.server.storage.exists(file_name):
+            print("Client requested to delete '{}', but it was not found on the server.".format(file_name))
+            await self.send_data_number(-1, "long")
+            return
+
+        print("Client requested to delete '{}', awaiting confirmation...".format(file_name))
+        await self.send_data_number(1, "long")
+        confirmation = (await self.receive_data("long")).decode("utf-8")
+        if confirmation == "Y":
+            self.server.storage.delete_file(file_name)
+            print("Deleted {}.".format(file_name))
+        elif confirmation == "N":
+            print("Client aborted file delete.")
+        else:
+            vprint("Received invalid confirmation: {}".format(confirmation))
+
+
+def supervise(processes, serve):
+    """
+    Runs a server in several worker processes, all listening on the same port, and restarts any that die. Each worker
+    has its own interpreter, so checksums, compression and framing for different sessions run on different cores.
+    Returns once the supervisor is told to stop with SIGINT or SIGTERM, after stopping the workers.
+    :param processes: The number of worker processes
+    :param serve: A function called with a worker's index in each worker process, which serves until it is killed
+    """
+    workers = {}
+    started = {}
+    stopping = []
+
+    def start_worker(index):
+        # Hold back SIGINT and SIGTERM until the worker has put back its own handlers, so the supervisor's handler
+        # never runs in the worker, where it would signal the worker's siblings from its copy of the pid table
+        signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+        try:
+            pid = os.fork()
+        except OSError:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+            raise
+        if pid == 0:
+            # The worker process: Ctrl-C in the terminal reaches it too, and SIGTERM from the supervisor just ends it.
+            # What it inherited of the supervisor's state is not its own to act on.
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            workers.clear()
+            started.clear()
+            del stopping[:]
+            exit_code = 0
+            try:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+                serve(index)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+        workers[pid] = index
+        started[index] = time.time()
+        print("Started worker process {} (pid {})".format(index, pid))
+
+    def stop(signal_number, frame):
+        if not stopping:
+            print("Stopping {} worker processes...".format(len(workers)))
+        stopping.append(signal_number)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for signal_number in STOP_SIGNALS:
+        signal.signal(signal_number, stop)
+    for index in range(processes):
+        start_worker(index)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+        exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        print("Error: Worker process {} (pid {}) exited with status {}, restarting it.".format(index, pid, exit_code))
+        if time.time() - started[index] < WORKER_MIN_LIFETIME:
+            time.sleep(WORKER_RESTART_DELAY)
+            if stopping:
+                break
+        start_worker(index)
 
 
 def main():
@@ -315,6 +1584,45 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", help="Enable verbose printing", action="store_true")
     parser.add_argument("-p", "--port", help="Specify a port to listen on", type=int)
+    parser.add_argument("-w", "--workers", "--max-connections", help="Number of sessions to serve concurrently",
+                        type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("-b", "--buffer-size", help="Bytes moved per socket read or write during file transfers",
+                        type=int, default=DEFAULT_TRANSFER_BUFFER_SIZE)
+    parser.add_argument("--no-sendfile", help="Serve downloads by reading files in chunks instead of sendfile()",
+                        action="store_true")
+    parser.add_argument("--no-compression", help="Refuse clients' requests to compress transfers",
+                        action="store_true")
+    parser.add_argument("-e", "--engine", help="Serve sessions from a thread pool or a single asyncio event loop",
+                        choices=ENGINES, default="threads")
+    parser.add_argument("--store", help="Keep files in a deduplicating content-addressed store in this directory "
+                                        "instead of the working directory", metavar="DIRECTORY")
+    parser.add_argument("--metrics-file", help="Write per-command counters and latencies to this file as JSON")
+    parser.add_argument("--metrics-interval", help="Seconds between writes of --metrics-file", type=float,
+                        default=DEFAULT_METRICS_INTERVAL)
+    parser.add_argument("--processes", help="Serve from this many worker processes sharing the port, restarting any "
+                                            "that die", type=int, default=1)
+    parser.add_argument("--durability", help="Leave writing uploads to disk to the operating system, sync each one "
+                                             "before storing it under its name, or sync every --sync-interval MiB as "
+                                             "it is received", choices=DURABILITY_POLICIES, default="none")
+    parser.add_argument("--sync-interval", help="MiB received between syncs with --durability periodic", type=float,
+                        default=DEFAULT_SYNC_INTERVAL / MEBIBYTE, metavar="MIB")
+    parser.add_argument("--max-rate", help="Limit file contents moved for all clients together to this many MiB per "
+                                           "second, shared fairly between busy sessions", type=float, metavar="MIB")
+    parser.add_argument("--session-rate", help="Limit file contents moved by each client to this many MiB per second",
+                        type=float, metavar="MIB")
+    parser.add_argument("--idle-timeout", help="Close sessions that send no command for this many seconds (default: "
+                                               "never)", type=float)
+    parser.add_argument("--read-timeout", help="Close sessions that stall part way through a command for this many "
+                                               "seconds, 0 to wait forever (default: {})".format(DEFAULT_READ_TIMEOUT),
+                        type=float)
+    parser.add_argument("--max-sessions", help="Turn clients away as busy when this many sessions are being served or "
+                                               "waiting for a worker", type=int)
+    parser.add_argument("--max-memory", help="Turn clients away as busy while the server uses more than this many MiB "
+                                             "of memory", type=float, metavar="MIB")
+    parser.add_argument("--cache-size", help="Keep the contents of recently downloaded files in memory, up to this "
+                                             "many MiB", type=float, default=0, metavar="MIB")
+    parser.add_argument("--cache-max-file-size", help="The largest file to cache, in MiB (default: a quarter of "
+                                                      "--cache-size)", type=float, metavar="MIB")
     args = parser.parse_args()
 
     # Global inits
@@ -339,10 +1647,130 @@ def main():
 
     vprint("main() called")
 
-    # Make server
-    server = FTPServer()
-    vprint("Made server")
-    server.listen()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    vprint("Arg workers was {}".format(args.workers))
+
+    vprint("Arg engine was {}".format(args.engine))
+    if args.buffer_size < 1:
+        parser.error("--buffer-size must be at least 1")
+    vprint("Arg buffer size was {}".format(args.buffer_size))
+
+    vprint("Arg no sendfile was {}".format(args.no_sendfile))
+    vprint("Arg no compression was {}".format(args.no_compression))
+
+    vprint("Arg store was {}".format(args.store))
+    if args.store is not None and args.engine == "asyncio":
+        parser.error("--store is not supported by the asyncio engine")
+    storage = None
+    if args.store is not None:
+        storage = BlobStorage(args.store)
+        # No session can be using the store yet, so this is the time to clear out what deleted files left behind
+        print("Using store: {} ({:,} unused files removed)".format(args.store, storage.collect_garbage()))
+    else:
+        # Likewise for the files uploads were being written to when the server last stopped
+        vprint("Removed {:,} unfinished uploads".format(DirectoryStorage().collect_garbage()))
+
+    vprint("Arg metrics file was {}".format(args.metrics_file))
+    if args.metrics_file is not None and args.metrics_interval <= 0:
+        parser.error("--metrics-interval must be positive")
+
+    vprint("Arg durability was {}".format(args.durability))
+    vprint("Arg sync interval was {}".format(args.sync_interval))
+    if args.sync_interval <= 0:
+        parser.error("--sync-interval must be positive")
+    sync_interval = int(args.sync_interval * MEBIBYTE)
+
+    vprint("Arg cache size was {}".format(args.cache_size))
+    vprint("Arg cache max file size was {}".format(args.cache_max_file_size))
+    if args.cache_size < 0:
+        parser.error("--cache-size cannot be negative")
+    if args.cache_size > 0 and args.engine == "asyncio":
+        parser.error("--cache-size is not supported by the asyncio engine")
+    cache_size = int(args.cache_size * MEBIBYTE)
+    cache_max_file_size = int(args.cache_size * DEFAULT_CACHE_MAX_FILE_FRACTION * MEBIBYTE)
+    if args.cache_max_file_size is not None:
+        if args.cache_max_file_size <= 0:
+            parser.error("--cache-max-file-size must be positive")
+        cache_max_file_size = int(args.cache_max_file_size * MEBIBYTE)
+
+    vprint("Arg max rate was {}".format(args.max_rate))
+    vprint("Arg session rate was {}".format(args.session_rate))
+    for option, rate in (("--max-rate", args.max_rate), ("--session-rate", args.session_rate)):
+        if rate is not None and rate <= 0:
+            parser.error("{} must be positive".format(option))
+        if rate is not None and args.engine == "asyncio":
+            parser.error("{} is not supported by the asyncio engine".format(option))
+    max_rate = int(args.max_rate * MEBIBYTE) if args.max_rate is not None else None
+    session_rate = int(args.session_rate * MEBIBYTE) if args.session_rate is not None else None
+
+    vprint("Arg idle timeout was {}".format(args.idle_timeout))
+    vprint("Arg read timeout was {}".format(args.read_timeout))
+    vprint("Arg max sessions was {}".format(args.max_sessions))
+    vprint("Arg max memory was {}".format(args.max_memory))
+    for option, value in (("--idle-timeout", args.idle_timeout), ("--read-timeout", args.read_timeout),
+                          ("--max-sessions", args.max_sessions), ("--max-memory", args.max_memory)):
+        if value is not None and value < 0:
+            parser.error("{} cannot be negative".format(option))
+        if value is not None and args.engine == "asyncio":
+            parser.error("{} is not supported by the asyncio engine".format(option))
+    # A timeout or limit of 0 means there is none
+    idle_timeout = args.idle_timeout or None
+    read_timeout = args.read_timeout if args.read_timeout is not None else DEFAULT_READ_TIMEOUT
+    read_timeout = read_timeout or None
+    max_sessions = args.max_sessions or None
+    max_memory = int(args.max_memory * MEBIBYTE) if args.max_memory else None
+    if max_sessions is not None and max_sessions < args.workers:
+        print("Warning: --max-sessions is below --workers, only {} workers will ever be busy".format(max_sessions))
+
+    vprint("Arg processes was {}".format(args.processes))
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if args.processes > 1:
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--processes needs fork() and SO_REUSEPORT, which this platform does not have")
+        if PORT == 0:
+            parser.error("--processes needs a fixed --port for the worker processes to share")
+
+    def serve(worker_index):
+        # Make server
+        reuse_port = args.processes > 1
+        if args.engine == "asyncio":
+            server = AsyncFTPServer(PORT, args.buffer_size, not args.no_sendfile, reuse_port, args.durability,
+                                    sync_interval)
+        else:
+            # Each worker process has a cache of its own
+            file_cache = FileCache(cache_size, cache_max_file_size) if cache_size > 0 else None
+            admission = None
+            if max_sessions is not None or max_memory is not None:
+                # With --processes, each worker process admits up to the limits on its own
+                admission = AdmissionController(max_sessions, max_memory)
+            # With --processes, each worker process has an equal part of --max-rate to share between its own sessions
+            shaper = None
+            if max_rate or session_rate:
+                shaper = TrafficShaper(max_rate // args.processes if max_rate else None, session_rate)
+            server = FTPServer(PORT, args.workers, args.buffer_size, not args.no_sendfile, not args.no_compression,
+                               storage, reuse_port, file_cache, args.durability, sync_interval, shaper,
+                               admission=admission, idle_timeout=idle_timeout, read_timeout=read_timeout)
+            if file_cache is not None:
+                print("Caching files of up to {:,} bytes in {:,} bytes of memory".format(file_cache.max_file_size,
+                                                                                      cache_size))
+        vprint("Made server")
+
+        if args.metrics_file is not None:
+            metrics_file = args.metrics_file
+            if args.processes > 1:
+                # Each worker process has metrics of its own
+                root, extension = os.path.splitext(metrics_file)
+                metrics_file = "{}-{}{}".format(root, worker_index, extension)
+            server.metrics.start_dumping(metrics_file, args.metrics_interval)
+            print("Writing metrics to {} every {:g} seconds".format(metrics_file, args.metrics_interval))
+        server.listen()
+
+    if args.processes > 1:
+        supervise(args.processes, serve)
+    else:
+        serve(0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+# ftp_shaping.py
+#
+# Rate limits for the file contents FTPServer moves, so one large transfer cannot take all of the bandwidth from the
+# other sessions. Only file contents are limited, commands and replies such as LIST and DELF are never held back. The
+# server lends a session's worker out while the session waits, see FTPServer.wait_aside().
+
+import threading
+import time
+
+# Constants
+# After a quiet spell a bucket lets this many seconds' worth of its rate through at once
+BURST_SECONDS = 0.1
+
+
+class TokenBucket:
+    """
+    Allows an average rate of bytes per second, with bursts of up to BURST_SECONDS of it. Callers reserve the bytes they
+    are about to move and wait the delay they are given, so the bucket can go into debt: a chunk larger than the burst
+    still goes through, and the next caller waits for the debt to be paid off as well.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: The rate in bytes per second
+        """
+        self.rate = rate
+        self.burst = rate * BURST_SECONDS
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Takes tokens for some bytes.
+        :param amount: The number of bytes
+        :return: The number of seconds to wait before moving them
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class TrafficShaper:
+    """
+    Applies a server's rate limits: a bucket shared by every session and a bucket of its own for each session.
+
+    Sessions move file contents a chunk of at most one transfer buffer at a time, and must wait out a chunk's delay
+    before asking for the next, so a session has at most one chunk waiting in the shared bucket. Every busy session
+    therefore gets a chunk through in turn, an equal share of the shared rate, however large the file it is moving.
+    """
+
+    def __init__(self, max_rate=None, session_rate=None):
+        """
+        :param max_rate: The most bytes per second for all sessions together, or None for no limit
+        :param session_rate: The most bytes per second for each session, or None for no limit
+        """
+        self.shared_bucket = TokenBucket(max_rate) if max_rate else None
+        self.session_rate = session_rate
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.delays = 0
+        self.delay_seconds = 0.0
+
+    def session_bucket(self):
+        """
+        :return: A TokenBucket for a new session, or None if sessions have no limit of their own
+        """
+        return TokenBucket(self.session_rate) if self.session_rate else None
+
+    def throttle(self, session_bucket, amount, sleep=time.sleep):
+        """
+        Waits until some bytes may be moved. The session's own limit is waited out first, so a slow session doesn't hold
+        tokens in the shared bucket it cannot use yet.
+        :param session_bucket: The session's TokenBucket, or None
+        :param amount: The number of bytes about to be moved
+        :param sleep: The function to wait with, given the number of seconds
+        """
+        delay = 0
+        if session_bucket is not None:
+            session_delay = session_bucket.reserve(amount)
+            if session_delay > 0:
+                sleep(session_delay)
+                delay += session_delay
+        if self.shared_bucket is not None:
+            shared_delay = self.shared_bucket.reserve(amount)
+            if shared_delay > 0:
+                sleep(shared_delay)
+                delay += shared_delay
+        with self.lock:
+            self.bytes += amount
+            if delay > 0:
+                self.delays += 1
+                self.delay_seconds += delay
+
+    def stats(self):
+        """
+        :return: The limits and how much they held transfers back, as a dict that can be encoded as JSON
+        """
+        with self.lock:
+            return {
+                "max_rate": self.shared_bucket.rate if self.shared_bucket is not None else None,
+                "session_rate": self.session_rate,
+                "bytes": self.bytes,
+                "delays": self.delays,
+                "delay_seconds": self.delay_seconds,
+            }
@@ -0,0 +1,554 @@
+# ftp_storage.py
+#
+# Where FTPServer keeps its files. DirectoryStorage keeps each file as it is in the working directory, as the server
+# always has. BlobStorage splits files into chunks stored once under their SHA-256, so identical content uploaded under
+# different names is only kept once.
+
+import errno
+import hashlib
+import json
+import os
+import stat
+import threading
+import time
+import urllib.parse
+
+# Constants
+# What an interrupted upload received is kept as a partial file under this suffix, so the upload can be resumed
+PARTIAL_SUFFIX = ".part"
+# DirectoryStorage keeps partial files in this directory, out of the way of the files clients can see
+PARTIAL_DIRECTORY = ".ftp-partial"
+# collect_garbage() removes partial files that nobody has resumed for this many seconds
+PARTIAL_MAX_AGE = 7 * 24 * 60 * 60
+
+# How uploads are made durable: left to the operating system, synced before they are stored under their names, or
+# synced every DEFAULT_SYNC_INTERVAL bytes as they are received
+DURABILITY_POLICIES = ["none", "close", "periodic"]
+DEFAULT_SYNC_INTERVAL = 16 * 1024 * 1024
+
+# BlobStorage splits files into chunks of this size
+BLOB_CHUNK_SIZE = 4 * 1024 * 1024
+BLOB_DIGEST_ALGORITHM = "sha256"
+TEMPORARY_SUFFIX = ".tmp"
+
+
+class StoredFile:
+    """
+    A file opened for reading from storage. Its contents may be spread over several files on disk, so they are read as
+    extents, each a file on disk with an offset and length, which can be handed to sendfile() as they are.
+    """
+
+    # The whole contents as a memoryview, for a file held in memory, which has no extents on disk
+    contents = None
+
+    def __init__(self, stat, size, digest=None):
+        self.stat = stat
+        self.size = size
+        # The SHA-256 of the whole file, if the storage already knows it
+        self.digest = digest
+
+    def extents(self, offset, length):
+        """
+        Finds where part of the file is kept on disk.
+        :param offset: The position in the file to start from
+        :param length: The number of bytes wanted
+        :return: An iterator of (file opened for binary reading, offset, length) tuples
+        """
+        raise NotImplementedError
+
+    def readinto(self, offset, buffer):
+        """
+        Reads part of the file into a buffer.
+        :param offset: The position in the file to start from
+        :param buffer: A writable buffer, filled from its start
+        :return: The number of bytes read, fewer than the buffer holds only at the end of the file
+        """
+        buffer = memoryview(buffer)
+        amount_read = 0
+        for binary_file, extent_offset, extent_length in self.extents(offset, len(buffer)):
+            binary_file.seek(extent_offset)
+            received = binary_file.readinto(buffer[amount_read:amount_read + extent_length])
+            amount_read += received
+            if received < extent_length:
+                break
+        return amount_read
+
+    def read(self, offset, length):
+        """
+        Reads part of the file.
+        :param offset: The position in the file to start from
+        :param length: The number of bytes wanted
+        :return: The bytes read, fewer than length only at the end of the file
+        """
+        data = bytearray(length)
+        return bytes(data[:self.readinto(offset, data)])
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LocalFile(StoredFile):
+    """
+    A file kept as it is on disk.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        file_stat = os.fstat(self.file.fileno())
+        super().__init__(file_stat, file_stat.st_size)
+
+    def extents(self, offset, length):
+        yield self.file, offset, length
+
+    def close(self):
+        self.file.close()
+
+
+class ManifestFile(StoredFile):
+    """
+    A file kept by BlobStorage as a manifest of its chunks.
+    """
+
+    def __init__(self, storage, manifest, name_stat, digest):
+        super().__init__(name_stat, manifest["size"], digest)
+        self.storage = storage
+        self.chunk_size = manifest["chunk_size"]
+        self.chunks = manifest["chunks"]
+        # The chunk being read, kept open as reads usually carry on through it
+        self.open_chunk = None
+        self.open_chunk_file = None
+
+    def extents(self, offset, length):
+        end = min(offset + length, self.size)
+        while offset < end:
+            index = offset // self.chunk_size
+            chunk_offset = offset - index * self.chunk_size
+            extent_length = min(self.chunk_size - chunk_offset, end - offset)
+            if self.open_chunk != self.chunks[index]:
+                self.close()
+                self.open_chunk_file = open(self.storage.blob_path(self.chunks[index]), "rb")
+                self.open_chunk = self.chunks[index]
+            yield self.open_chunk_file, chunk_offset, extent_length
+            offset += extent_length
+
+    def close(self):
+        if self.open_chunk_file is not None:
+            self.open_chunk_file.close()
+            self.open_chunk_file = None
+            self.open_chunk = None
+
+
+class MemoryFile(StoredFile):
+    """
+    A file whose contents are held in memory, e.g. by the server's file cache.
+    """
+
+    def __init__(self, stat, contents, digest=None):
+        super().__init__(stat, len(contents), digest)
+        self.contents = memoryview(contents)
+
+    def extents(self, offset, length):
+        raise NotImplementedError("MemoryFile has no extents on disk, use its contents")
+
+    def readinto(self, offset, buffer):
+        buffer = memoryview(buffer)
+        amount_read = max(0, min(len(buffer), self.size - offset))
+        buffer[:amount_read] = self.contents[offset:offset + amount_read]
+        return amount_read
+
+
+def sync_data(binary_file):
+    """
+    Flushes a file and waits for its contents to reach the disk, without its metadata where the platform allows.
+    """
+    binary_file.flush()
+    getattr(os, "fdatasync", os.fsync)(binary_file.fileno())
+
+
+def sync_directory(path):
+    """
+    Waits for the entries of a directory, e.g. a file just renamed into it, to reach the disk. Does nothing on platforms
+    where directories cannot be opened.
+    """
+    try:
+        directory_fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+class PartialFile:
+    """
+    An upload being received. It is written to a file of its own, named after the partial file with this process and
+    thread added, so concurrent uploads of the same name never write to the same file. The file is preallocated to the
+    size the client announced, so the filesystem can lay it out in one piece and a full disk is found before the
+    contents arrive rather than part way through them.
+
+    A complete upload is committed from writing_path. An upload that ends early is truncated to the bytes actually
+    written and, if it is resumable, only then moved to the partial file's path, so a partial file never has a
+    preallocated end of zeros to resume from, even if the server dies part way through.
+    """
+
+    def __init__(self, path, size, offset=0, durability="none", sync_interval=DEFAULT_SYNC_INTERVAL, resumable=True):
+        """
+        :param path: The path of the partial file
+        :param size: The size the client announced for the whole file
+        :param offset: How many bytes of an earlier attempt in the partial file to keep, 0 to start over
+        :param durability: One of DURABILITY_POLICIES
+        :param sync_interval: With "periodic" durability, the number of bytes written between syncs
+        :param resumable: Whether an upload that ends early is kept to be resumed, or removed
+        """
+        self.path = path
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.resumable = resumable
+        self.unsynced = 0
+        self.writing_path = "{}.{}.{}{}".format(path, os.getpid(), threading.get_ident(), TEMPORARY_SUFFIX)
+        if offset > 0:
+            try:
+                os.replace(path, self.writing_path)
+            except FileNotFoundError:
+                # Another session resuming the same upload got to it first
+                raise ConnectionAbortedError("Partial file {} was taken by another session".format(path))
+            self.file = open(self.writing_path, "r+b")
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        else:
+            self.file = open(self.writing_path, "wb")
+        self.length = offset
+        if size > offset and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.file.fileno(), offset, size - offset)
+            except OSError as e:
+                # Filesystems that cannot preallocate are written as they always have been, but a full disk fails now
+                if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                    self.close()
+                    self.abandon()
+                    raise
+
+    def write(self, data):
+        amount_written = self.file.write(data)
+        self.length += amount_written
+        if self.durability == "periodic":
+            self.unsynced += amount_written
+            if self.unsynced >= self.sync_interval:
+                sync_data(self.file)
+                self.unsynced = 0
+        return amount_written
+
+    def close(self):
+        """
+        Truncates the file to what was written and syncs it if the durability policy says to. The file stays at
+        writing_path, to be committed or abandoned.
+        """
+        if self.file.closed:
+            return
+        try:
+            self.file.truncate(self.length)
+            if self.durability == "close":
+                sync_data(self.file)
+        finally:
+            self.file.close()
+
+    def abandon(self):
+        """
+        Gives up on an upload that ended early. A resumable one is kept at the partial file's path, any other is
+        removed.
+        """
+        self.close()
+        try:
+            if self.resumable:
+                os.replace(self.writing_path, self.path)
+            else:
+                os.remove(self.writing_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is not None:
+            self.abandon()
+
+
+def remove_abandoned_uploads(directory):
+    """
+    Removes the files uploads were being written to when the server last stopped, and the partial files nobody has
+    resumed for PARTIAL_MAX_AGE seconds, from a directory.
+    :param directory: The directory the storage keeps partial files in
+    :return: The number of files removed
+    """
+    removed = 0
+    expired = time.time() - PARTIAL_MAX_AGE
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(TEMPORARY_SUFFIX) or (name.endswith(PARTIAL_SUFFIX) and os.path.getmtime(path) < expired):
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def partial_file_name(file_name, key):
+    """
+    Gets the name of the partial file for an upload, a single path component whatever the file name holds.
+    :param file_name: The name of the file
+    :param key: The client's key for the upload, or "" for clients that don't send one
+    """
+    name = urllib.parse.quote(file_name, safe="")
+    if key:
+        name += "." + urllib.parse.quote(key, safe="")
+    return name + PARTIAL_SUFFIX
+
+
+class DirectoryStorage:
+    """
+    Keeps each file as it is in the working directory. Partial uploads are kept in PARTIAL_DIRECTORY, which is the
+    one name in the working directory clients cannot use.
+    """
+
+    deduplicates = False
+
+    def list_files(self):
+        return [name for name in os.listdir() if name != PARTIAL_DIRECTORY]
+
+    def listing_version(self):
+        """
+        Gets a value that changes whenever a file is added, removed or replaced, so a cached listing can be checked.
+        """
+        return os.stat(os.curdir).st_mtime_ns
+
+    def describe(self, file_name):
+        """
+        Gets the metadata of a file for a listing.
+        :param file_name: The name of the file
+        :return: A (size, modification time, is a directory) tuple, raises FileNotFoundError if there is no such file
+        """
+        file_stat = os.stat(file_name)
+        return file_stat.st_size, file_stat.st_mtime, stat.S_ISDIR(file_stat.st_mode)
+
+    def open_file(self, file_name):
+        """
+        Opens a file for reading.
+        :param file_name: The name of the file
+        :return: A StoredFile, raises FileNotFoundError or IsADirectoryError if there is no such file
+        """
+        return LocalFile(file_name)
+
+    def stat(self, file_name):
+        return os.stat(file_name)
+
+    def exists(self, file_name):
+        return os.path.isfile(file_name)
+
+    def delete_file(self, file_name):
+        os.remove(file_name)
+
+    def partial_path(self, file_name, key=""):
+        """
+        Gets the path an interrupted upload of a file is kept at to be resumed.
+        :param file_name: The name of the file
+        :param key: The client's key for the upload, so different clients' uploads of the same name are kept apart
+        :return: The path of the partial file
+        """
+        os.makedirs(PARTIAL_DIRECTORY, exist_ok=True)
+        return os.path.join(PARTIAL_DIRECTORY, partial_file_name(file_name, key))
+
+    def commit_file(self, partial_path, file_name, durable=False):
+        """
+        Stores a completed upload under its name, replacing any file already there.
+        :param partial_path: The path of the partial file, which is moved or removed
+        :param file_name: The name of the file
+        :param durable: Whether to wait for the file to be stored on disk under its name, the partial file itself must
+                        already have been synced
+        :return: The SHA-256 of the file if it was computed along the way, otherwise None
+        """
+        os.replace(partial_path, file_name)
+        if durable:
+            sync_directory(os.path.dirname(file_name) or os.curdir)
+        return None
+
+    def link_content(self, file_name, size, digest, durable=False):
+        """
+        Stores content the storage already holds under another name.
+        :param file_name: The name to store it under
+        :param size: The size of the content
+        :param digest: The SHA-256 of the content
+        :param durable: Whether to wait for the name to be stored on disk
+        :return: Whether the content was found and stored
+        """
+        return False
+
+    def collect_garbage(self):
+        """
+        Removes the files uploads were being written to when the server last stopped, and partial files nobody has
+        resumed for PARTIAL_MAX_AGE seconds. Only safe while nothing else is using the storage.
+        :return: The number of files removed
+        """
+        if not os.path.isdir(PARTIAL_DIRECTORY):
+            return 0
+        return remove_abandoned_uploads(PARTIAL_DIRECTORY)
+
+
+class BlobStorage:
+    """
+    Keeps files in a content-addressed store. Each file is split into chunks which are kept once under their SHA-256,
+    a manifest kept under the SHA-256 of the whole file lists its chunks, and each name refers to a manifest.
+
+    Chunks and manifests no longer referred to by any name are removed by collect_garbage() rather than on delete, so a
+    file deleted while another session is downloading it can still be read to the end.
+    """
+
+    deduplicates = True
+
+    def __init__(self, root, chunk_size=BLOB_CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.blobs_directory = os.path.join(root, "blobs")
+        self.manifests_directory = os.path.join(root, "manifests")
+        self.names_directory = os.path.join(root, "names")
+        self.staging_directory = os.path.join(root, "staging")
+        for directory in (self.blobs_directory, self.manifests_directory, self.names_directory,
+                          self.staging_directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def write_atomically(self, path, data, durable=False):
+        """
+        Writes a file so that readers see either nothing or the whole of it. The contents are written to the staging
+        directory first, where they can't be mistaken for a name or chunk.
+        :param path: The path of the file
+        :param data: The contents as bytes
+        :param durable: Whether to wait for the file to be stored on disk
+        """
+        temporary_path = os.path.join(self.staging_directory, "{}.{}.{}{}".format(
+            os.path.basename(path), os.getpid(), threading.get_ident(), TEMPORARY_SUFFIX))
+        with open(temporary_path, "wb") as binary_file:
+            binary_file.write(data)
+            if durable:
+                sync_data(binary_file)
+        os.replace(temporary_path, path)
+        if durable:
+            sync_directory(os.path.dirname(path))
+
+    def blob_path(self, blob_digest):
+        # Spread the chunks over subdirectories so none of them grows too large
+        return os.path.join(self.blobs_directory, blob_digest[:2], blob_digest)
+
+    def manifest_path(self, file_digest):
+        return os.path.join(self.manifests_directory, file_digest)
+
+    def name_path(self, file_name):
+        return os.path.join(self.names_directory, urllib.parse.quote(file_name, safe=""))
+
+    def read_name(self, file_name):
+        """
+        Looks up the manifest a name refers to.
+        :param file_name: The name of the file
+        :return: A (digest as hex, os.stat_result of the name) tuple, raises FileNotFoundError if there is no such file
+        """
+        with open(self.name_path(file_name), "r") as name_file:
+            return name_file.read().strip(), os.fstat(name_file.fileno())
+
+    def read_manifest(self, file_digest):
+        with open(self.manifest_path(file_digest), "r") as manifest_file:
+            return json.load(manifest_file)
+
+    def list_files(self):
+        return [urllib.parse.unquote(name) for name in os.listdir(self.names_directory)]
+
+    def listing_version(self):
+        return os.stat(self.names_directory).st_mtime_ns
+
+    def describe(self, file_name):
+        file_digest, name_stat = self.read_name(file_name)
+        return self.read_manifest(file_digest)["size"], name_stat.st_mtime, False
+
+    def open_file(self, file_name):
+        file_digest, name_stat = self.read_name(file_name)
+        return ManifestFile(self, self.read_manifest(file_digest), name_stat, bytes.fromhex(file_digest))
+
+    def stat(self, file_name):
+        return os.stat(self.name_path(file_name))
+
+    def exists(self, file_name):
+        return os.path.isfile(self.name_path(file_name))
+
+    def delete_file(self, file_name):
+        os.remove(self.name_path(file_name))
+
+    def partial_path(self, file_name, key=""):
+        return os.path.join(self.staging_directory, partial_file_name(file_name, key))
+
+    def commit_file(self, partial_path, file_name, durable=False):
+        file_digest = hashlib.new(BLOB_DIGEST_ALGORITHM)
+        chunks = []
+        with open(partial_path, "rb") as binary_file:
+            while True:
+                chunk = binary_file.read(self.chunk_size)
+                if not chunk:
+                    break
+                file_digest.update(chunk)
+                blob_digest = hashlib.new(BLOB_DIGEST_ALGORITHM, chunk).hexdigest()
+                blob_path = self.blob_path(blob_digest)
+                if not os.path.exists(blob_path):
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    self.write_atomically(blob_path, chunk, durable)
+                chunks.append(blob_digest)
+            size = binary_file.tell()
+
+        manifest_path = self.manifest_path(file_digest.hexdigest())
+        if not os.path.exists(manifest_path):
+            manifest = {"size": size, "chunk_size": self.chunk_size, "chunks": chunks}
+            self.write_atomically(manifest_path, json.dumps(manifest).encode("utf-8"), durable)
+        self.write_atomically(self.name_path(file_name), file_digest.hexdigest().encode("utf-8"), durable)
+        os.remove(partial_path)
+        return file_digest.digest()
+
+    def link_content(self, file_name, size, digest, durable=False):
+        try:
+            manifest = self.read_manifest(digest.hex())
+        except (FileNotFoundError, ValueError):
+            return False
+        if manifest["size"] != size:
+            return False
+        self.write_atomically(self.name_path(file_name), digest.hex().encode("utf-8"), durable)
+        return True
+
+    def collect_garbage(self):
+        """
+        Removes the manifests and chunks that no name refers to any more, along with any temporary files left by an
+        interrupted write and partial files nobody has resumed for PARTIAL_MAX_AGE seconds. Only safe while nothing
+        else is using the storage.
+        :return: The number of files removed
+        """
+        removed = remove_abandoned_uploads(self.staging_directory)
+
+        live_manifests = set()
+        for name in os.listdir(self.names_directory):
+            with open(os.path.join(self.names_directory, name), "r") as name_file:
+                live_manifests.add(name_file.read().strip())
+
+        live_blobs = set()
+        for file_digest in os.listdir(self.manifests_directory):
+            if file_digest in live_manifests:
+                live_blobs.update(self.read_manifest(file_digest)["chunks"])
+            else:
+                os.remove(self.manifest_path(file_digest))
+                removed += 1
+
+        for directory, subdirectories, blob_digests in os.walk(self.blobs_directory):
+            for blob_digest in blob_digests:
+                if blob_digest not in live_blobs:
+                    os.remove(os.path.join(directory, blob_digest))
+                    removed += 1
+        return removed
@@ -0,0 +1,43 @@
+# test_delta.py
+#
+# Checks the rolling checksum delta uploads use to find the server's blocks. Run from partA with
+# python3 -m unittest discover tests
+
+import os
+import random
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "client"))
+
+from ftp_client import roll_adler32  # noqa: E402
+
+
+class RollAdler32Test(unittest.TestCase):
+
+    def check_rolling(self, data, window_size):
+        """
+        Rolls a window along the data a byte at a time, checking the checksum against zlib.adler32 of each window.
+        """
+        checksum = zlib.adler32(data[:window_size])
+        a, b = checksum & 0xffff, checksum >> 16
+        for position in range(len(data) - window_size):
+            a, b = roll_adler32(a, b, data[position], data[position + window_size], window_size)
+            window = data[position + 1:position + 1 + window_size]
+            self.assertEqual((b << 16) | a, zlib.adler32(window), "window of {} at {}".format(window_size, position))
+
+    def test_random_data(self):
+        data = bytes(random.Random(1337).getrandbits(8) for _ in range(20000))
+        for window_size in (1, 2, 7, 2048, 5552, 6000):
+            self.check_rolling(data, window_size)
+
+    def test_extreme_bytes(self):
+        # Runs of 0xff push the sums past the modulus fastest, runs of zeros leave them where they are
+        for data in (b"\xff" * 12000, bytes(12000), b"\xff\x00" * 6000):
+            for window_size in (1, 16, 5552, 8000):
+                self.check_rolling(data, window_size)
+
+
+if __name__ == "__main__":
+    unittest.main()